@@ -0,0 +1,241 @@
+import asyncio
+import weakref
+from contextlib import asynccontextmanager
+
+from playwright.async_api import async_playwright
+
+from config import BROWSER_POOL_MAX_IDLE_PAGES, BROWSER_POOL_RECYCLE_AFTER, PROXIES_ENABLED, \
+    CIRCUIT_BREAKER_IDENTITY_HOLD
+from logger import Logger
+from proxy_manager import ProxyManager
+from rate_controller import RateController
+from resource_blocker import apply_resource_blocking
+from utils import get_browser, launch_browser, get_isolated_context
+
+
+class BrowserPool:
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super(BrowserPool, cls).__new__(cls)
+            cls._instance.playwright = None
+            cls._instance.context = None
+            cls._instance.browser = None
+            cls._instance.user_agent = None
+            cls._instance.idle_pages = []
+            cls._instance.pages_in_use = 0
+            cls._instance.pages_served = 0
+            cls._instance.lock = asyncio.Lock()
+            cls._instance.context_proxies = weakref.WeakKeyDictionary()
+            cls._instance.retired_contexts = weakref.WeakSet()
+        return cls._instance
+
+    @property
+    def is_running(self) -> bool:
+        return self.context is not None
+
+    async def start(self) -> None:
+        """Start Playwright and launch the shared browser profile if it is not running yet."""
+        async with self.lock:
+            if self.is_running:
+                return
+
+            Logger.info("Starting browser pool")
+            if self.playwright is None:
+                self.playwright = await async_playwright().start()
+            await self.__launch_context()
+            Logger.info("Browser pool started")
+
+    async def stop(self) -> None:
+        """Close the shared browser profile and stop Playwright."""
+        async with self.lock:
+            Logger.info("Stopping browser pool")
+            await self.__close_context()
+            if self.browser is not None:
+                try:
+                    await self.browser.close()
+                except Exception as e:
+                    Logger.warn("Error closing isolated browser", e)
+                self.browser = None
+            if self.playwright is not None:
+                await self.playwright.stop()
+                self.playwright = None
+            Logger.info("Browser pool stopped")
+
+    async def recycle(self) -> None:
+        """Relaunch the shared browser profile, dropping every idle page."""
+        async with self.lock:
+            Logger.info(f"Recycling browser pool after {self.pages_served} pages")
+            await self.__close_context()
+            await self.__launch_context()
+
+    async def retire_context(self, context, url: str = None) -> None:
+        """Take a quarantined context out of rotation: relaunch the shared profile, or close an isolated context.
+
+        Without another proxy to move to, the relaunched profile keeps the IP and cookies that tripped the breaker. The
+        proxy, or the host of the url for a direct connection, is then held for CIRCUIT_BREAKER_IDENTITY_HOLD instead.
+        """
+        # Every page of a context hits its quarantine, only the first one retires it
+        if context in self.retired_contexts:
+            return
+        self.retired_contexts.add(context)
+
+        if context is self.context:
+            async with self.lock:
+                # The profile may have been recycled while this waited for the lock
+                if context is not self.context:
+                    return
+                Logger.warn("Retiring quarantined browser profile, pages still using it will fail and be retried")
+                retired_proxy = self.get_proxy_key(context)
+                await self.__close_context()
+                await self.__launch_context()
+                if self.get_proxy_key(self.context) == retired_proxy:
+                    RateController().pause(CIRCUIT_BREAKER_IDENTITY_HOLD, "browser profile relaunched with the same IP",
+                                           url, retired_proxy)
+            return
+
+        Logger.warn("Retiring quarantined isolated context")
+        try:
+            await context.close()
+        except Exception as e:
+            Logger.warn("Error closing isolated context", e)
+
+    async def retire_proxy_contexts(self, proxy_key: str) -> None:
+        """Retire every open context that goes through a quarantined proxy."""
+        for context, context_proxy in list(self.context_proxies.items()):
+            if context_proxy == proxy_key:
+                await self.retire_context(context)
+
+    async def acquire_page(self):
+        """Get an idle page from the pool, opening a new tab when none is available."""
+        if not self.is_running:
+            await self.start()
+
+        if self.idle_pages:
+            page = self.idle_pages.pop()
+        else:
+            page = await self.context.new_page()
+
+        self.pages_in_use += 1
+        self.pages_served += 1
+        return page
+
+    async def release_page(self, page) -> None:
+        """Return a page to the pool so the next stage can reuse it."""
+        self.pages_in_use -= 1
+
+        if self.is_running and not page.is_closed():
+            if len(self.idle_pages) < BROWSER_POOL_MAX_IDLE_PAGES:
+                try:
+                    await page.goto('about:blank')
+                    self.idle_pages.append(page)
+                except Exception as e:
+                    Logger.warn("Could not reset page, closing it", e)
+                    await self.__close_page(page)
+            else:
+                await self.__close_page(page)
+
+        if self.pages_in_use == 0 and self.pages_served >= BROWSER_POOL_RECYCLE_AFTER:
+            await self.recycle()
+
+    @asynccontextmanager
+    async def page(self, stage: str = None):
+        page = await self.acquire_page()
+        try:
+            await apply_resource_blocking(page, stage)
+            yield page
+        finally:
+            await self.release_page(page)
+
+    async def get_cookies(self) -> list[dict]:
+        if not self.is_running:
+            await self.start()
+        return await self.context.cookies()
+
+    async def new_isolated_context(self):
+        """Open a separate browser context seeded with the cookies of the shared profile."""
+        if not self.is_running:
+            await self.start()
+
+        async with self.lock:
+            if self.browser is None or not self.browser.is_connected():
+                Logger.info("Launching browser for isolated contexts")
+                self.browser = await launch_browser(self.playwright)
+
+        storage_state = await self.context.storage_state()
+        proxy = self.pick_proxy()
+        context = await get_isolated_context(self.browser, storage_state, proxy and {'server': proxy.server})
+        self.context_proxies[context] = proxy and proxy.key
+        return context
+
+    @asynccontextmanager
+    async def isolated_context(self):
+        context = await self.new_isolated_context()
+        try:
+            yield context
+        finally:
+            try:
+                await context.close()
+            except Exception as e:
+                Logger.warn("Error closing isolated context", e)
+
+    @asynccontextmanager
+    async def worker_page(self, isolated: bool, stage: str = None):
+        """Yield a page from its own isolated context, or a shared-profile page when isolation is off."""
+        if isolated:
+            async with self.isolated_context() as context:
+                page = await context.new_page()
+                await apply_resource_blocking(page, stage)
+                yield page
+        else:
+            async with self.page(stage) as page:
+                yield page
+
+    def get_proxy_key(self, context) -> str | None:
+        """The proxy a context was launched with, None when it connects directly."""
+        return self.context_proxies.get(context)
+
+    @staticmethod
+    def pick_proxy():
+        if not PROXIES_ENABLED:
+            return None
+
+        proxy = ProxyManager().get_proxy()
+        if proxy is None:
+            Logger.warn("No working proxy available, connecting directly")
+        else:
+            Logger.info(f"Using proxy {proxy.key} (score {proxy.score:.2f})")
+        return proxy
+
+    async def __launch_context(self) -> None:
+        proxy = self.pick_proxy()
+        self.context, page = await get_browser(self.playwright, proxy and {'server': proxy.server})
+        self.context_proxies[self.context] = proxy and proxy.key
+        self.context.on('close', self.__on_context_closed)
+        self.user_agent = await page.evaluate('navigator.userAgent')
+        self.idle_pages = [page]
+        self.pages_served = 0
+
+    async def __close_context(self) -> None:
+        context = self.context
+        self.context = None
+        self.idle_pages = []
+        if context is not None:
+            try:
+                await context.close()
+            except Exception as e:
+                Logger.warn("Error closing browser context", e)
+
+    def __on_context_closed(self, context) -> None:
+        if context is self.context:
+            Logger.warn("Browser context closed unexpectedly, it will be relaunched on next use")
+            self.context = None
+            self.idle_pages = []
+
+    @staticmethod
+    async def __close_page(page) -> None:
+        try:
+            await page.close()
+        except Exception as e:
+            Logger.warn("Error closing page", e)
@@ -0,0 +1,105 @@
+import uuid
+from datetime import datetime, timedelta
+
+from config import RUN_CHECKPOINT_MAX_AGE
+from db import get_unfinished_run, save_run, get_run_items, save_run_item
+from logger import Logger
+from models import Promotion, ProductDetails, price_change_to_dict, price_change_from_dict
+from utils import get_product_key
+
+
+def get_product_details_key(promotion: Promotion) -> str:
+    return f"{get_product_key(promotion.product_url)}/{promotion.promotion_code}"
+
+
+class RunCheckpoint:
+    """Saves the outputs of a scraper run to Mongo item by item, so a run that dies part way can be resumed.
+
+    Search terms, product links, promo codes and promotions are saved under the run id as soon as they are scraped,
+    failures are not, so a resumed run only scrapes what is missing. A run is finished once its products have been
+    processed, until then the next start younger than RUN_CHECKPOINT_MAX_AGE picks it up again.
+    """
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super(RunCheckpoint, cls).__new__(cls)
+            cls._instance.run_id = None
+            cls._instance.items = {}
+        return cls._instance
+
+    @property
+    def is_active(self) -> bool:
+        return self.run_id is not None
+
+    async def start(self, force_refresh: bool = False) -> tuple[str, bool]:
+        """Resume the latest unfinished run or start a new one, returning its run id and whether it forces a refresh."""
+        current_time = datetime.utcnow()
+        run = await get_unfinished_run(current_time - timedelta(seconds=RUN_CHECKPOINT_MAX_AGE))
+        if run is None:
+            self.run_id = uuid.uuid4().hex[:12]
+            self.items = {}
+            await save_run(self.run_id, {"status": "running", "started_at": current_time,
+                                         "force_refresh": force_refresh})
+            return self.run_id, force_refresh
+
+        self.run_id = run['_id']
+        self.items = await get_run_items(self.run_id)
+        force_refresh = run.get('force_refresh', False) or force_refresh
+        await save_run(self.run_id, {"resumed_at": current_time, "force_refresh": force_refresh})
+        Logger.info(f"Resuming unfinished run {self.run_id} started at {run['started_at']}",
+                    {stage: len(items) for stage, items in self.items.items()})
+        return self.run_id, force_refresh
+
+    async def finish(self) -> None:
+        if not self.is_active:
+            return
+        await save_run(self.run_id, {"status": "finished", "finished_at": datetime.utcnow()})
+        self.run_id = None
+        self.items = {}
+
+    def get(self, stage: str, key: str):
+        return self.items.get(stage, {}).get(key)
+
+    async def save(self, stage: str, key: str, value) -> None:
+        if not self.is_active:
+            return
+        self.items.setdefault(stage, {})[key] = value
+        try:
+            await save_run_item(self.run_id, stage, key, value)
+        except Exception as e:
+            # The item is only scraped again if the run has to be resumed
+            Logger.warn(f"Could not checkpoint {stage} item {key}", e)
+
+    def get_search_links(self, search_term: str) -> list[str] | None:
+        return self.get('search', search_term)
+
+    async def save_search_links(self, search_term: str, links: list[str]) -> None:
+        await self.save('search', search_term, links)
+
+    def get_promo_codes(self, link: str) -> set[str] | None:
+        promo_codes = self.get('promo_codes', get_product_key(link))
+        return set(promo_codes) if promo_codes is not None else None
+
+    async def save_promo_codes(self, link: str, promo_codes: set[str]) -> None:
+        await self.save('promo_codes', get_product_key(link), sorted(promo_codes))
+
+    def get_promotions(self, promo_code: str) -> list[Promotion] | None:
+        promotions = self.get('promotions', promo_code)
+        return list(map(Promotion.from_dict, promotions)) if promotions is not None else None
+
+    async def save_promotions(self, promo_code: str, promotions: list[Promotion],
+                              price_changes: list[tuple[Promotion, str]]) -> None:
+        # Saved first, a promo code restored with its promotions must not lose the price changes they caused
+        await self.save('price_changes', promo_code, list(map(price_change_to_dict, price_changes)))
+        await self.save('promotions', promo_code, [promotion.to_dict() for promotion in promotions])
+
+    def get_price_changes(self, promo_code: str) -> list[tuple[Promotion, str]]:
+        return list(map(price_change_from_dict, self.get('price_changes', promo_code) or []))
+
+    def get_product_details(self, promotion: Promotion) -> ProductDetails | None:
+        product_details = self.get('product_details', get_product_details_key(promotion))
+        return ProductDetails.from_dict(product_details) if product_details is not None else None
+
+    async def save_product_details(self, promotion: Promotion, product_details: ProductDetails) -> None:
+        await self.save('product_details', get_product_details_key(promotion), product_details.to_dict())
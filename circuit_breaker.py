@@ -0,0 +1,60 @@
+import time
+
+from config import CIRCUIT_BREAKER_BLOCK_THRESHOLD, CIRCUIT_BREAKER_FAILURE_THRESHOLD, CIRCUIT_BREAKER_QUARANTINE
+from logger import Logger
+
+
+class BreakerState:
+    def __init__(self):
+        self.consecutive_blocks = 0
+        self.consecutive_failures = 0
+        self.quarantined_until = 0.0
+        self.trips = 0
+
+
+class CircuitBreaker:
+    """Counts consecutive failures per browser context, HTTP session or proxy, and quarantines the ones that trip."""
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super(CircuitBreaker, cls).__new__(cls)
+            cls._instance.states = {}
+        return cls._instance
+
+    def get_state(self, key: str) -> BreakerState:
+        if key not in self.states:
+            self.states[key] = BreakerState()
+        return self.states[key]
+
+    def is_quarantined(self, key: str) -> bool:
+        state = self.states.get(key)
+        return state is not None and time.monotonic() < state.quarantined_until
+
+    def record_success(self, key: str) -> None:
+        state = self.get_state(key)
+        state.consecutive_blocks = 0
+        state.consecutive_failures = 0
+
+    def record_failure(self, key: str, reason: str, blocked: bool) -> bool:
+        """Count a failure, returning True when it trips the breaker and the key is quarantined.
+
+        Blocks (CAPTCHA, dog page, throttling) trip the breaker sooner than timeouts or missing selectors.
+        """
+        state = self.get_state(key)
+        if blocked:
+            state.consecutive_blocks += 1
+        else:
+            state.consecutive_failures += 1
+
+        if state.consecutive_blocks < CIRCUIT_BREAKER_BLOCK_THRESHOLD and \
+                state.consecutive_failures < CIRCUIT_BREAKER_FAILURE_THRESHOLD:
+            return False
+
+        state.trips += 1
+        state.consecutive_blocks = 0
+        state.consecutive_failures = 0
+        state.quarantined_until = time.monotonic() + CIRCUIT_BREAKER_QUARANTINE
+        Logger.error(f"Circuit breaker tripped for {key} ({reason}), quarantined for {CIRCUIT_BREAKER_QUARANTINE}s "
+                     f"(trip #{state.trips})")
+        return True
@@ -0,0 +1,20 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    # Optional, `pip install orjson` makes encoding large run results several times faster
+    orjson = None
+
+
+def dumps(data) -> bytes:
+    """Compact JSON, values JSON has no type for are written with str()."""
+    if orjson is not None:
+        return orjson.dumps(data, default=str)
+    return json.dumps(data, default=str, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def loads(data: bytes | str):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
@@ -6,10 +6,100 @@ DELAY_BETWEEN_PAGES = 7
 DELAY_BETWEEN_LINKS = 15
 MAX_PAGES_TO_SCRAPE = 1
 LIMITING_RESULTS = 50
+SCRAPER_EXECUTION_MODE = 'staged'  # 'staged' runs the stages one after another, 'streaming' overlaps them, 'distributed' queues them for worker.py processes
+PIPELINE_QUEUE_SIZE = 100  # max items waiting between two streaming stages
+PRODUCT_DETAILS_CONCURRENCY = 1  # isolated browser contexts used to scrape product details
+RESOURCE_BLOCKING_ENABLED = True
+BLOCKED_RESOURCE_TYPES = ['image', 'media', 'font']
+BLOCKED_URL_PATTERNS = [
+    r'amazon-adsystem\.com',
+    r'fls-eu\.amazon\.',
+    r'unagi(-eu)?\.amazon\.',
+    r'/uedata',
+    r'doubleclick\.net',
+    r'google-analytics\.com',
+    r'googletagmanager\.com',
+]
+# Resource types from BLOCKED_RESOURCE_TYPES that are still loaded for a stage
+STAGE_ALLOWED_RESOURCE_TYPES = {
+    'setup': ['image', 'media', 'font'],
+    'search': [],
+    'promo_codes': [],
+    'promotions': [],
+    'product_details': [],
+}
+PROMO_CODE_FETCHER = 'http'  # 'http' fetches product pages with aiohttp and falls back to the browser, 'browser' always uses Playwright
+HTTP_FETCHER_CONNECTION_LIMIT = 10
+HTTP_FETCHER_TIMEOUT = 30
+PROMO_CODE_CACHE_TTL = 3 * 24 * 60 * 60  # seconds a product page's promo codes are reused without a visit
+PRODUCTS_BULK_WRITE_CHUNK_SIZE = 500
+PROMO_PAGE_SCRAPE_MODE = 'dom'  # 'dom' clicks Show More and scrapes the page, 'network' reads its XHR responses (unverified URL pattern below)
+PROMO_PAGE_RESPONSE_URL_PATTERN = r'/promotion/psp/.*productInfoList'  # regex matching the XHR URLs that return product cards
+PROMO_PAGE_RESPONSE_TIMEOUT = 15  # seconds to wait for a product list response before falling back to the DOM
+PROMO_PAGE_PAGINATION_KEY = 'nextPageToken'  # JSON key of the next page token, sent back as a query parameter of the same name
+PROMO_PAGE_MAX_RESPONSES = 100  # guard against pagination that never ends
+PROMO_PAGE_CAPTURE_MAX_FAILURES = 3  # capture failures after which the rest of the run scrapes the DOM
+PROMO_SEARCH_CONCURRENCY = 1  # tabs of the shared profile running a promotion page's search terms at once
+FINGERPRINT_MAX_AGE_DAYS = 3  # days before unchanged search results and promotion listings are crawled in full again, keep below DAYS_TO_EXPIRE_OLD_PRODUCTS
+RUN_CHECKPOINT_MAX_AGE = 36 * 60 * 60  # seconds an unfinished run is resumed by the next start, well over the day between scheduled runs
+RUN_CHECKPOINT_TTL = 7 * 24 * 60 * 60  # seconds runs and their checkpointed items are kept in Mongo
+JOB_LEASE_SECONDS = 5 * 60  # seconds a worker holds a job before another worker may take it over, renewed while it runs
+JOB_MAX_ATTEMPTS = 3  # leases of a job before it is marked failed
+JOB_POLL_INTERVAL = 5  # seconds an idle worker waits before asking the queue again
+JOB_PROGRESS_INTERVAL = 30  # seconds between the bot's progress checks of a distributed run
+JOB_RUN_TIMEOUT = 12 * 60 * 60  # seconds the bot waits for the workers before processing what a distributed run has
+WORKER_CONCURRENCY = 1  # jobs a worker process runs at once, each on its own page of the shared profile
+SCRAPER_OUT_OF_PROCESS = True  # run the scraper in a child process so the bot stays responsive during a run
+SCRAPER_PROCESS_HEARTBEAT_INTERVAL = 30  # seconds between the child's heartbeats
+SCRAPER_PROCESS_HEARTBEAT_TIMEOUT = 10 * 60  # seconds without any message after which the child is killed
+SCRAPER_PROCESS_MESSAGE_LIMIT = 256 * 1024 * 1024  # bytes of the largest message, the result carries every product
+SCRAPER_PROCESS_STOP_TIMEOUT = 30  # seconds a stopped child gets to close its browser before it is killed
+ADAPTIVE_RATE_ENABLED = True  # when False, navigations keep the fixed DELAY_BETWEEN_* pacing
+RATE_HOST_BASE_INTERVAL = 2  # seconds between navigations to one host across all contexts
+RATE_HOST_BURST = 5
+RATE_PROXY_BASE_INTERVAL = 5
+RATE_PROXY_BURST = 2
+RATE_MIN_INTERVAL_FACTOR = 0.2  # intervals never drop below this fraction of their base
+RATE_MAX_INTERVAL_FACTOR = 10
+RATE_SPEEDUP_STEP = 0.05  # fraction of the base interval removed after each successful navigation
+RATE_BACKOFF_FACTOR = 2
+CIRCUIT_BREAKER_BLOCK_THRESHOLD = 2  # consecutive CAPTCHA, dog page or 429/503 responses that quarantine a context
+CIRCUIT_BREAKER_FAILURE_THRESHOLD = 4  # consecutive timeouts or missing selectors that quarantine a context
+CIRCUIT_BREAKER_QUARANTINE = 30 * 60  # seconds a quarantined context, HTTP session or proxy is kept out of use
+CIRCUIT_BREAKER_IDENTITY_HOLD = 5 * 60  # seconds a host or proxy is held when the quarantined profile relaunches with the same IP, e.g. without proxies
+PROXIES_ENABLED = False  # route browser contexts and HTTP fetches through the proxies in PROXIES_FILE
+PROXIES_FILE = 'proxies.txt'
+PROXY_CHECK_URL = 'https://httpbin.org/ip'  # any URL answering 200 through a working proxy
+PROXY_CHECK_TIMEOUT = 10
+PROXY_CHECK_CONCURRENCY = 20
+PROXY_REVALIDATE_INTERVAL = 10 * 60  # seconds between background re-checks of every proxy
+PROXY_MAX_CONSECUTIVE_FAILURES = 3  # failed navigations or checks before a proxy is evicted until it checks out again
+PROXY_SCORE_SMOOTHING = 0.3  # weight of the newest sample in a proxy's moving latency and success rate
+PROXY_STATS_LATENCY_SAMPLES = 500  # latest latencies per proxy kept for the percentiles of a run
+PROXY_STATS_HISTORY_RUNS = 10  # runs of stats kept per proxy in the ProxyStats collection
+PROXY_STATS_MAX_AGE = 7 * 24 * 60 * 60  # seconds after which a proxy's stored stats are ignored and it is checked again
+PROXY_STATS_MIN_REQUESTS = 20  # requests in the stored runs needed to rank a proxy without checking it
+PROXY_MIN_SUCCESS_RATE = 0.5  # proxies below this stored success rate are skipped at startup
+PROXY_MAX_CAPTCHA_RATE = 0.3  # proxies above this stored CAPTCHA rate are skipped at startup
+BROWSER_POOL_MAX_IDLE_PAGES = 2
+BROWSER_POOL_RECYCLE_AFTER = 200  # pages served before the browser profile is relaunched
+
+LOG_LEVEL = 'DEBUG'
+LOG_DETAILS_MAX_ITEMS = 20  # larger collections passed as log details are truncated
+LOG_DETAILS_MAX_CHARS = 10000
+LOG_CONSOLE_ENABLED = True
+LOG_JSON_ENABLED = False  # structured NDJSON log files, written alongside or instead of the console output
+LOG_JSON_PATH = 'logs/scraper.ndjson'
+LOG_JSON_MAX_BYTES = 50 * 1024 * 1024
+LOG_JSON_ROTATE_WHEN = None  # e.g. 'midnight' to rotate by time instead of size
+LOG_JSON_BACKUP_COUNT = 14
+LOG_JSON_COMPRESS = True
 
 # Do not change the following values
 POST_CODE = 'TQ1 3RW'
-DISCORD_MESSAGE_DELAY = 5
+DISCORD_MESSAGE_EMBED_LIMIT = 10  # Discord's limits per message
+DISCORD_MESSAGE_EMBED_SIZE_LIMIT = 6000  # characters across all embeds of a message
+DISCORD_EMBED_TITLE_LIMIT = 256
 MAX_SHOW_MORE_CLICKS = 4
 SCRAPING_URL_BATCH_SIZE = 10
 CRON_JOB_INTERVAL = 60 * 60 * 12  # 12 hours
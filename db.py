@@ -1,24 +1,44 @@
 from motor.motor_asyncio import AsyncIOMotorClient
 import os
+import re
+import time
+from pymongo import ASCENDING, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
 from dotenv import load_dotenv
 from datetime import datetime, timedelta
 
-from config import DAYS_TO_EXPIRE_OLD_PRODUCTS
+from config import DAYS_TO_EXPIRE_OLD_PRODUCTS, PROMO_CODE_CACHE_TTL, PRODUCTS_BULK_WRITE_CHUNK_SIZE, \
+    PROXY_STATS_HISTORY_RUNS, RUN_CHECKPOINT_TTL, JOB_MAX_ATTEMPTS
 from data_manager import DataManager
 from logger import Logger
 from models import ProductDetails, ProcessedProductDetails,Promotion
+from utils import canonicalize_product_url
 
 load_dotenv()
 
+INDEX_OPTIONS_CONFLICT = 85
+DUPLICATE_KEY = 11000
+# What canonicalize_product_url turns every product link with an ASIN into
+CANONICAL_PRODUCT_URL_REGEX = re.compile(r'^https://[^/]+/dp/[A-Z0-9]{10}$')
+
 client = None
 db = None
 collection = None
 products_collection = None
+promotion_collection = None
+promo_code_cache_collection = None
+proxy_stats_collection = None
+fingerprints_collection = None
+runs_collection = None
+run_items_collection = None
+jobs_collection = None
 data_manager = DataManager()
 
 
 async def connect_to_database():
-    global client, db, collection, products_collection, promotion_collection
+    global client, db, collection, products_collection, promotion_collection, promo_code_cache_collection, \
+        proxy_stats_collection, fingerprints_collection, runs_collection, run_items_collection, \
+        jobs_collection
     try:
         Logger.info('Connecting to the database')
         client = AsyncIOMotorClient(os.getenv('MONGO_URI'), serverSelectionTimeoutMS=10000)
@@ -27,10 +47,83 @@ async def connect_to_database():
         collection = db['Searches']
         products_collection = db['Products']
         promotion_collection = db['Promotions']
+        promo_code_cache_collection = db['PromoCodeCache']
+        proxy_stats_collection = db['ProxyStats']
+        fingerprints_collection = db['Fingerprints']
+        runs_collection = db['Runs']
+        run_items_collection = db['RunItems']
+        jobs_collection = db['Jobs']
         Logger.info("Successfully connected to the database")
     except Exception as e:
         raise ConnectionError(f"Failed to connect to the database: {str(e)}")
 
+    await ensure_indexes()
+    await migrate_promotion_product_urls()
+
+
+async def ensure_index(target_collection, keys: list[tuple], **options):
+    start_time = time.perf_counter()
+    try:
+        index_name = await target_collection.create_index(keys, **options)
+    except OperationFailure as error:
+        if error.code == INDEX_OPTIONS_CONFLICT and 'expireAfterSeconds' in options:
+            # The TTL was changed in config, update the existing index in place
+            await db.command('collMod', target_collection.name,
+                             index={'keyPattern': dict(keys), 'expireAfterSeconds': options['expireAfterSeconds']})
+            index_name = f"{'_'.join(f'{field}_{direction}' for field, direction in keys)} (TTL updated)"
+        else:
+            Logger.error(f"Could not create index {keys} on {target_collection.name}", error)
+            return
+
+    elapsed_ms = (time.perf_counter() - start_time) * 1000
+    Logger.info(f"Index {target_collection.name}.{index_name} ready in {elapsed_ms:.0f} ms")
+
+
+async def ensure_indexes():
+    """Create the indexes the bot queries rely on. Existing indexes are left untouched, so this is safe on every start."""
+    Logger.info('Ensuring database indexes')
+    start_time = time.perf_counter()
+
+    await ensure_index(promotion_collection, [("product_url", ASCENDING)], unique=True)
+    await ensure_index(products_collection, [("_id", ASCENDING), ("last_updated", ASCENDING)])
+    await ensure_index(products_collection, [("last_updated", ASCENDING)],
+                       expireAfterSeconds=DAYS_TO_EXPIRE_OLD_PRODUCTS * 24 * 60 * 60)
+    await ensure_index(collection, [("text", ASCENDING)])
+    await ensure_index(promo_code_cache_collection, [("cached_at", ASCENDING)], expireAfterSeconds=PROMO_CODE_CACHE_TTL)
+    await ensure_index(runs_collection, [("started_at", ASCENDING)], expireAfterSeconds=RUN_CHECKPOINT_TTL)
+    await ensure_index(run_items_collection, [("run_id", ASCENDING)])
+    await ensure_index(run_items_collection, [("saved_at", ASCENDING)], expireAfterSeconds=RUN_CHECKPOINT_TTL)
+    await ensure_index(jobs_collection, [("status", ASCENDING), ("kind", ASCENDING), ("created_at", ASCENDING)])
+    await ensure_index(jobs_collection, [("run_id", ASCENDING), ("kind", ASCENDING)])
+    await ensure_index(jobs_collection, [("created_at", ASCENDING)], expireAfterSeconds=RUN_CHECKPOINT_TTL)
+
+    Logger.info(f"Database indexes ensured in {(time.perf_counter() - start_time) * 1000:.0f} ms")
+
+
+async def migrate_promotion_product_urls():
+    """Move promotions stored under raw product links to the canonical URL they are upserted under now.
+
+    A row whose canonical URL is already taken is dropped, the newest row of a product is the one that is kept. Only
+    rows that are not canonical yet are read, so this is cheap once they have been moved.
+    """
+    cursor = promotion_collection.find({"product_url": {"$not": CANONICAL_PRODUCT_URL_REGEX}}, {"product_url": 1}) \
+        .sort("last_updated", -1)
+    migrated = 0
+    removed = 0
+    for doc in await cursor.to_list(None):
+        canonical_url = canonicalize_product_url(doc['product_url'])
+        if canonical_url == doc['product_url']:
+            continue
+        try:
+            await promotion_collection.update_one({"_id": doc['_id']}, {"$set": {"product_url": canonical_url}})
+            migrated += 1
+        except DuplicateKeyError:
+            await promotion_collection.delete_one({"_id": doc['_id']})
+            removed += 1
+
+    if migrated or removed:
+        Logger.info(f"Moved {migrated} promotions to canonical product URLs, removed {removed} duplicates")
+
 
 async def add_search(search_text):
     Logger.info(f"Adding search term: {search_text}")
@@ -56,25 +149,16 @@ async def get_all_searches():
     return searches
 
 
+def get_product_update_data(product_details: ProductDetails, current_time: datetime) -> dict:
+    return {"last_updated": current_time, **product_details.to_dict()}
+
+
 async def upsert_product(product_details: ProductDetails):
-    current_time = datetime.utcnow()
     product_id = product_details.id
 
-    update_data = {
-        "last_updated": current_time,
-        "product_image_url": product_details.product_image_url,
-        "product_title": product_details.product_title,
-        "product_url": product_details.product_url,
-        "product_asin": product_details.product_asin,
-        "product_price": product_details.product_price,
-        "product_sales": product_details.product_sales,
-        "promotion_code": product_details.promotion_code,
-        "promotion_title": product_details.promotion_title
-    }
-
     result = await products_collection.update_one(
         {"_id": product_id},
-        {"$set": update_data},
+        {"$set": get_product_update_data(product_details, datetime.utcnow())},
         upsert=True
     )
 
@@ -82,22 +166,14 @@ async def upsert_product(product_details: ProductDetails):
     return result.upserted_id is not None
 
 
-async def upsert_promotion(promotion: Promotion):
-    current_time = datetime.utcnow()
-    updated_promotion = {
-        "last_updated": current_time,
-        "promotion_code": promotion.promotion_code,
-        "promotion_title": promotion.promotion_title,
-        "promotion_url": promotion.promotion_url,
-        "product_title": promotion.product_title,
-        "product_price": promotion.product_price,
-        "product_img": promotion.product_img,
-        "product_url": promotion.product_url
-    }
+def get_promotion_update_data(promotion: Promotion, current_time: datetime) -> dict:
+    return {"last_updated": current_time, **promotion.to_dict()}
+
 
+async def upsert_promotion(promotion: Promotion):
     result = await promotion_collection.update_one(
         {"product_url": promotion.product_url},
-        {"$set": updated_promotion},
+        {"$set": get_promotion_update_data(promotion, datetime.utcnow())},
         upsert=True
     )
     return result
@@ -106,32 +182,292 @@ async def get_promotion_by_url(product_url: str):
     
     return await promotion_collection.find_one({"product_url": product_url})
 
+
+async def upsert_promotions_and_get_price_changes(promotions: list[Promotion]) -> list[tuple[Promotion, str]]:
+    """Upsert the promotions in one bulk write and return (promotion, old_price) for every price that changed."""
+    if not promotions:
+        return []
+
+    product_urls = list({promotion.product_url for promotion in promotions})
+    cursor = promotion_collection.find({"product_url": {"$in": product_urls}}, {"product_url": 1, "product_price": 1})
+    known_prices = {doc['product_url']: doc.get("product_price", "N/A") async for doc in cursor}
+
+    price_changes = []
+    latest_promotions = {}
+    for promotion in promotions:
+        if promotion.product_url in known_prices:
+            old_price = known_prices[promotion.product_url]
+            if old_price != promotion.product_price:
+                Logger.info(f"Price changed for {promotion.product_title}: {old_price} → {promotion.product_price}")
+                price_changes.append((promotion, old_price))
+        else:
+            Logger.info(f"New promotion found: {promotion.product_title}")
+
+        # A repeated product is compared with, and finally stored as, its latest occurrence
+        known_prices[promotion.product_url] = promotion.product_price
+        latest_promotions[promotion.product_url] = promotion
+
+    current_time = datetime.utcnow()
+    operations = [
+        UpdateOne({"product_url": product_url}, {"$set": get_promotion_update_data(promotion, current_time)}, upsert=True)
+        for product_url, promotion in latest_promotions.items()
+    ]
+    for attempt in range(2):
+        try:
+            await promotion_collection.bulk_write(operations, ordered=False)
+            break
+        except BulkWriteError as error:
+            # Two workers inserting the same new product race on the unique product_url index, the upsert that lost
+            # updates the row the other one inserted when it is retried
+            write_errors = error.details['writeErrors']
+            operations = [operations[write_error['index']] for write_error in write_errors
+                          if write_error['code'] == DUPLICATE_KEY]
+            if len(operations) < len(write_errors) or (operations and attempt == 1):
+                Logger.error(f"Bulk promotion upsert had {len(write_errors)} failed writes", write_errors)
+            if not operations:
+                break
+
+    Logger.info(f"Upserted {len(latest_promotions)} promotions, found {len(price_changes)} price changes")
+    return price_changes
+
+
+async def get_cached_promo_codes(asins: list[str]) -> dict[str, set[str]]:
+    # The TTL monitor only runs periodically, so expired entries are filtered out here as well
+    fresh_after = datetime.utcnow() - timedelta(seconds=PROMO_CODE_CACHE_TTL)
+    cursor = promo_code_cache_collection.find({"_id": {"$in": asins}, "cached_at": {"$gte": fresh_after}})
+    return {doc['_id']: set(doc['promo_codes']) async for doc in cursor}
+
+
+async def cache_promo_codes(asin: str, promo_codes: set[str]):
+    await promo_code_cache_collection.update_one(
+        {"_id": asin},
+        {"$set": {"promo_codes": sorted(promo_codes), "cached_at": datetime.utcnow()}},
+        upsert=True
+    )
+
+
+async def get_fingerprint_records(keys: list[str]) -> dict[str, dict]:
+    cursor = fingerprints_collection.find({"_id": {"$in": keys}})
+    return {doc['_id']: doc async for doc in cursor}
+
+
+async def save_fingerprint_records(records: dict[str, dict]):
+    if not records:
+        return
+    operations = [UpdateOne({"_id": key}, {"$set": record}, upsert=True) for key, record in records.items()]
+    await fingerprints_collection.bulk_write(operations, ordered=False)
+
+
+async def get_unfinished_run(started_after: datetime) -> dict | None:
+    return await runs_collection.find_one({"status": {"$ne": "finished"}, "started_at": {"$gte": started_after}},
+                                          sort=[("started_at", -1)])
+
+
+async def save_run(run_id: str, fields: dict):
+    await runs_collection.update_one({"_id": run_id}, {"$set": {**fields, "updated_at": datetime.utcnow()}},
+                                     upsert=True)
+
+
+async def get_run_items(run_id: str) -> dict[str, dict]:
+    """The checkpointed items of a run, by stage and item key."""
+    items = {}
+    async for doc in run_items_collection.find({"run_id": run_id}):
+        items.setdefault(doc['stage'], {})[doc['key']] = doc['value']
+    return items
+
+
+async def save_run_item(run_id: str, stage: str, key: str, value):
+    await run_items_collection.update_one(
+        {"_id": f"{run_id}:{stage}:{key}"},
+        {"$set": {"run_id": run_id, "stage": stage, "key": key, "value": value, "saved_at": datetime.utcnow()}},
+        upsert=True
+    )
+
+
+async def enqueue_jobs(run_id: str, kind: str, payloads: dict[str, dict]):
+    """Add a job per key, keys already queued for the run are left as they are so fan-out can't duplicate work."""
+    if not payloads:
+        return
+    current_time = datetime.utcnow()
+    operations = [
+        UpdateOne(
+            {"_id": f"{run_id}:{kind}:{key}"},
+            {"$setOnInsert": {"run_id": run_id, "kind": kind, "key": key, "payload": payload, "status": "pending",
+                              "attempts": 0, "created_at": current_time}},
+            upsert=True
+        )
+        for key, payload in payloads.items()
+    ]
+    await jobs_collection.bulk_write(operations, ordered=False)
+
+
+async def claim_job(kinds: list[str], worker_id: str, lease_seconds: float) -> dict | None:
+    """Lease the oldest job of the first kind that has one, taking over jobs whose lease ran out."""
+    current_time = datetime.utcnow()
+    for kind in kinds:
+        job = await jobs_collection.find_one_and_update(
+            {"kind": kind, "attempts": {"$lt": JOB_MAX_ATTEMPTS},
+             "$or": [{"status": "pending"}, {"status": "leased", "lease_expires_at": {"$lt": current_time}}]},
+            {"$set": {"status": "leased", "worker_id": worker_id,
+                      "lease_expires_at": current_time + timedelta(seconds=lease_seconds)},
+             "$inc": {"attempts": 1}},
+            sort=[("created_at", ASCENDING)],
+            return_document=ReturnDocument.AFTER
+        )
+        if job is not None:
+            return job
+    return None
+
+
+async def renew_job_lease(job_id: str, worker_id: str, lease_seconds: float) -> bool:
+    result = await jobs_collection.update_one(
+        {"_id": job_id, "status": "leased", "worker_id": worker_id},
+        {"$set": {"lease_expires_at": datetime.utcnow() + timedelta(seconds=lease_seconds)}}
+    )
+    return result.matched_count > 0
+
+
+async def complete_job(job_id: str, worker_id: str, result) -> bool:
+    """Store the result of a leased job, False when the lease was lost to another worker in the meantime."""
+    update = await jobs_collection.update_one(
+        {"_id": job_id, "status": "leased", "worker_id": worker_id},
+        {"$set": {"status": "done", "result": result, "finished_at": datetime.utcnow()}}
+    )
+    return update.matched_count > 0
+
+
+async def fail_job(job_id: str, worker_id: str, error: str):
+    """Put a failed job back in the queue, or mark it failed once it is out of attempts."""
+    job = await jobs_collection.find_one({"_id": job_id, "status": "leased", "worker_id": worker_id})
+    if job is None:
+        return
+    status = "failed" if job['attempts'] >= JOB_MAX_ATTEMPTS else "pending"
+    await jobs_collection.update_one({"_id": job_id, "worker_id": worker_id},
+                                     {"$set": {"status": status, "error": error}})
+
+
+async def fail_abandoned_jobs(run_id: str) -> int:
+    """Mark the jobs whose last lease ran out without any attempt left as failed."""
+    result = await jobs_collection.update_many(
+        {"run_id": run_id, "status": "leased", "attempts": {"$gte": JOB_MAX_ATTEMPTS},
+         "lease_expires_at": {"$lt": datetime.utcnow()}},
+        {"$set": {"status": "failed", "error": "lease expired"}}
+    )
+    return result.modified_count
+
+
+async def get_job_counts(run_id: str) -> dict[str, dict[str, int]]:
+    """Number of jobs of a run by kind and status."""
+    counts = {}
+    cursor = jobs_collection.aggregate([
+        {"$match": {"run_id": run_id}},
+        {"$group": {"_id": {"kind": "$kind", "status": "$status"}, "count": {"$sum": 1}}}
+    ])
+    async for doc in cursor:
+        counts.setdefault(doc['_id']['kind'], {})[doc['_id']['status']] = doc['count']
+    return counts
+
+
+async def get_job_results(run_id: str, kind: str) -> list:
+    cursor = jobs_collection.find({"run_id": run_id, "kind": kind, "status": "done"}, {"result": 1}) \
+        .sort("created_at", ASCENDING)
+    return [doc['result'] async for doc in cursor]
+
+
+async def get_proxy_stats(proxy_keys: list[str] = None) -> list[dict]:
+    query = {} if proxy_keys is None else {"_id": {"$in": proxy_keys}}
+    return [doc async for doc in proxy_stats_collection.find(query)]
+
+
+async def save_proxy_stats(run_id: str, stats: dict[str, dict]):
+    """Add each proxy's run to its lifetime totals and keep the last PROXY_STATS_HISTORY_RUNS runs in full."""
+    current_time = datetime.utcnow()
+    operations = [
+        UpdateOne(
+            {"_id": proxy_key},
+            {
+                "$inc": {
+                    "requests": run_stats["requests"],
+                    "successes": run_stats["successes"],
+                    "captchas": run_stats["captchas"],
+                    "bytes_transferred": run_stats["bytes_transferred"],
+                },
+                "$set": {"updated_at": current_time, "last_run_id": run_id},
+                "$push": {"runs": {"$each": [{"run_id": run_id, "finished_at": current_time, **run_stats}],
+                                   "$slice": -PROXY_STATS_HISTORY_RUNS}},
+            },
+            upsert=True
+        )
+        for proxy_key, run_stats in stats.items()
+    ]
+    await proxy_stats_collection.bulk_write(operations, ordered=False)
+    Logger.info(f"Saved stats of {len(operations)} proxies for run {run_id}")
+
+
+async def get_up_to_date_product_ids(product_ids: list[str], cutoff_date: datetime) -> set[str]:
+    up_to_date_ids = set()
+    for i in range(0, len(product_ids), PRODUCTS_BULK_WRITE_CHUNK_SIZE):
+        cursor = products_collection.find(
+            {
+                "_id": {"$in": product_ids[i:i + PRODUCTS_BULK_WRITE_CHUNK_SIZE]},
+                "last_updated": {"$gte": cutoff_date}
+            },
+            {"_id": 1}
+        )
+        up_to_date_ids.update([doc['_id'] async for doc in cursor])
+    return up_to_date_ids
+
+
+async def bulk_upsert_products(product_list: list[ProductDetails]) -> set[str]:
+    """Upsert the products in unordered chunks and return the ids of the ones that were newly inserted."""
+    current_time = datetime.utcnow()
+    inserted_ids = set()
+
+    for i in range(0, len(product_list), PRODUCTS_BULK_WRITE_CHUNK_SIZE):
+        chunk = product_list[i:i + PRODUCTS_BULK_WRITE_CHUNK_SIZE]
+        operations = [
+            UpdateOne({"_id": product.id}, {"$set": get_product_update_data(product, current_time)}, upsert=True)
+            for product in chunk
+        ]
+        try:
+            result = await products_collection.bulk_write(operations, ordered=False)
+            chunk_inserted_ids = set(result.upserted_ids.values())
+        except BulkWriteError as error:
+            Logger.error(f"Bulk upsert had {len(error.details['writeErrors'])} failed writes", error.details['writeErrors'])
+            chunk_inserted_ids = {upsert['_id'] for upsert in error.details['upserted']}
+
+        inserted_ids.update(chunk_inserted_ids)
+        Logger.info(f"Bulk upserted {len(chunk)} products ({len(chunk_inserted_ids)} new)")
+
+    return inserted_ids
+
+
 async def process_products(product_list: list[ProductDetails]) -> ProcessedProductDetails:
     cutoff_date = datetime.utcnow() - timedelta(days=DAYS_TO_EXPIRE_OLD_PRODUCTS)
     cutoff_sales = data_manager.get_monthly_sales_cutoff()
     processed_product_details = ProcessedProductDetails()
 
+    product_ids = list({product.id for product in product_list})
+    up_to_date_ids = await get_up_to_date_product_ids(product_ids, cutoff_date)
+
+    products_to_upsert = []
     for product in product_list:
-        product_id = product.id
-        doc = await products_collection.find_one(
-            {
-                "_id": product_id,
-                "last_updated": {"$gte": cutoff_date}
-            }
-        )
+        if product.id in up_to_date_ids:
+            processed_product_details.up_to_date.append(product)
+        elif product.product_sales >= cutoff_sales:
+            products_to_upsert.append(product)
+            # A repeated product would have found the document written for its first occurrence
+            up_to_date_ids.add(product.id)
+        else:
+            processed_product_details.below_threshold.append(product)
+            Logger.warn(f"Product sales below threshold: {product.id}")
 
-        if doc is None:
-            if product.product_sales >= cutoff_sales:
-                upserted = await upsert_product(product)
-                if upserted:
-                    processed_product_details.upserted.append(product)
-                else:
-                    Logger.warn(f"Failed to upsert product: {product_id}")
-            else:
-                processed_product_details.below_threshold.append(product)
-                Logger.warn(f"Product sales below threshold: {product_id}")
+    inserted_ids = await bulk_upsert_products(products_to_upsert)
+    for product in products_to_upsert:
+        if product.id in inserted_ids:
+            processed_product_details.upserted.append(product)
         else:
-            processed_product_details.up_to_date.append(product)
+            Logger.warn(f"Failed to upsert product: {product.id}")
 
     Logger.info(f"Processed {len(product_list)} products")
     Logger.info(f"Upserted {len(processed_product_details.upserted)} products")
@@ -2,29 +2,63 @@ import asyncio
 import datetime
 import discord
 
-from math import ceil
 from discord import app_commands
 from discord.ext import tasks
 
-from config import DISCORD_MESSAGE_DELAY
+from config import SCRAPER_OUT_OF_PROCESS, DISCORD_MESSAGE_EMBED_LIMIT, DISCORD_MESSAGE_EMBED_SIZE_LIMIT, DISCORD_EMBED_TITLE_LIMIT
 from data_manager import DataManager
-from db import add_search, remove_search, get_all_searches
+from db import add_search, remove_search, get_all_searches, get_proxy_stats
 
 from logger import Logger
 from models import ProductDetails, ProcessedProductDetails,Promotion
 from scraper import startScraper
+from scraper_process import ScraperProcess
 from utils import get_current_time
 
 data_manager = DataManager()
+scraper_process = ScraperProcess()
 
 
-async def send_promo_notification_to_discord(channel, processed_data: ProcessedProductDetails):
-    products = processed_data.upserted
-    total_products = len(processed_data.upserted) + len(processed_data.up_to_date) + len(processed_data.below_threshold)
-
-    Logger.info(f'Sending promo notification to Discord. Channel: {channel.id}, Total Products: {total_products}')
+def create_product_embed(product: ProductDetails) -> discord.Embed:
+    promotion_url = f'https://www.amazon.co.uk/promotion/psp/{product.promotion_code}'
 
-    content = (
+    embed = discord.Embed(
+        # Discord rejects the whole message when a title is over the limit
+        title=product.product_title[:DISCORD_EMBED_TITLE_LIMIT],
+        url=product.product_url,
+        color=discord.Color.green()
+    ).set_thumbnail(url=product.product_image_url)
+
+    embed.add_field(name="Price", value=product.product_price or 'N/A', inline=True)
+    embed.add_field(name="Sales This Month", value=f"{product.product_sales}+ this month" or 'N/A',
+                    inline=True)
+    embed.add_field(name="Promotion", value=f"[{product.promotion_title}]({promotion_url})",
+                    inline=True)
+
+    return embed
+
+
+def pack_embeds(embeds: list[discord.Embed]) -> list[list[discord.Embed]]:
+    """Split embeds into messages that stay within Discord's embed count and total embed size per message."""
+    messages = []
+    message = []
+    message_size = 0
+    for embed in embeds:
+        if message and (len(message) == DISCORD_MESSAGE_EMBED_LIMIT or
+                        message_size + len(embed) > DISCORD_MESSAGE_EMBED_SIZE_LIMIT):
+            messages.append(message)
+            message = []
+            message_size = 0
+        message.append(embed)
+        message_size += len(embed)
+    if message:
+        messages.append(message)
+    return messages
+
+
+def create_summary_content(processed_data: ProcessedProductDetails) -> str:
+    total_products = len(processed_data.upserted) + len(processed_data.up_to_date) + len(processed_data.below_threshold)
+    return (
         f"@here\n\n"
         f"We've just completed a scan for product promotions. Here's what we found:\n\n"
         f"**Summary:**\n"
@@ -35,65 +69,63 @@ async def send_promo_notification_to_discord(channel, processed_data: ProcessedP
         f"Scan completed at: **{get_current_time()}**\n\n"
     )
 
+
+async def send_notification_to_channel(channel, notification: str, content: str,
+                                      messages: list[list[discord.Embed]]):
+    """Send the content and the packed embeds to one channel, in order.
+
+    discord.py waits out the rate limit bucket of the channel's message route by itself, so no fixed delay is needed.
+    """
+    Logger.info(f'Sending {notification} to Discord. Channel: {channel.id}, Messages: {len(messages)}')
+
     await channel.send(content=content)
 
-    def create_product_embed(product: ProductDetails):
-        promotion_url = f'https://www.amazon.co.uk/promotion/psp/{product.promotion_code}'
+    for i, embeds in enumerate(messages):
+        try:
+            await channel.send(embeds=embeds)
+            Logger.info(f"{notification.capitalize()} sent successfully (Chunk {i + 1} of {len(messages)})")
+        except Exception as error:
+            Logger.error(f"Error sending {notification} (Chunk {i + 1} of {len(messages)})", error)
+
+    Logger.info(f'Finished sending {notification} to Discord. Channel: {channel.id}')
 
-        embed = discord.Embed(
-            title=product.product_title,
-            url=product.product_url,
-            color=discord.Color.green()
-        ).set_thumbnail(url=product.product_image_url)
 
-        embed.add_field(name="Price", value=product.product_price or 'N/A', inline=True)
-        embed.add_field(name="Sales This Month", value=f"{product.product_sales}+ this month" or 'N/A',
-                        inline=True)
-        embed.add_field(name="Promotion", value=f"[{product.promotion_title}]({promotion_url})",
-                        inline=True)
+async def send_notification(channels: list, notification: str, content: str, messages: list[list[discord.Embed]]):
+    """Send the same messages to every channel at the same time."""
+    results = await asyncio.gather(*(send_notification_to_channel(channel, notification, content, messages)
+                                     for channel in channels), return_exceptions=True)
+    for channel, result in zip(channels, results):
+        if isinstance(result, Exception):
+            Logger.error(f"Error sending {notification} to channel {channel.id}", result)
 
-        return embed
 
-    all_embeds = [create_product_embed(product) for product in products]
+async def send_promo_notifications(channels: list, processed_data: ProcessedProductDetails):
+    messages = pack_embeds([create_product_embed(product) for product in processed_data.upserted])
+    await send_notification(channels, 'promo notification', create_summary_content(processed_data), messages)
 
-    chunk_size = 10
-    total_chunks = ceil(len(all_embeds) / chunk_size)
 
-    for i in range(total_chunks):
-        embed_chunk = all_embeds[i * chunk_size: (i + 1) * chunk_size]
+def create_price_change_embed(promotion: Promotion, old_price: str) -> discord.Embed:
+    embed = discord.Embed(
+        title=f"Price Change Detected: {promotion.product_title}"[:DISCORD_EMBED_TITLE_LIMIT],
+        url=promotion.product_url,
+        color=discord.Color.orange()
+    )
+    embed.add_field(name="Old Price", value=old_price or "N/A", inline=True)
+    embed.add_field(name="New Price", value=promotion.product_price or "N/A", inline=True)
+    embed.add_field(name="Promotion", value=promotion.promotion_title, inline=False)
+    embed.set_thumbnail(url=promotion.product_img)
+    return embed
 
-        try:
-            await channel.send(embeds=embed_chunk)
-            Logger.info(f"Promo notification sent successfully (Chunk {i + 1} of {total_chunks})")
-        except Exception as error:
-            Logger.error(f"Error sending promo notification (Chunk {i + 1} of {total_chunks})", error)
-
-        if i < total_chunks - 1:
-            await asyncio.sleep(DISCORD_MESSAGE_DELAY)
-
-    Logger.info('Finished sending promo notification to Discord')
-
-async def send_price_change_notification(promotion: Promotion, old_price: str):
-    Logger.info(f'Sending price change notification for {promotion.product_title} to Discord')
-    channel_ids = data_manager.get_notification_channels()
-    for channel_id in channel_ids:
-        channel = client.get_channel(channel_id)
-        if channel and "price-alert" in channel.name.lower():
-            print(f"Checking channel: {channel.name}")
-            embed = discord.Embed(
-                title=f"Price Change Detected: {promotion.product_title}",
-                url=promotion.product_url,
-                color=discord.Color.orange()
-            )
-            embed.add_field(name="Old Price", value=old_price or "N/A", inline=True)
-            embed.add_field(name="New Price", value=promotion.product_price or "N/A", inline=True)
-            embed.add_field(name="Promotion", value=promotion.promotion_title, inline=False)
-            embed.set_thumbnail(url=promotion.product_img)
-
-            await channel.send(embed=embed)
-        else:
-            
-            print(f"Channel not found: {channel.name if channel else 'None'} (ID: {channel_id})")
+
+async def send_price_change_digest(channels: list, price_changes: list[tuple[Promotion, str]]):
+    """Send the price changes of a run to the price alert channels, packed into as few messages as possible."""
+    price_alert_channels = [channel for channel in channels if "price-alert" in channel.name.lower()]
+    if not price_changes or not price_alert_channels:
+        return
+
+    messages = pack_embeds([create_price_change_embed(promotion, old_price) for promotion, old_price in price_changes])
+    content = f"Found **{len(price_changes)}** price changes in the scan completed at **{get_current_time()}**"
+    await send_notification(price_alert_channels, 'price change digest', content, messages)
 
 
 async def on_command_error(interaction: discord.Interaction, error: app_commands.AppCommandError):
@@ -123,6 +155,7 @@ class AmazonSearchBot(discord.Client):
 
     async def close(self):
         self.amazon_cron.cancel()
+        await scraper_process.stop()
         await super().close()
 
     @tasks.loop(time=datetime.time(hour=1, minute=0, tzinfo=datetime.timezone.utc))
@@ -250,32 +283,75 @@ async def get_monthly_sales_cutoff(interaction: discord.Interaction):
     await interaction.response.send_message(embed=embed)
 
 
+@client.tree.command(name="ap_proxy_stats", description="Show the stored performance of every proxy")
+@app_commands.checks.has_permissions(administrator=True)
+async def proxy_stats(interaction: discord.Interaction):
+    Logger.info('Proxy stats Command invoked')
+    await interaction.response.defer()
+    stats = await get_proxy_stats()
+    stats.sort(key=lambda doc: doc['successes'] / max(doc['requests'], 1), reverse=True)
+
+    def format_latency(latency):
+        return f"{latency * 1000:.0f}" if latency is not None else '-'
+
+    lines = [f"{'Proxy':<22}{'Req':>6}{'OK%':>6}{'CAP%':>6}{'p50':>7}{'p90':>7}{'MB':>8}"]
+    for doc in stats[:25]:
+        requests = max(doc['requests'], 1)
+        last_run = doc['runs'][-1] if doc.get('runs') else {}
+        lines.append(f"{doc['_id']:<22}{doc['requests']:>6}{doc['successes'] / requests:>6.0%}"
+                     f"{doc['captchas'] / requests:>6.0%}{format_latency(last_run.get('latency_p50')):>7}"
+                     f"{format_latency(last_run.get('latency_p90')):>7}{doc['bytes_transferred'] / 1e6:>8.1f}")
+
+    table = '\n'.join(lines)
+    embed = discord.Embed(
+        title="🌐 Proxy Stats",
+        description=f"```\n{table}\n```" if stats else "No proxy stats recorded yet.",
+        color=discord.Color.blue()
+    )
+    embed.set_footer(text=f"Total proxies: {len(stats)} · latencies in ms from the last run")
+    await interaction.followup.send(embed=embed)
+    Logger.info('Proxy stats Command completed')
+
+
 @client.tree.command(name="ap_run_scraper", description="Manually run the Amazon promotion scraper")
 @app_commands.checks.has_permissions(administrator=True)
-async def run_scraper(interaction: discord.Interaction):
-    Logger.info("Manual scraper run initiated")
+async def run_scraper(interaction: discord.Interaction, force_refresh: bool = False):
+    Logger.info(f"Manual scraper run initiated (force refresh: {force_refresh})")
+    if scraper_process.is_running:
+        embed = discord.Embed(
+            title="The scraper is already running",
+            color=discord.Color.orange()
+        )
+        await interaction.response.send_message(embed=embed)
+        return
+
     embed = discord.Embed(
         title="Manually Triggered Bot",
         color=discord.Color.blue()
     )
     await interaction.response.send_message(embed=embed)
-    await run_amazon_cron()
+    await run_amazon_cron(force_refresh)
 
 
-async def run_amazon_cron():
+async def run_amazon_cron(force_refresh: bool = False):
     try:
         Logger.info("Starting daily Amazon promotion check")
 
-        processed_data = await startScraper()
-
-        channel_ids = data_manager.get_notification_channels()
+        if SCRAPER_OUT_OF_PROCESS:
+            processed_data = await scraper_process.run(force_refresh)
+        else:
+            processed_data = await startScraper(force_refresh)
 
-        for channel_id in channel_ids:
+        channels = []
+        for channel_id in data_manager.get_notification_channels():
             channel = client.get_channel(channel_id)
             if channel:
-                await send_promo_notification_to_discord(channel, processed_data)
+                channels.append(channel)
             else:
                 Logger.warn(f"Channel with ID {channel_id} not found")
+        await send_promo_notifications(channels, processed_data)
+        # Channels are looked up once, the price alert channels are picked from the same list
+        await send_price_change_digest(channels, processed_data.price_changes)
 
         Logger.info("Daily Amazon promotion check completed.")
     except Exception as e:
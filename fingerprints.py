@@ -0,0 +1,120 @@
+import hashlib
+from datetime import datetime, timedelta
+
+from config import FINGERPRINT_MAX_AGE_DAYS
+from db import get_fingerprint_records, save_fingerprint_records
+from logger import Logger
+from models import ProductDetails, Promotion
+from utils import extract_asin
+
+
+def get_ordered_asins(urls: list[str]) -> list[str]:
+    return [asin for asin in map(extract_asin, urls) if asin is not None]
+
+
+def get_fingerprint(asins: list[str]) -> str:
+    return hashlib.sha1('\n'.join(asins).encode('utf-8')).hexdigest()
+
+
+class FingerprintTracker:
+    """Compares this run's search results and promotion listings with the ones of the previous run.
+
+    Search terms whose ordered ASIN list is unchanged reuse the promo codes found last time instead of visiting their
+    products, and promotion listings only send the ASINs they did not list before to the product details stage.
+    Fingerprints are only saved once the downstream work they stand for has succeeded, and unchanged ones keep their
+    age so everything is crawled in full again after FINGERPRINT_MAX_AGE_DAYS.
+    """
+
+    def __init__(self, force_refresh: bool = False):
+        self.force_refresh = force_refresh
+        self.fresh_after = datetime.utcnow() - timedelta(days=FINGERPRINT_MAX_AGE_DAYS)
+        # Changed search terms waiting for the promo codes of their links
+        self.search_links: dict[str, list[str]] = {}
+        self.link_promo_codes: dict[str, set[str]] = {}
+        # Promo codes of the unchanged search terms, stage 3 still needs them
+        self.unchanged_promo_codes: set[str] = set()
+        # Changed promotion listings waiting for the product details of their new ASINs
+        self.promotion_listings: dict[str, tuple[list[str], dict | None]] = {}
+        self.skipped_links = 0
+        self.skipped_products = 0
+
+    async def get_stored_record(self, key: str) -> dict | None:
+        if self.force_refresh:
+            return None
+        record = (await get_fingerprint_records([key])).get(key)
+        if record is None or record['fingerprinted_at'] < self.fresh_after:
+            return None
+        return record
+
+    async def get_unchanged_search_promo_codes(self, search_term: str, links: list[str]) -> set[str] | None:
+        """The promo codes stored for the search term when its results did not change, None when they have to be
+        scraped again."""
+        asins = get_ordered_asins(links)
+        record = await self.get_stored_record(f"search:{search_term}")
+        if record is not None and record['fingerprint'] == get_fingerprint(asins):
+            Logger.info(f"Search results unchanged for '{search_term}', reusing {len(record['promo_codes'])} promo "
+                        f"codes instead of visiting {len(links)} products")
+            self.skipped_links += len(links)
+            self.unchanged_promo_codes.update(record['promo_codes'])
+            return set(record['promo_codes'])
+
+        self.search_links[search_term] = links
+        return None
+
+    def record_link_promo_codes(self, link: str, promo_codes: set[str] | None) -> None:
+        if promo_codes is not None:
+            self.link_promo_codes[link] = promo_codes
+
+    async def save_search_fingerprints(self) -> None:
+        records = {}
+        for search_term, links in self.search_links.items():
+            if not all(link in self.link_promo_codes for link in links):
+                # Some products failed, scrape the search term in full next time
+                continue
+            asins = get_ordered_asins(links)
+            promo_codes = set().union(*(self.link_promo_codes[link] for link in links))
+            records[f"search:{search_term}"] = {"fingerprint": get_fingerprint(asins), "asins": asins,
+                                                "promo_codes": sorted(promo_codes),
+                                                "fingerprinted_at": datetime.utcnow()}
+
+        await save_fingerprint_records(records)
+        Logger.info(f"Saved fingerprints of {len(records)} of {len(self.search_links)} changed search terms, "
+                    f"{self.skipped_links} product visits skipped")
+
+    async def get_new_promotions(self, promo_code: str, promotions: list[Promotion]) -> list[Promotion]:
+        """The promotions whose ASIN the promo code did not list last time, or all of them without a fingerprint."""
+        asins = get_ordered_asins([promotion.product_url for promotion in promotions])
+        record = await self.get_stored_record(f"promo:{promo_code}")
+        if record is not None and record['fingerprint'] == get_fingerprint(asins):
+            Logger.info(f"Promotion listing unchanged for promo code {promo_code}, skipping {len(promotions)} products")
+            self.skipped_products += len(promotions)
+            return []
+
+        self.promotion_listings[promo_code] = (asins, record)
+        known_asins = set(record['asins']) if record is not None else set()
+        new_promotions = [promotion for promotion in promotions
+                          if extract_asin(promotion.product_url) not in known_asins]
+        self.skipped_products += len(promotions) - len(new_promotions)
+        if known_asins:
+            Logger.info(f"Promotion listing changed for promo code {promo_code}, "
+                        f"{len(new_promotions)} of {len(promotions)} products are new")
+        return new_promotions
+
+    async def save_promotion_fingerprints(self, product_details_list: list[ProductDetails]) -> None:
+        # A product scraped under one promo code says nothing about the same ASIN under another
+        scraped_ids = {product_details.id for product_details in product_details_list}
+        records = {}
+        for promo_code, (asins, record) in self.promotion_listings.items():
+            known_asins = set(record['asins']) if record is not None else set()
+            # Products that failed stay out of the stored listing, so the next run picks them up as new
+            stored_asins = [asin for asin in asins if asin in known_asins or f"{asin}/{promo_code}" in scraped_ids]
+            records[f"promo:{promo_code}"] = {
+                "fingerprint": get_fingerprint(stored_asins),
+                "asins": stored_asins,
+                # Carried over products were last visited when the old listing was saved, keep its age
+                "fingerprinted_at": record['fingerprinted_at'] if known_asins else datetime.utcnow(),
+            }
+
+        await save_fingerprint_records(records)
+        Logger.info(f"Saved fingerprints of {len(records)} promotion listings, "
+                    f"{self.skipped_products} product details visits skipped")
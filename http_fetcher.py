@@ -0,0 +1,53 @@
+import aiohttp
+from yarl import URL
+
+from config import HTTP_FETCHER_CONNECTION_LIMIT, HTTP_FETCHER_TIMEOUT
+from logger import Logger
+
+AMAZON_URL = URL('https://www.amazon.co.uk/')
+
+
+class HttpFetcher:
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super(HttpFetcher, cls).__new__(cls)
+            cls._instance.session = None
+        return cls._instance
+
+    @property
+    def is_running(self) -> bool:
+        return self.session is not None and not self.session.closed
+
+    async def start(self, cookies: list[dict], user_agent: str) -> None:
+        """Open a keep-alive session that presents the same cookies and user agent as the browser profile."""
+        if self.is_running:
+            return
+
+        Logger.info(f"Starting HTTP fetcher with {len(cookies)} browser cookies")
+        connector = aiohttp.TCPConnector(limit=HTTP_FETCHER_CONNECTION_LIMIT, ttl_dns_cache=300)
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=HTTP_FETCHER_TIMEOUT),
+            headers={
+                'User-Agent': user_agent,
+                'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+                'Accept-Language': 'en-GB,en;q=0.9',
+            },
+        )
+        self.session.cookie_jar.update_cookies(
+            {cookie['name']: cookie['value'] for cookie in cookies if 'amazon' in cookie.get('domain', '')},
+            response_url=AMAZON_URL,
+        )
+
+    async def close(self) -> None:
+        if self.is_running:
+            Logger.info("Closing HTTP fetcher")
+            await self.session.close()
+        self.session = None
+
+    async def fetch_html(self, url: str, proxy: str = None) -> str:
+        async with self.session.get(url, proxy=proxy) as response:
+            response.raise_for_status()
+            return await response.text()
@@ -0,0 +1,183 @@
+import asyncio
+import os
+import socket
+import time
+
+from checkpoints import get_product_details_key
+from config import JOB_LEASE_SECONDS, JOB_POLL_INTERVAL, JOB_PROGRESS_INTERVAL, JOB_RUN_TIMEOUT, WORKER_CONCURRENCY
+from db import get_all_searches, upsert_promotions_and_get_price_changes, enqueue_jobs, claim_job, renew_job_lease, \
+    complete_job, fail_job, fail_abandoned_jobs, get_job_counts, get_job_results
+from logger import Logger
+from models import Promotion, ProductDetails, price_change_to_dict, price_change_from_dict
+from scraper import browser_pool, proxy_manager, price_changes, report_progress, run_with_reroute, \
+    scraping_promo_products_from_search, get_promo_codes_from_cache, scrape_promo_codes_from_link, \
+    scrape_links_from_promo_code, scrape_product_details_from_url
+from utils import get_product_key
+
+# Workers take the later stages first so a run drains instead of piling up links
+JOB_KINDS = ['product_details', 'promotions', 'promo_codes', 'search']
+OPEN_JOB_STATUSES = ('pending', 'leased')
+
+
+# Every handler queues the jobs of the next stage before returning, the job keys keep the fan-out free of duplicates
+
+
+async def handle_search_job(run_id: str, payload: dict) -> list[str]:
+    product_links = await scraping_promo_products_from_search(payload['search_term'])
+    await enqueue_jobs(run_id, 'promo_codes', {
+        get_product_key(link): {"link": link, "force_refresh": payload['force_refresh']} for link in product_links
+    })
+    return product_links
+
+
+async def handle_promo_codes_job(run_id: str, payload: dict) -> list[str]:
+    link = payload['link']
+    link_promo_codes, uncached_links = await get_promo_codes_from_cache([link], payload['force_refresh'])
+    if uncached_links:
+        async with browser_pool.page('promo_codes') as page:
+            promo_codes = await scrape_promo_codes_from_link(page, link)
+        if promo_codes is None:
+            raise RuntimeError(f"Could not scrape promo codes from link: {link}")
+    else:
+        promo_codes = link_promo_codes[link]
+
+    await enqueue_jobs(run_id, 'promotions', {promo_code: {"promo_code": promo_code} for promo_code in promo_codes})
+    return sorted(promo_codes)
+
+
+async def handle_promotions_job(run_id: str, payload: dict) -> dict:
+    promotions = await scrape_links_from_promo_code(payload['promo_code'])
+    promotion_price_changes = await upsert_promotions_and_get_price_changes(promotions)
+    await enqueue_jobs(run_id, 'product_details', {
+        get_product_details_key(promotion): {"promotion": promotion.to_dict()} for promotion in promotions
+    })
+    # The bot sends the price changes of every worker in one digest
+    return {"promotions": len(promotions),
+            "price_changes": list(map(price_change_to_dict, promotion_price_changes))}
+
+
+async def handle_product_details_job(run_id: str, payload: dict) -> dict:
+    promotion = Promotion.from_dict(payload['promotion'])
+    with Logger.context(url=promotion.product_url):
+        async with browser_pool.page('product_details') as page:
+            product_details = await run_with_reroute(page, 'product_details', scrape_product_details_from_url,
+                                                     promotion)
+    return product_details.to_dict()
+
+
+JOB_HANDLERS = {
+    'search': handle_search_job,
+    'promo_codes': handle_promo_codes_job,
+    'promotions': handle_promotions_job,
+    'product_details': handle_product_details_job,
+}
+
+
+class JobWorker:
+    """Runs jobs from the Mongo queue until stopped, any number of these can share a queue across processes and hosts.
+
+    A job is leased while it runs and the lease is renewed in the background, so the job of a worker that dies is taken
+    over by another one once the lease runs out. Failed jobs go back to the queue until JOB_MAX_ATTEMPTS.
+    """
+
+    def __init__(self, concurrency: int = WORKER_CONCURRENCY):
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.concurrency = max(concurrency, 1)
+        self.stopping = asyncio.Event()
+        self.unsaved_jobs = 0
+
+    def stop(self) -> None:
+        """Let the running jobs finish, then return from run()."""
+        Logger.info(f"Stopping worker {self.worker_id} after its running jobs")
+        self.stopping.set()
+
+    async def run(self) -> None:
+        Logger.info(f"Worker {self.worker_id} taking jobs with {self.concurrency} pages")
+        await asyncio.gather(*(self.run_slot() for _ in range(self.concurrency)))
+        Logger.info(f"Worker {self.worker_id} stopped")
+
+    async def run_slot(self) -> None:
+        while not self.stopping.is_set():
+            job = await claim_job(JOB_KINDS, self.worker_id, JOB_LEASE_SECONDS)
+            if job is not None:
+                await self.run_job(job)
+                continue
+
+            if self.unsaved_jobs:
+                # The queue ran dry, a good moment to persist what the proxies did
+                self.unsaved_jobs = 0
+                await self.save_proxy_stats()
+            try:
+                await asyncio.wait_for(self.stopping.wait(), JOB_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    async def run_job(self, job: dict) -> None:
+        lease_renewal = asyncio.create_task(self.renew_lease_periodically(job['_id']))
+        try:
+            with Logger.context(run_id=job['run_id'], stage=job['kind']):
+                Logger.info(f"Running {job['kind']} job {job['key']}, attempt {job['attempts']}")
+                try:
+                    result = await JOB_HANDLERS[job['kind']](job['run_id'], job['payload'])
+                except Exception as e:
+                    Logger.error(f"{job['kind']} job {job['key']} failed on attempt {job['attempts']}", e)
+                    await fail_job(job['_id'], self.worker_id, str(e))
+                    return
+
+                if not await complete_job(job['_id'], self.worker_id, result):
+                    Logger.warn(f"Lease of {job['kind']} job {job['key']} was taken over, dropping its result")
+        finally:
+            lease_renewal.cancel()
+            self.unsaved_jobs += 1
+
+    async def renew_lease_periodically(self, job_id: str) -> None:
+        while True:
+            await asyncio.sleep(JOB_LEASE_SECONDS / 3)
+            try:
+                if not await renew_job_lease(job_id, self.worker_id, JOB_LEASE_SECONDS):
+                    return
+            except Exception as e:
+                Logger.warn(f"Could not renew the lease of job {job_id}", e)
+
+    async def save_proxy_stats(self) -> None:
+        try:
+            await proxy_manager.save_stats(self.worker_id)
+        except Exception as e:
+            Logger.error("Error saving proxy stats", e)
+
+
+def count_open_jobs(job_counts: dict[str, dict[str, int]]) -> int:
+    return sum(count for statuses in job_counts.values()
+               for status, count in statuses.items() if status in OPEN_JOB_STATUSES)
+
+
+async def run_distributed(run_id: str, force_refresh: bool = False) -> list[ProductDetails]:
+    """Queue the search terms of a run for the workers and wait until every job it fanned out to is done or failed."""
+    search_items = await get_all_searches()
+    Logger.info(f"Queueing {len(search_items)} search terms for the workers")
+    await enqueue_jobs(run_id, 'search', {
+        search_term: {"search_term": search_term, "force_refresh": force_refresh} for search_term in search_items
+    })
+
+    started_at = time.monotonic()
+    while True:
+        abandoned_jobs = await fail_abandoned_jobs(run_id)
+        if abandoned_jobs:
+            Logger.warn(f"{abandoned_jobs} jobs ran out of attempts on an expired lease")
+
+        job_counts = await get_job_counts(run_id)
+        open_jobs = count_open_jobs(job_counts)
+        Logger.info(f"Distributed run {run_id}: {open_jobs} jobs open", job_counts)
+        report_progress('jobs', {"open_jobs": open_jobs, "job_counts": job_counts})
+        if open_jobs == 0:
+            break
+        if time.monotonic() - started_at > JOB_RUN_TIMEOUT:
+            Logger.warn(f"Distributed run {run_id} timed out with {open_jobs} jobs open, processing what is done")
+            break
+        await asyncio.sleep(JOB_PROGRESS_INTERVAL)
+
+    for result in await get_job_results(run_id, 'promotions'):
+        price_changes.extend(map(price_change_from_dict, result['price_changes']))
+    product_details_list = list(map(ProductDetails.from_dict, await get_job_results(run_id, 'product_details')))
+    Logger.info(f"Finished the distributed run. Found {len(product_details_list)} products", product_details_list)
+    return product_details_list
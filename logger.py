@@ -1,110 +1,233 @@
+import atexit
+import gzip
+import json
 import logging
-import inspect
+import logging.handlers
 import os
-from datetime import datetime
-from colorama import Fore, init
 import pprint
+import queue
+import shutil
+import sys
 import traceback
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from itertools import islice
+
+from colorama import Fore, init
+
+from config import LOG_LEVEL, LOG_DETAILS_MAX_ITEMS, LOG_DETAILS_MAX_CHARS, LOG_CONSOLE_ENABLED, LOG_JSON_ENABLED, \
+    LOG_JSON_PATH, LOG_JSON_MAX_BYTES, LOG_JSON_ROTATE_WHEN, LOG_JSON_BACKUP_COUNT, LOG_JSON_COMPRESS
 
 init(autoreset=True)
 
+# Fields such as run_id, stage and url that are attached to every record logged inside Logger.context()
+log_context: ContextVar[dict] = ContextVar('log_context', default={})
+
+LEVEL_COLORS = {
+    logging.DEBUG: Fore.CYAN,
+    logging.INFO: Fore.GREEN,
+    logging.WARNING: Fore.YELLOW,
+    logging.ERROR: Fore.RED,
+}
+
+
+def copy_containers(details):
+    """Copy the lists, tuples, sets and dicts of log details at any depth, leaving the other objects shared."""
+    if isinstance(details, dict):
+        return {key: copy_containers(value) for key, value in details.items()}
+    if type(details) in (list, tuple, set, frozenset):
+        return type(details)(map(copy_containers, details))
+    return details
+
+
+def get_details_preview(details):
+    """Snapshot log details at call time, keeping at most LOG_DETAILS_MAX_ITEMS items of a large collection.
+
+    The listener thread formats the snapshot later, the caller may be changing the original by then. Returns the
+    snapshot with the omitted count.
+    """
+    omitted_items = 0
+    if isinstance(details, (list, tuple, set, frozenset, dict)) and len(details) > LOG_DETAILS_MAX_ITEMS:
+        omitted_items = len(details) - LOG_DETAILS_MAX_ITEMS
+        items = details.items() if isinstance(details, dict) else details
+        preview = list(islice(items, LOG_DETAILS_MAX_ITEMS))
+        details = dict(preview) if isinstance(details, dict) else preview
+    return copy_containers(details), omitted_items
+
+
+def format_details(details, omitted_items: int = 0) -> str:
+    if isinstance(details, BaseException):
+        # For exceptions, include the full stack trace
+        return ''.join(traceback.format_exception(type(details), details, details.__traceback__))
+
+    formatted_details = pprint.pformat(details, indent=4)
+    if len(formatted_details) > LOG_DETAILS_MAX_CHARS:
+        formatted_details = f"{formatted_details[:LOG_DETAILS_MAX_CHARS]}... (truncated)"
+    if omitted_items:
+        formatted_details += f"\n... and {omitted_items} more items"
+    return formatted_details
+
+
+class ConsoleFormatter(logging.Formatter):
+    """Renders the coloured console line. Runs on the listener thread, so details are only formatted there."""
+
+    def format(self, record):
+        color = LEVEL_COLORS.get(record.levelno, Fore.MAGENTA)
+        timestamp = datetime.utcfromtimestamp(record.created).isoformat()
+        file_path_info = f"{record.log_file_path}:{record.lineno}"
+
+        log_message = (f"{Fore.WHITE}{timestamp:<30} {color}{record.levelname:<10} "
+                       f"{Fore.WHITE}{file_path_info:<40} : {color}{record.getMessage()}")
+
+        if record.log_details is not None:
+            details_color = Fore.RED if isinstance(record.log_details, BaseException) else Fore.LIGHTWHITE_EX
+            log_message += f"\n{details_color}{format_details(record.log_details, record.log_omitted_items)}"
+
+        return log_message
+
+
+class JsonFormatter(logging.Formatter):
+    """Renders one NDJSON line per record for the structured log sink."""
+
+    def format(self, record):
+        log_record = {
+            'timestamp': datetime.utcfromtimestamp(record.created).isoformat() + 'Z',
+            'level': record.levelname,
+            'file': f"{record.log_file_path}:{record.lineno}",
+            'message': record.getMessage(),
+            'run_id': None,
+            'stage': None,
+            'url': None,
+            **record.log_context,
+        }
+        if record.log_details is not None:
+            log_record['details'] = format_details(record.log_details, record.log_omitted_items)
+        return json.dumps(log_record, ensure_ascii=False, default=str)
+
+
+def gzip_rotator(source: str, destination: str) -> None:
+    with open(source, 'rb') as source_file, gzip.open(destination, 'wb') as destination_file:
+        shutil.copyfileobj(source_file, destination_file)
+    os.remove(source)
+
+
+def get_json_file_handler() -> logging.Handler:
+    os.makedirs(os.path.dirname(os.path.abspath(LOG_JSON_PATH)), exist_ok=True)
+    if LOG_JSON_ROTATE_WHEN:
+        handler = logging.handlers.TimedRotatingFileHandler(
+            LOG_JSON_PATH, when=LOG_JSON_ROTATE_WHEN, backupCount=LOG_JSON_BACKUP_COUNT, encoding='utf-8', utc=True)
+    else:
+        handler = logging.handlers.RotatingFileHandler(
+            LOG_JSON_PATH, maxBytes=LOG_JSON_MAX_BYTES, backupCount=LOG_JSON_BACKUP_COUNT, encoding='utf-8')
+
+    if LOG_JSON_COMPRESS:
+        handler.namer = lambda name: f"{name}.gz"
+        handler.rotator = gzip_rotator
+
+    handler.setFormatter(JsonFormatter())
+    return handler
+
+
+def get_log_handlers() -> list[logging.Handler]:
+    handlers = []
+    if LOG_CONSOLE_ENABLED:
+        console_handler = logging.StreamHandler()
+        console_handler.setFormatter(ConsoleFormatter())
+        handlers.append(console_handler)
+    if LOG_JSON_ENABLED:
+        handlers.append(get_json_file_handler())
+    return handlers
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # The default implementation formats the record on the calling thread, leave that to the listener
+        return record
+
 
 class Logger:
     __logger = logging.getLogger(__name__)
-    __logger.setLevel(logging.DEBUG)
-    __handler = logging.StreamHandler()
-    __formatter = logging.Formatter("%(message)s")
-    __handler.setFormatter(__formatter)
-    __logger.addHandler(__handler)
+    __logger.setLevel(LOG_LEVEL)
+    __logger.propagate = False
+    __queue = queue.SimpleQueue()
+    __logger.addHandler(DeferredQueueHandler(__queue))
+    # Every handler runs on the listener thread, so slow disks or terminals never block the event loop
+    __listener = logging.handlers.QueueListener(__queue, *get_log_handlers(), respect_handler_level=True)
+    __listener.start()
+    atexit.register(__listener.stop)
+
+    __project_root = None
+    __relative_paths = {}
 
     @staticmethod
     def get_project_root():
+        if Logger.__project_root is not None:
+            return Logger.__project_root
+
         current_path = os.path.abspath(os.path.dirname(__file__))
         while True:
             # Check for common project root indicators
             if os.path.exists(os.path.join(current_path, 'setup.py')) or \
                     os.path.exists(os.path.join(current_path, 'pyproject.toml')) or \
                     os.path.exists(os.path.join(current_path, '.git')):
-                return current_path
+                break
 
             parent_path = os.path.dirname(current_path)
             if parent_path == current_path:
                 # We've reached the root of the file system without finding a project root
                 # In this case, we'll return the directory of the logger file itself
-                return os.path.abspath(os.path.dirname(__file__))
+                current_path = os.path.abspath(os.path.dirname(__file__))
+                break
 
             current_path = parent_path
 
-    @staticmethod
-    def __get_log_details():
-        frame = inspect.stack()[3]
-        file_name = frame.filename
-        line_number = frame.lineno
+        Logger.__project_root = current_path
+        return current_path
 
-        project_root = Logger.get_project_root()
-        relative_file_name = os.path.relpath(file_name, project_root)
-        relative_file_name = f"./{relative_file_name.replace(os.sep, '/')}"
+    @staticmethod
+    def get_relative_path(file_name: str) -> str:
+        relative_file_name = Logger.__relative_paths.get(file_name)
+        if relative_file_name is None:
+            relative_file_name = os.path.relpath(file_name, Logger.get_project_root())
+            relative_file_name = f"./{relative_file_name.replace(os.sep, '/')}"
+            Logger.__relative_paths[file_name] = relative_file_name
+        return relative_file_name
 
-        timestamp = datetime.utcnow().isoformat()
-        pid = os.getpid()
+    @staticmethod
+    @contextmanager
+    def context(**fields):
+        """Attach fields like run_id, stage or url to everything logged inside the block."""
+        token = log_context.set({**log_context.get(), **fields})
+        try:
+            yield
+        finally:
+            log_context.reset(token)
 
-        file_path_info = f"{relative_file_name}:{line_number}"
-        return timestamp, pid, file_path_info
+    @staticmethod
+    def is_enabled_for(level) -> bool:
+        return Logger.__logger.isEnabledFor(level)
 
     @staticmethod
     def __log(message, details, level):
-        timestamp, pid, file_path_info = Logger.__get_log_details()
-
-        # Color the timestamp white
-        colored_timestamp = f"{Fore.WHITE}{timestamp:<30}"
-
-        # Color the log level according to its severity
-        if level == logging.DEBUG:
-            colored_log_level = f"{Fore.CYAN}{logging.getLevelName(level):<10}"
-            colored_message = f"{Fore.CYAN}{message}"
-        elif level == logging.INFO:
-            colored_log_level = f"{Fore.GREEN}{logging.getLevelName(level):<10}"
-            colored_message = f"{Fore.GREEN}{message}"
-        elif level == logging.WARNING:
-            colored_log_level = f"{Fore.YELLOW}{logging.getLevelName(level):<10}"
-            colored_message = f"{Fore.YELLOW}{message}"
-        elif level == logging.ERROR:
-            colored_log_level = f"{Fore.RED}{logging.getLevelName(level):<10}"
-            colored_message = f"{Fore.RED}{message}"
-        else:
-            colored_log_level = f"{Fore.MAGENTA}{logging.getLevelName(level):<10}"
-            colored_message = f"{Fore.MAGENTA}{message}"
-
-        # Color the file path white
-        colored_file_path = f"{Fore.WHITE}{file_path_info:<40}"
-
-        # Prepare the log message
-        log_message = f"{colored_timestamp} {colored_log_level} {colored_file_path} : {colored_message}"
-
-        # Pretty print details if provided
-        if details is not None:
-            if isinstance(details, Exception):
-                # For exceptions, include the full stack trace
-                error_details = ''.join(traceback.format_exception(type(details), details, details.__traceback__))
-                log_message += f"\n{Fore.RED}{error_details}"
-            else:
-                # For other types of details, use pretty printing
-                formatted_details = pprint.pformat(details, indent=4)
-                log_message += f"\n{Fore.LIGHTWHITE_EX}{formatted_details}"
-
-        # Log the message
-        if level == logging.DEBUG:
-            Logger.__logger.debug(log_message)
-        elif level == logging.INFO:
-            Logger.__logger.info(log_message)
-        elif level == logging.WARNING:
-            Logger.__logger.warning(log_message)
-        elif level == logging.ERROR:
-            Logger.__logger.error(log_message)
-        elif level == logging.CRITICAL:
-            Logger.__logger.critical(log_message)
-        else:
-            Logger.__logger.info(log_message)
+        if not Logger.__logger.isEnabledFor(level):
+            return
+
+        # 0 is this method, 1 the public level method and 2 the caller
+        frame = sys._getframe(2)
+        file_name = frame.f_code.co_filename
+        details, omitted_items = get_details_preview(details)
+
+        record = Logger.__logger.makeRecord(
+            Logger.__logger.name, level, file_name, frame.f_lineno, message, None, None,
+            extra={
+                'log_file_path': Logger.get_relative_path(file_name),
+                'log_details': details,
+                'log_omitted_items': omitted_items,
+                'log_context': log_context.get(),
+            },
+        )
+        Logger.__logger.handle(record)
 
     @staticmethod
     def debug(message, details=None):
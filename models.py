@@ -1,73 +1,75 @@
-import json
-
-
-class Promotion:
-    def __init__(self, promotion_code: str, promotion_title: str, promotion_url: str, product_title: str, product_price: str, product_img: str, product_url: str):
-        self.promotion_code = promotion_code
-        self.promotion_title = promotion_title
-        self.promotion_url = promotion_url
-        self.product_title = product_title
-        self.product_price = product_price
-        self.product_img = product_img
-        self.product_url = product_url
-
-    def to_json(self):
-        json_object = {
-            "promotion_code": self.promotion_code,
-            "promotion_title": self.promotion_title,
-            "promotion_url": self.promotion_url,
-            "product_title": self.product_title,
-            "product_price": self.product_price,
-            "product_img": self.product_img,
-            "product_url": self.product_url
-        }
-        return json.dumps(json_object, indent=2)
-
-    def __str__(self):
-        return self.to_json()
-
-    def __repr__(self):
-        return self.__str__()
-
-
-class ProductDetails:
-    def __init__(self, promotion_code: str, promotion_title: str, promotion_url: str, product_url: str,
-                 product_title: str, product_image_url: str, product_price: str, product_sales: int, product_asin: str):
-        self.id = f"{product_asin}/{promotion_code}"
-        self.promotion_code = promotion_code
-        self.promotion_title = promotion_title
-        self.promotion_url = promotion_url
-        self.product_url = product_url
-        self.product_title = product_title
-        self.product_image_url = product_image_url
-        self.product_price = product_price
-        self.product_sales = product_sales
-        self.product_asin = product_asin
-
-    def to_json(self):
-        json_object = {
-            'id': self.id,
-            "promotion_code": self.promotion_code,
-            "promotion_title": self.promotion_title,
-            "promotion_url": self.promotion_url,
-            "product_url": self.product_url,
-            "product_title": self.product_title,
-            "product_image_url": self.product_image_url,
-            "product_price": self.product_price,
-            "product_sales": self.product_sales,
-            "product_asin": self.product_asin
-        }
-        return json.dumps(json_object, indent=2)
+from dataclasses import dataclass, field
+
+
+class Model:
+    """to_dict()/from_dict() for the slotted dataclasses below, the dicts are what Mongo, checkpoints and IPC store."""
+    __slots__ = ()
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__dataclass_fields__}
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        return cls(**data)
+
+
+@dataclass(slots=True, eq=False)
+class Promotion(Model):
+    promotion_code: str
+    promotion_title: str
+    promotion_url: str
+    product_title: str
+    product_price: str
+    product_img: str
+    product_url: str
 
-    def __str__(self):
-        return self.to_json()
 
-    def __repr__(self):
-        return self.__str__()
+@dataclass(slots=True, eq=False)
+class ProductDetails(Model):
+    promotion_code: str
+    promotion_title: str
+    promotion_url: str
+    product_url: str
+    product_title: str
+    product_image_url: str
+    product_price: str
+    product_sales: int
+    product_asin: str
 
+    @property
+    def id(self) -> str:
+        return f"{self.product_asin}/{self.promotion_code}"
+
+
+def price_change_to_dict(price_change: tuple[Promotion, str]) -> dict:
+    promotion, old_price = price_change
+    return {"promotion": promotion.to_dict(), "old_price": old_price}
+
+
+def price_change_from_dict(data: dict) -> tuple[Promotion, str]:
+    return Promotion.from_dict(data['promotion']), data['old_price']
+
+
+@dataclass(slots=True, eq=False)
+class ProcessedProductDetails(Model):
+    upserted: list[ProductDetails] = field(default_factory=list)
+    up_to_date: list[ProductDetails] = field(default_factory=list)
+    below_threshold: list[ProductDetails] = field(default_factory=list)
+    price_changes: list[tuple[Promotion, str]] = field(default_factory=list)
+
+    def to_dict(self) -> dict:
+        return {
+            "upserted": [product.to_dict() for product in self.upserted],
+            "up_to_date": [product.to_dict() for product in self.up_to_date],
+            "below_threshold": [product.to_dict() for product in self.below_threshold],
+            "price_changes": list(map(price_change_to_dict, self.price_changes)),
+        }
 
-class ProcessedProductDetails:
-    def __init__(self):
-        self.upserted = []
-        self.up_to_date = []
-        self.below_threshold = []
+    @classmethod
+    def from_dict(cls, data: dict) -> 'ProcessedProductDetails':
+        return cls(
+            upserted=list(map(ProductDetails.from_dict, data['upserted'])),
+            up_to_date=list(map(ProductDetails.from_dict, data['up_to_date'])),
+            below_threshold=list(map(ProductDetails.from_dict, data['below_threshold'])),
+            price_changes=list(map(price_change_from_dict, data['price_changes'])),
+        )
@@ -0,0 +1,156 @@
+import itertools
+import time
+import weakref
+from enum import Enum
+
+from playwright.async_api import TimeoutError as PlaywrightTimeoutError
+
+from circuit_breaker import CircuitBreaker
+from logger import Logger
+from proxy_manager import ProxyManager, get_proxy_breaker_key
+from rate_controller import RateController
+
+CAPTCHA_SELECTOR = "form[action='/errors/validateCaptcha']"
+# Amazon's "Sorry! Something went wrong" error page shows pictures of the Dogs of Amazon
+DOG_PAGE_SELECTOR = "img[alt*='Dogs of Amazon'], a[href*='/ref=cs_503_link']"
+THROTTLED_STATUS_CODES = {429, 503}
+# Pacing key shared by the plain HTTP fetches, which have no browser context
+HTTP_CONTEXT_KEY = 'http'
+
+rate_controller = RateController()
+circuit_breaker = CircuitBreaker()
+proxy_manager = ProxyManager()
+# id() of a closed context can be reused by a new one, which must not inherit its pacing or quarantine
+context_keys = weakref.WeakKeyDictionary()
+context_counter = itertools.count(1)
+
+
+class NavigationOutcome(Enum):
+    OK = 'ok'
+    CAPTCHA = 'captcha'
+    DOG_PAGE = 'dog page'
+    THROTTLED = 'throttled'
+    TIMEOUT = 'timeout'
+    SELECTOR_MISSING = 'selector missing'
+    ERROR = 'error'
+    QUARANTINED = 'context quarantined'
+
+
+# Outcomes that mean Amazon is pushing back on the session, rather than a slow or unusual page
+BLOCKING_OUTCOMES = {NavigationOutcome.CAPTCHA, NavigationOutcome.DOG_PAGE, NavigationOutcome.THROTTLED}
+
+
+class NavigationError(Exception):
+    def __init__(self, url: str, outcome: NavigationOutcome):
+        super().__init__(f"Navigation to {url} failed: {outcome.value}")
+        self.url = url
+        self.outcome = outcome
+
+
+class ContextQuarantinedError(NavigationError):
+    """The browser context tripped the circuit breaker and was retired, its work has to move to a fresh page."""
+
+
+def get_context_key(page) -> str:
+    context = page.context
+    if context not in context_keys:
+        context_keys[context] = f"context-{next(context_counter)}"
+    return context_keys[context]
+
+
+async def classify_page(page, response, expected_selector: str = None,
+                        selector_timeout: int = 10000) -> NavigationOutcome:
+    if await page.locator(DOG_PAGE_SELECTOR).count() > 0:
+        return NavigationOutcome.DOG_PAGE
+    if await page.locator(CAPTCHA_SELECTOR).count() > 0:
+        return NavigationOutcome.CAPTCHA
+    if response is not None and response.status in THROTTLED_STATUS_CODES:
+        return NavigationOutcome.THROTTLED
+
+    if expected_selector is not None:
+        try:
+            await page.wait_for_selector(expected_selector, timeout=selector_timeout)
+        except PlaywrightTimeoutError:
+            return NavigationOutcome.SELECTOR_MISSING
+
+    return NavigationOutcome.OK
+
+
+def classify_error(error: Exception) -> NavigationOutcome:
+    if isinstance(error, PlaywrightTimeoutError):
+        return NavigationOutcome.TIMEOUT
+    return NavigationOutcome.ERROR
+
+
+async def get_response_size(response) -> int:
+    try:
+        sizes = await response.request.sizes()
+        return sizes['responseBodySize'] + sizes['responseHeadersSize']
+    except Exception:
+        return 0
+
+
+def record_navigation_outcome(url: str, outcome: NavigationOutcome, context_key: str, pace: str = 'links',
+                              proxy: str = None, latency: float = None, bytes_transferred: int = 0) -> bool:
+    """Feed the outcome to the rate controller, circuit breaker and proxy scores.
+
+    Returns True when the context, or the proxy it goes through, got quarantined.
+    """
+    if outcome is NavigationOutcome.OK:
+        rate_controller.record_success(url, context_key, pace, proxy)
+        circuit_breaker.record_success(context_key)
+        if proxy is not None:
+            circuit_breaker.record_success(get_proxy_breaker_key(proxy))
+            proxy_manager.record_success(proxy, latency, bytes_transferred)
+        return False
+
+    Logger.warn(f"Navigation to {url} failed: {outcome.value}{f' through proxy {proxy}' if proxy else ''}")
+    rate_controller.record_failure(url, outcome.value, context_key, pace, proxy)
+    blocked = outcome in BLOCKING_OUTCOMES
+    quarantined = circuit_breaker.record_failure(context_key, outcome.value, blocked)
+    if proxy is not None:
+        proxy_manager.record_failure(proxy, outcome is NavigationOutcome.CAPTCHA, bytes_transferred)
+        quarantined = circuit_breaker.record_failure(get_proxy_breaker_key(proxy), outcome.value, blocked) or quarantined
+    return quarantined
+
+
+async def navigate(page, url: str, pace: str = 'links', expected_selector: str = None,
+                   selector_timeout: int = 10000, **goto_options):
+    """Go to the url once the rate controller allows it, and classify how the navigation went.
+
+    Anything but a clean page raises NavigationError. When the failure trips the circuit breaker, the context is
+    retired from the browser pool and ContextQuarantinedError is raised instead, so the caller can move its work.
+    """
+    from browser_pool import BrowserPool
+
+    browser_pool = BrowserPool()
+    context_key = get_context_key(page)
+    proxy = browser_pool.get_proxy_key(page.context)
+    if circuit_breaker.is_quarantined(context_key) or \
+            (proxy is not None and circuit_breaker.is_quarantined(get_proxy_breaker_key(proxy))):
+        # The proxy may have tripped on another context or the HTTP fetcher, this one is still bound to it
+        await browser_pool.retire_context(page.context, url)
+        raise ContextQuarantinedError(url, NavigationOutcome.QUARANTINED)
+
+    await rate_controller.acquire(url, context_key, pace, proxy)
+
+    response = None
+    error = None
+    latency = None
+    try:
+        started_at = time.monotonic()
+        response = await page.goto(url, **goto_options)
+        latency = time.monotonic() - started_at
+        outcome = await classify_page(page, response, expected_selector, selector_timeout)
+    except Exception as e:
+        error = e
+        outcome = classify_error(e)
+
+    # Only proxied traffic is metered, the size lookup is an extra round trip to the browser
+    bytes_transferred = await get_response_size(response) if proxy is not None and response is not None else 0
+    if record_navigation_outcome(url, outcome, context_key, pace, proxy, latency, bytes_transferred):
+        await browser_pool.retire_context(page.context, url)
+        raise ContextQuarantinedError(url, outcome) from error
+    if outcome is not NavigationOutcome.OK:
+        raise NavigationError(url, outcome) from error
+    return response
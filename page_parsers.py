@@ -0,0 +1,164 @@
+import json
+import re
+import urllib.parse
+from html.parser import HTMLParser
+
+PROMO_CODE_HREF_PREFIX = '/promotion/psp/'
+CAPTCHA_FORM_ACTION = '/errors/validateCaptcha'
+PRODUCT_PAGE_ELEMENT_IDS = {'productTitle', 'dp', 'dp-container'}
+PRICE_REGEX = re.compile(r'([£€$]|USD|EUR)?\s*([\d.,]+)')
+
+
+class ProductPageParser(HTMLParser):
+    """Collects what stage 2 needs from the server-rendered HTML of a product page."""
+
+    def __init__(self):
+        super().__init__()
+        self.promo_codes = set()
+        self.is_captcha = False
+        self.is_product_page = False
+
+    def handle_starttag(self, tag, attrs):
+        attributes = dict(attrs)
+
+        if attributes.get('id') in PRODUCT_PAGE_ELEMENT_IDS:
+            self.is_product_page = True
+
+        if tag == 'form' and attributes.get('action') == CAPTCHA_FORM_ACTION:
+            self.is_captcha = True
+        elif tag == 'a':
+            href = attributes.get('href') or ''
+            if href.startswith(PROMO_CODE_HREF_PREFIX):
+                promo_code = href.split(PROMO_CODE_HREF_PREFIX)[1].split('?')[0]
+                if promo_code:
+                    self.promo_codes.add(promo_code)
+
+
+def parse_product_page(html: str) -> ProductPageParser:
+    parser = ProductPageParser()
+    parser.feed(html)
+    parser.close()
+    return parser
+
+
+class PromotionProductListParser(HTMLParser):
+    """Collects the product cards of a promotion page, or of the product list fragment its XHR responses return.
+
+    Mirrors the DOM scraping of stage 3: the first image, the title link and the first offscreen price of each card.
+    """
+
+    def __init__(self, base_url: str):
+        super().__init__()
+        self.base_url = base_url
+        self.products = []
+        self.card = None
+        self.card_depth = 0
+        self.title_box_depth = 0
+        self.title_link = None
+        self.price_text = None
+
+    def handle_starttag(self, tag, attrs):
+        attributes = dict(attrs)
+        classes = (attributes.get('class') or '').split()
+
+        if self.card is None:
+            if tag == 'li' and 'productGrid' in classes:
+                self.card = {'product_url': None, 'product_title': '', 'current_price': None, 'product_img': None}
+                self.card_depth = 1
+            return
+
+        if tag == 'li':
+            self.card_depth += 1
+        elif tag == 'img' and self.card['product_img'] is None:
+            self.card['product_img'] = attributes.get('src')
+        elif tag == 'div' and (self.title_box_depth or 'productTitleBox' in classes):
+            self.title_box_depth += 1
+        elif tag == 'a' and self.title_box_depth and self.card['product_url'] is None:
+            self.title_link = []
+            self.card['product_url'] = urllib.parse.urljoin(self.base_url, attributes.get('href') or '')
+        elif tag == 'span' and 'a-offscreen' in classes and self.card['current_price'] is None:
+            self.price_text = []
+
+    def handle_endtag(self, tag):
+        if self.card is None:
+            return
+
+        if tag == 'a' and self.title_link is not None:
+            self.card['product_title'] = ''.join(self.title_link).strip()
+            self.title_link = None
+        elif tag == 'span' and self.price_text is not None:
+            self.card['current_price'] = get_price(''.join(self.price_text))
+            self.price_text = None
+        elif tag == 'div' and self.title_box_depth:
+            self.title_box_depth -= 1
+        elif tag == 'li':
+            self.card_depth -= 1
+            if self.card_depth == 0:
+                self.finish_card()
+
+    def handle_data(self, data):
+        if self.title_link is not None:
+            self.title_link.append(data)
+        if self.price_text is not None:
+            self.price_text.append(data)
+
+    def finish_card(self):
+        if self.card['product_url'] is not None:
+            self.card['product_title'] = self.card['product_title'] or "Unknown Title"
+            self.card['current_price'] = self.card['current_price'] or "N/A"
+            self.products.append(self.card)
+        self.card = None
+        self.title_box_depth = 0
+
+
+class PromotionProductList:
+    def __init__(self, products: list[dict], next_page_token: str | None):
+        self.products = products
+        self.next_page_token = next_page_token
+
+
+def get_price(price_text: str) -> str | None:
+    match = PRICE_REGEX.search(price_text.strip())
+    return f"{match.group(1) or ''}{match.group(2)}" if match else None
+
+
+def parse_promotion_product_list(html: str, base_url: str) -> list[dict]:
+    parser = PromotionProductListParser(base_url)
+    parser.feed(html)
+    parser.close()
+    return parser.products
+
+
+def find_html_fragments(value) -> list[str]:
+    if isinstance(value, str):
+        return [value] if 'productGrid' in value else []
+    if isinstance(value, dict):
+        value = list(value.values())
+    if isinstance(value, list):
+        return [fragment for item in value for fragment in find_html_fragments(item)]
+    return []
+
+
+def find_pagination_token(value, token_key: str) -> str | None:
+    if isinstance(value, dict):
+        if isinstance(value.get(token_key), str) and value[token_key]:
+            return value[token_key]
+        value = list(value.values())
+    if isinstance(value, list):
+        for item in value:
+            token = find_pagination_token(item, token_key)
+            if token is not None:
+                return token
+    return None
+
+
+def parse_promotion_response(body: str, base_url: str, token_key: str) -> PromotionProductList:
+    """Read the products and next page token of a promotion page XHR response, be it JSON or an HTML fragment."""
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return PromotionProductList(parse_promotion_product_list(body, base_url), None)
+
+    products = [product for fragment in find_html_fragments(data)
+                for product in parse_promotion_product_list(fragment, base_url)]
+    return PromotionProductList(products, find_pagination_token(data, token_key))
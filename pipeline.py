@@ -0,0 +1,157 @@
+import asyncio
+
+from config import SCRAPING_URL_BATCH_SIZE, BATCH_SIZE_DELAY, PIPELINE_QUEUE_SIZE, PRODUCT_DETAILS_CONCURRENCY
+from db import get_all_searches
+from fingerprints import FingerprintTracker
+from logger import Logger
+from models import ProductDetails
+from scraper import browser_pool, report_progress, scraping_promo_products_from_search, get_promo_codes_from_cache, \
+    scrape_promo_codes_from_link, scrape_links_from_promo_code_with_retries, scrape_product_details_worker
+from utils import sleep_randomly, get_product_key
+
+# Every stage puts None on its output queue once it has no more items to produce
+
+
+async def search_stage(link_queue: asyncio.Queue, fingerprints: FingerprintTracker) -> None:
+    Logger.info('Streaming stage 1: scraping product links from searches')
+    seen_product_keys = set()
+    search_items = await get_all_searches()
+
+    for search_term in search_items:
+        try:
+            product_links = await scraping_promo_products_from_search(search_term)
+            unchanged_promo_codes = await fingerprints.get_unchanged_search_promo_codes(search_term, product_links)
+            if unchanged_promo_codes is not None:
+                # Stage 2 passes the stored promo codes straight on instead of visiting the links
+                await link_queue.put(unchanged_promo_codes)
+                continue
+
+            # Links come back canonical, one per ASIN, so only the other search terms can repeat them
+            for link in product_links:
+                product_key = get_product_key(link)
+                if product_key not in seen_product_keys:
+                    seen_product_keys.add(product_key)
+                    await link_queue.put(link)
+        except Exception:
+            # The rate controller has already backed off on the failed navigation
+            pass
+
+    await link_queue.put(None)
+    Logger.info(f'Streaming stage 1 finished. Found {len(seen_product_keys)} product links')
+    report_progress('stage_finished', {"stage": 'search', "product_links": len(seen_product_keys)})
+
+
+async def promo_code_stage(link_queue: asyncio.Queue, promo_code_queue: asyncio.Queue,
+                           fingerprints: FingerprintTracker, force_refresh: bool = False) -> None:
+    Logger.info('Streaming stage 2: scraping promo codes from product links')
+    promo_codes = set()
+    finished = False
+    batch_number = 0
+    cache_hits = 0
+    cache_misses = 0
+
+    async def emit(found_promo_codes: set[str]) -> None:
+        for promo_code in found_promo_codes:
+            if promo_code not in promo_codes:
+                promo_codes.add(promo_code)
+                await promo_code_queue.put(promo_code)
+
+    while not finished:
+        batch_number += 1
+        scraped_in_batch = 0
+        async with browser_pool.page('promo_codes') as page:
+            while scraped_in_batch < SCRAPING_URL_BATCH_SIZE:
+                link = await link_queue.get()
+                if link is None:
+                    finished = True
+                    break
+                if isinstance(link, set):
+                    await emit(link)
+                    continue
+
+                link_promo_codes, uncached_links = await get_promo_codes_from_cache([link], force_refresh)
+                if not uncached_links:
+                    cache_hits += 1
+                else:
+                    cache_misses += 1
+                    scraped_in_batch += 1
+                    link_promo_codes = {link: await scrape_promo_codes_from_link(page, link)}
+
+                fingerprints.record_link_promo_codes(link, link_promo_codes[link])
+                await emit(link_promo_codes[link] or set())
+
+        if not finished:
+            Logger.info(f"Completed promo code batch {batch_number}")
+            await sleep_randomly(BATCH_SIZE_DELAY, 3)
+
+    await promo_code_queue.put(None)
+    Logger.info(f"Promo code cache: {cache_hits} hits, {cache_misses} misses"
+                f"{' (refresh forced)' if force_refresh else ''}")
+    Logger.info(f'Streaming stage 2 finished. Found {len(promo_codes)} promo codes', promo_codes)
+    report_progress('stage_finished', {"stage": 'promo_codes', "promo_codes": len(promo_codes)})
+
+
+async def promotion_stage(promo_code_queue: asyncio.Queue, promotion_queue: asyncio.Queue,
+                          fingerprints: FingerprintTracker) -> None:
+    Logger.info('Streaming stage 3: scraping promotions from promo codes')
+    coupon_count = 0
+    promotion_count = 0
+
+    while True:
+        promo_code = await promo_code_queue.get()
+        if promo_code is None:
+            break
+
+        coupon_count += 1
+        promo_results = await scrape_links_from_promo_code_with_retries(promo_code, f"#{coupon_count}")
+        if promo_results is not None:
+            for promotion in await fingerprints.get_new_promotions(promo_code, promo_results):
+                await promotion_queue.put((promotion_count, promotion))
+                promotion_count += 1
+
+    await promotion_queue.put(None)
+    Logger.info(f'Streaming stage 3 finished. Found {promotion_count} items with promotions')
+    report_progress('stage_finished', {"stage": 'promotions', "promotions": promotion_count})
+
+
+async def product_details_stage(promotion_queue: asyncio.Queue, results: dict[int, ProductDetails]) -> None:
+    worker_count = max(PRODUCT_DETAILS_CONCURRENCY, 1)
+    Logger.info(f'Streaming stage 4: scraping product details with {worker_count} workers')
+    await asyncio.gather(*(scrape_product_details_worker(worker_id, promotion_queue, results, worker_count > 1)
+                           for worker_id in range(worker_count)))
+    Logger.info(f'Streaming stage 4 finished. Scraped {len(results)} products')
+    report_progress('stage_finished', {"stage": 'product_details', "products": len(results)})
+
+
+async def run_stage(stage: str, coroutine) -> None:
+    with Logger.context(stage=stage):
+        await coroutine
+
+
+async def run_streaming_pipeline(fingerprints: FingerprintTracker, force_refresh: bool = False) -> list[ProductDetails]:
+    """Run all four scraper stages at once, connected by bounded queues."""
+    Logger.info('Starting the streaming pipeline')
+    link_queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    promo_code_queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    promotion_queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    results: dict[int, ProductDetails] = {}
+
+    tasks = [
+        asyncio.create_task(run_stage('search', search_stage(link_queue, fingerprints))),
+        asyncio.create_task(run_stage('promo_codes', promo_code_stage(link_queue, promo_code_queue, fingerprints,
+                                                                      force_refresh))),
+        asyncio.create_task(run_stage('promotions', promotion_stage(promo_code_queue, promotion_queue, fingerprints))),
+        asyncio.create_task(run_stage('product_details', product_details_stage(promotion_queue, results))),
+    ]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        # A failed stage would leave the others waiting on their queues forever
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+    product_details_list = [results[index] for index in sorted(results)]
+    Logger.info(f'Finished the streaming pipeline. Found {len(product_details_list)} products', product_details_list)
+    return product_details_list
@@ -1,7 +1,96 @@
-import requests
-from typing import List, Tuple
-import concurrent.futures
+import asyncio
+import math
 import random
+import time
+from collections import deque
+from datetime import datetime, timedelta
+
+import aiohttp
+
+from circuit_breaker import CircuitBreaker
+from config import PROXIES_FILE, PROXY_CHECK_URL, PROXY_CHECK_TIMEOUT, PROXY_CHECK_CONCURRENCY, \
+    PROXY_REVALIDATE_INTERVAL, PROXY_MAX_CONSECUTIVE_FAILURES, PROXY_SCORE_SMOOTHING, PROXY_STATS_LATENCY_SAMPLES, \
+    PROXY_STATS_MAX_AGE, PROXY_STATS_MIN_REQUESTS, PROXY_MIN_SUCCESS_RATE, PROXY_MAX_CAPTCHA_RATE
+from db import get_proxy_stats, save_proxy_stats
+from logger import Logger
+
+
+def get_proxy_breaker_key(key: str) -> str:
+    return f"proxy:{key}"
+
+
+class Proxy:
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.latency = None
+        self.success_rate = 1.0
+        self.consecutive_failures = 0
+        self.evicted = True
+        self.checked_at = None
+        # Real traffic of the current run, persisted and reset by ProxyManager.save_stats()
+        self.latencies = deque(maxlen=PROXY_STATS_LATENCY_SAMPLES)
+        self.requests = 0
+        self.successes = 0
+        self.captchas = 0
+        self.bytes_transferred = 0
+
+    @property
+    def key(self) -> str:
+        return f"{self.host}:{self.port}"
+
+    @property
+    def server(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    @property
+    def score(self) -> float:
+        """Higher for proxies that succeed often and answer fast, used as the selection weight."""
+        return self.success_rate / max(self.latency or PROXY_CHECK_TIMEOUT, 0.05)
+
+    def record_success(self, latency: float = None) -> None:
+        self.consecutive_failures = 0
+        self.success_rate += PROXY_SCORE_SMOOTHING * (1 - self.success_rate)
+        if latency is not None:
+            self.latency = latency if self.latency is None else \
+                self.latency + PROXY_SCORE_SMOOTHING * (latency - self.latency)
+
+    def record_failure(self) -> None:
+        self.consecutive_failures += 1
+        self.success_rate -= PROXY_SCORE_SMOOTHING * self.success_rate
+
+    def record_request(self, succeeded: bool, latency: float = None, captcha: bool = False,
+                       bytes_transferred: int = 0) -> None:
+        self.requests += 1
+        self.successes += succeeded
+        self.captchas += captcha
+        self.bytes_transferred += bytes_transferred
+        if latency is not None:
+            self.latencies.append(latency)
+
+    def get_latency_percentile(self, percentile: int) -> float | None:
+        if not self.latencies:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[max(math.ceil(percentile / 100 * len(latencies)) - 1, 0)]
+
+    def get_run_stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "successes": self.successes,
+            "captchas": self.captchas,
+            "bytes_transferred": self.bytes_transferred,
+            "latency_p50": self.get_latency_percentile(50),
+            "latency_p90": self.get_latency_percentile(90),
+            "latency_p99": self.get_latency_percentile(99),
+        }
+
+    def reset_run_stats(self) -> None:
+        self.latencies.clear()
+        self.requests = 0
+        self.successes = 0
+        self.captchas = 0
+        self.bytes_transferred = 0
 
 
 class ProxyManager:
@@ -10,43 +99,154 @@ class ProxyManager:
     def __new__(cls):
         if cls._instance is None:
             cls._instance = super(ProxyManager, cls).__new__(cls)
-            cls._instance.proxies = []
+            cls._instance.proxies = {}
+            cls._instance.revalidation_task = None
         return cls._instance
 
-    def initialize_proxies(self) -> None:
-        """Initialize proxies from a text file."""
-        self.proxies = []
-        with open('proxies.txt', 'r') as file:
+    @property
+    def is_running(self) -> bool:
+        return self.revalidation_task is not None and not self.revalidation_task.done()
+
+    async def initialize_proxies(self) -> None:
+        """Load proxies from a text file, rank them from past runs, check the rest and keep re-checking in the background."""
+        if self.is_running:
+            return
+
+        self.proxies = {}
+        with open(PROXIES_FILE, 'r') as file:
             for line in file:
+                if not line.strip():
+                    continue
                 ip, port = line.strip().split(':')
-                self.proxies.append((ip, int(port)))
+                proxy = Proxy(ip, int(port))
+                self.proxies[proxy.key] = proxy
+
+        unchecked_proxies = await self.apply_stats_history()
+        if unchecked_proxies:
+            await self.filter_working_proxies(unchecked_proxies)
+        self.revalidation_task = asyncio.create_task(self.revalidate_periodically())
+
+    async def apply_stats_history(self) -> list[Proxy]:
+        """Rank proxies with enough recent history from earlier runs, returning the ones that still need a check."""
+        fresh_after = datetime.utcnow() - timedelta(seconds=PROXY_STATS_MAX_AGE)
+        history = {doc['_id']: doc for doc in await get_proxy_stats(list(self.proxies))
+                   if doc.get('updated_at') and doc['updated_at'] >= fresh_after}
+
+        unchecked_proxies = []
+        skipped = 0
+        for key, proxy in self.proxies.items():
+            runs = history.get(key, {}).get('runs', [])
+            requests = sum(run['requests'] for run in runs)
+            if requests < PROXY_STATS_MIN_REQUESTS:
+                unchecked_proxies.append(proxy)
+                continue
+
+            proxy.success_rate = sum(run['successes'] for run in runs) / requests
+            captcha_rate = sum(run['captchas'] for run in runs) / requests
+            proxy.latency = runs[-1]['latency_p50']
+            proxy.evicted = proxy.success_rate < PROXY_MIN_SUCCESS_RATE or captcha_rate > PROXY_MAX_CAPTCHA_RATE
+            skipped += proxy.evicted
+
+        Logger.info(f"Ranked {len(self.proxies) - len(unchecked_proxies)} proxies from their history, skipping "
+                    f"{skipped} known-bad ones, {len(unchecked_proxies)} proxies still need a check")
+        return unchecked_proxies
+
+    async def close(self) -> None:
+        if self.is_running:
+            self.revalidation_task.cancel()
+            try:
+                await self.revalidation_task
+            except asyncio.CancelledError:
+                pass
+        self.revalidation_task = None
 
-        self.filter_working_proxies()
+    async def check_proxy(self, session: aiohttp.ClientSession, proxy: Proxy) -> bool:
+        started_at = time.monotonic()
+        try:
+            async with session.get(PROXY_CHECK_URL, proxy=proxy.server) as response:
+                await response.read()
+                is_working = response.status == 200
+        except Exception:
+            is_working = False
 
-    def filter_working_proxies(self, timeout: int = 3) -> None:
-        """Filter out non-working proxies."""
+        proxy.checked_at = time.time()
+        if is_working:
+            proxy.record_success(time.monotonic() - started_at)
+        else:
+            proxy.record_failure()
+        return is_working
 
-        def check_proxy(proxy: Tuple[str, int]) -> bool:
+    async def filter_working_proxies(self, proxies: list[Proxy] = None) -> None:
+        """Check the proxies, every one including evicted ones by default, and only keep the working ones in rotation."""
+        proxies = list(self.proxies.values()) if proxies is None else proxies
+        Logger.info(f"Checking {len(proxies)} proxies against {PROXY_CHECK_URL}")
+        semaphore = asyncio.Semaphore(PROXY_CHECK_CONCURRENCY)
+        timeout = aiohttp.ClientTimeout(total=PROXY_CHECK_TIMEOUT)
+
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            async def check(proxy: Proxy) -> bool:
+                async with semaphore:
+                    return await self.check_proxy(session, proxy)
+
+            results = await asyncio.gather(*(check(proxy) for proxy in proxies))
+
+        for proxy, is_working in zip(proxies, results):
+            proxy.evicted = not is_working
+        Logger.info(f"{sum(results)} of {len(proxies)} proxies are working",
+                    {proxy.key: proxy.latency and round(proxy.latency, 3) for proxy in self.get_proxies()})
+
+    async def revalidate_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(PROXY_REVALIDATE_INTERVAL)
             try:
-                response = requests.get('https://httpbin.org/ip',
-                                        proxies={'http': f'http://{proxy[0]}:{proxy[1]}',
-                                                 'https': f'http://{proxy[0]}:{proxy[1]}'},
-                                        timeout=timeout)
-                return response.status_code == 200
-            except:
-                return False
+                await self.filter_working_proxies()
+            except Exception as e:
+                Logger.error("Error re-validating proxies", e)
 
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            results = list(executor.map(check_proxy, self.proxies))
+    def record_success(self, key: str, latency: float = None, bytes_transferred: int = 0) -> None:
+        proxy = self.proxies.get(key)
+        if proxy is not None:
+            proxy.record_success(latency)
+            proxy.record_request(True, latency, bytes_transferred=bytes_transferred)
 
-        self.proxies = [proxy for proxy, is_working in zip(self.proxies, results) if is_working]
+    def record_failure(self, key: str, captcha: bool = False, bytes_transferred: int = 0) -> None:
+        proxy = self.proxies.get(key)
+        if proxy is None:
+            return
 
-    def get_proxies(self) -> List[Tuple[str, int]]:
+        proxy.record_failure()
+        proxy.record_request(False, captcha=captcha, bytes_transferred=bytes_transferred)
+        if not proxy.evicted and proxy.consecutive_failures >= PROXY_MAX_CONSECUTIVE_FAILURES:
+            # The next re-validation brings it back if it starts working again
+            proxy.evicted = True
+            Logger.warn(f"Evicting proxy {key} after {proxy.consecutive_failures} consecutive failures")
+
+    async def save_stats(self, run_id: str) -> None:
+        """Persist the traffic stats of this run for every proxy that was used, then start counting afresh."""
+        stats = {proxy.key: proxy.get_run_stats() for proxy in self.proxies.values() if proxy.requests}
+        if not stats:
+            return
+
+        await save_proxy_stats(run_id, stats)
+        for proxy in self.proxies.values():
+            proxy.reset_run_stats()
+
+    def get_proxies(self) -> list[Proxy]:
         """Get the list of working proxies."""
-        return self.proxies
+        return [proxy for proxy in self.proxies.values() if not proxy.evicted]
+
+    def get_proxy(self) -> Proxy | None:
+        """Pick a working, unquarantined proxy at random weighted by its score, or None when there is none left."""
+        circuit_breaker = CircuitBreaker()
+        proxies = [proxy for proxy in self.get_proxies()
+                   if not circuit_breaker.is_quarantined(get_proxy_breaker_key(proxy.key))]
+        if not proxies:
+            return None
+        return random.choices(proxies, weights=[proxy.score for proxy in proxies])[0]
 
-    def get_random_proxy(self) -> Tuple[str, int]:
+    def get_random_proxy(self) -> Proxy:
         """Get a random proxy from the list of working proxies."""
-        if not self.proxies:
+        proxy = self.get_proxy()
+        if proxy is None:
             raise ValueError("No working proxies available.")
-        return random.choice(self.proxies)
+        return proxy
@@ -0,0 +1,123 @@
+import time
+import urllib.parse
+
+from config import ADAPTIVE_RATE_ENABLED, CAPTCHA_DETECTED_DELAY, DELAY_BETWEEN_LINKS, DELAY_BETWEEN_PAGES, \
+    DELAY_BETWEEN_SEARCHES, RATE_HOST_BASE_INTERVAL, RATE_HOST_BURST, RATE_PROXY_BASE_INTERVAL, RATE_PROXY_BURST, \
+    RATE_MIN_INTERVAL_FACTOR, RATE_MAX_INTERVAL_FACTOR, RATE_SPEEDUP_STEP, RATE_BACKOFF_FACTOR
+from logger import Logger
+from utils import sleep_randomly
+
+# Base interval between two navigations of one browser context, per kind of navigation
+PACE_INTERVALS = {
+    'links': DELAY_BETWEEN_LINKS,
+    'pages': DELAY_BETWEEN_PAGES,
+    'searches': DELAY_BETWEEN_SEARCHES,
+}
+
+
+class RateBudget:
+    """A token bucket whose refill interval is tuned with AIMD: shortened a little on success, multiplied on failure."""
+
+    def __init__(self, key: str, base_interval: float, burst: int):
+        self.key = key
+        self.interval = base_interval
+        self.min_interval = base_interval * RATE_MIN_INTERVAL_FACTOR
+        self.max_interval = base_interval * RATE_MAX_INTERVAL_FACTOR
+        self.speedup_step = base_interval * RATE_SPEEDUP_STEP
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0
+
+    def get_wait_time(self, now: float) -> float:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) / self.interval)
+        self.updated_at = now
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) * self.interval
+
+    def consume(self) -> None:
+        self.tokens -= 1
+
+    def record_success(self) -> None:
+        if not ADAPTIVE_RATE_ENABLED or self.interval <= self.min_interval:
+            return
+        old_interval = self.interval
+        self.interval = max(self.min_interval, self.interval - self.speedup_step)
+        Logger.debug(f"Rate controller speeding up {self.key}: {old_interval:.2f}s -> {self.interval:.2f}s")
+
+    def record_failure(self, reason: str) -> None:
+        if not ADAPTIVE_RATE_ENABLED:
+            # Fixed pacing, only pause this budget like the old CAPTCHA sleep did
+            self.blocked_until = time.monotonic() + CAPTCHA_DETECTED_DELAY
+            Logger.warn(f"Rate controller pausing {self.key} for {CAPTCHA_DETECTED_DELAY}s ({reason})")
+            return
+
+        old_interval = self.interval
+        self.interval = min(self.max_interval, self.interval * RATE_BACKOFF_FACTOR)
+        self.tokens = 0.0
+        Logger.warn(f"Rate controller backing off {self.key}: {old_interval:.2f}s -> {self.interval:.2f}s ({reason})")
+
+
+def get_host_budget_key(url: str) -> str:
+    return f"host:{urllib.parse.urlparse(url).hostname or 'unknown'}"
+
+
+class RateController:
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super(RateController, cls).__new__(cls)
+            cls._instance.budgets = {}
+        return cls._instance
+
+    def get_budgets(self, url: str, context_key: str = None, pace: str = 'links', proxy: str = None) -> list[RateBudget]:
+        """Every navigation draws from its host budget, its proxy budget if any, and its context's pacing budget."""
+        budget_specs = [(get_host_budget_key(url), RATE_HOST_BASE_INTERVAL, RATE_HOST_BURST)]
+        if proxy is not None:
+            budget_specs.append((f"proxy:{proxy}", RATE_PROXY_BASE_INTERVAL, RATE_PROXY_BURST))
+        if context_key is not None:
+            budget_specs.append((f"context:{context_key}:{pace}", PACE_INTERVALS[pace], 1))
+
+        return [self.get_budget(key, base_interval, burst) for key, base_interval, burst in budget_specs]
+
+    def get_budget(self, key: str, base_interval: float, burst: int) -> RateBudget:
+        if key not in self.budgets:
+            self.budgets[key] = RateBudget(key, base_interval, burst)
+        return self.budgets[key]
+
+    async def acquire(self, url: str, context_key: str = None, pace: str = 'links', proxy: str = None) -> None:
+        """Wait until every budget of the navigation has a token, then take one from each."""
+        budgets = self.get_budgets(url, context_key, pace, proxy)
+        while True:
+            now = time.monotonic()
+            wait_time = max(budget.get_wait_time(now) for budget in budgets)
+            if wait_time <= 0:
+                for budget in budgets:
+                    budget.consume()
+                return
+
+            limiting_budget = max(budgets, key=lambda budget: budget.get_wait_time(now))
+            await sleep_randomly(wait_time, min(1, wait_time * 0.2), f'Rate limited by {limiting_budget.key}')
+
+    def pause(self, seconds: float, reason: str, url: str = None, proxy: str = None) -> None:
+        """Hold every navigation through the proxy, or to the url's host when it connects directly."""
+        if proxy is not None:
+            budget = self.get_budget(f"proxy:{proxy}", RATE_PROXY_BASE_INTERVAL, RATE_PROXY_BURST)
+        elif url is not None:
+            budget = self.get_budget(get_host_budget_key(url), RATE_HOST_BASE_INTERVAL, RATE_HOST_BURST)
+        else:
+            return
+
+        budget.blocked_until = max(budget.blocked_until, time.monotonic() + seconds)
+        Logger.warn(f"Rate controller pausing {budget.key} for {seconds}s ({reason})")
+
+    def record_success(self, url: str, context_key: str = None, pace: str = 'links', proxy: str = None) -> None:
+        for budget in self.get_budgets(url, context_key, pace, proxy):
+            budget.record_success()
+
+    def record_failure(self, url: str, reason: str, context_key: str = None, pace: str = 'links',
+                       proxy: str = None) -> None:
+        for budget in self.get_budgets(url, context_key, pace, proxy):
+            budget.record_failure(reason)
@@ -0,0 +1,40 @@
+import re
+
+from config import RESOURCE_BLOCKING_ENABLED, BLOCKED_RESOURCE_TYPES, BLOCKED_URL_PATTERNS, \
+    STAGE_ALLOWED_RESOURCE_TYPES
+from logger import Logger
+
+blocked_url_regex = re.compile('|'.join(BLOCKED_URL_PATTERNS)) if BLOCKED_URL_PATTERNS else None
+
+
+def get_blocked_resource_types(stage: str = None) -> set[str]:
+    allowed_resource_types = STAGE_ALLOWED_RESOURCE_TYPES.get(stage, [])
+    return set(BLOCKED_RESOURCE_TYPES) - set(allowed_resource_types)
+
+
+def should_block(resource_type: str, url: str, blocked_resource_types: set[str]) -> bool:
+    if resource_type in blocked_resource_types:
+        return True
+    return blocked_url_regex is not None and blocked_url_regex.search(url) is not None
+
+
+async def apply_resource_blocking(page, stage: str = None) -> None:
+    """Route every request of the page through the blocker, replacing the rules of the previous stage."""
+    if not RESOURCE_BLOCKING_ENABLED:
+        return
+
+    blocked_resource_types = get_blocked_resource_types(stage)
+
+    async def handle_route(route):
+        request = route.request
+        try:
+            if should_block(request.resource_type, request.url, blocked_resource_types):
+                await route.abort()
+            else:
+                await route.continue_()
+        except Exception as e:
+            # The page may have navigated away or closed while the request was in flight
+            Logger.debug(f"Could not handle route for {request.url}: {e}")
+
+    await page.unroute_all(behavior='ignoreErrors')
+    await page.route('**/*', handle_route)
@@ -1,32 +1,72 @@
+import asyncio
 import time
 import urllib.parse
 import re
-from playwright.async_api import async_playwright
+from collections import deque
 
-from config import DELAY_BETWEEN_SEARCHES, DELAY_BETWEEN_PAGES, MAX_PAGES_TO_SCRAPE, DELAY_BETWEEN_LINKS, POST_CODE, \
+from config import MAX_PAGES_TO_SCRAPE, DELAY_BETWEEN_LINKS, POST_CODE, \
     SCRAPING_URL_BATCH_SIZE, BATCH_SIZE_DELAY, DELAY_BETWEEN_STEPS, \
-    MAX_SHOW_MORE_CLICKS, LIMITING_RESULTS, CAPTCHA_DETECTED_DELAY
-from db import get_all_searches, connect_to_database, process_products,get_promotion_by_url, upsert_promotion
+    MAX_SHOW_MORE_CLICKS, LIMITING_RESULTS, PRODUCT_DETAILS_CONCURRENCY, \
+    SCRAPER_EXECUTION_MODE, PROMO_CODE_FETCHER, PROXIES_ENABLED, PROMO_PAGE_SCRAPE_MODE, \
+    PROMO_PAGE_RESPONSE_URL_PATTERN, PROMO_PAGE_RESPONSE_TIMEOUT, PROMO_PAGE_PAGINATION_KEY, \
+    PROMO_PAGE_MAX_RESPONSES, PROMO_PAGE_CAPTURE_MAX_FAILURES, PROMO_SEARCH_CONCURRENCY
+from browser_pool import BrowserPool
+from checkpoints import RunCheckpoint
+from fingerprints import FingerprintTracker
+from db import get_all_searches, connect_to_database, process_products, \
+    upsert_promotions_and_get_price_changes, get_cached_promo_codes, cache_promo_codes
+from http_fetcher import HttpFetcher
 from logger import Logger
 from models import ProductDetails, Promotion, ProcessedProductDetails
-from utils import sleep_randomly, get_browser
+from playwright.async_api import TimeoutError as PlaywrightTimeoutError
+
+from navigation import navigate, circuit_breaker, record_navigation_outcome, NavigationOutcome, \
+    ContextQuarantinedError, HTTP_CONTEXT_KEY, THROTTLED_STATUS_CODES, rate_controller
+from page_parsers import parse_product_page, parse_promotion_response
+from proxy_manager import ProxyManager, get_proxy_breaker_key
+from utils import sleep_randomly, extract_asin, set_query_parameter, canonicalize_product_url, get_product_key, \
+    get_unique_product_urls
+
+browser_pool = BrowserPool()
+http_fetcher = HttpFetcher()
+proxy_manager = ProxyManager()
+run_checkpoint = RunCheckpoint()
+# Promotion searches whose product list responses could not be captured this run, see scrape_promotion_search()
+promo_page_capture_failures = 0
+# Price changes of the run as (promotion, old price), sent as a digest once scraping is over
+price_changes: list[tuple[Promotion, str]] = []
+# Called with (event, details) as a run moves through its stages, scraper_process.py forwards them to the bot
+progress_listener = None
+
+
+def report_progress(event: str, details: dict = None) -> None:
+    if progress_listener is not None:
+        progress_listener(event, details or {})
+
+
+async def run_with_reroute(page, stage: str, scrape, *args):
+    """Run scrape(page, *args), moving it once to a fresh pool page when the page's context gets quarantined."""
+    try:
+        return await scrape(page, *args)
+    except ContextQuarantinedError as e:
+        Logger.warn(f"Rerouting to a fresh page: {e}")
+        async with browser_pool.page(stage) as fresh_page:
+            return await scrape(fresh_page, *args)
 
 
 async def setup_amazon_uk():
-    async with async_playwright() as p:
+    async with browser_pool.page('setup') as page:
         Logger.info("Setting up Amazon UK")
 
-        browser, page = await get_browser(p)
-
         # Navigate to Amazon UK
-        await page.goto('https://www.amazon.co.uk')
+        await navigate(page, 'https://www.amazon.co.uk', 'pages')
 
         # Wait for and accept cookies
         try:
             accept_cookies_button = page.locator('#sp-cc-accept')
             await accept_cookies_button.click(timeout=5000)
             Logger.info("Cookies accepted")
-        except:
+        except Exception:
             Logger.warn(f"Could not find or click cookie accept button")
 
         await page.click('#glow-ingress-block')
@@ -52,71 +92,80 @@ async def setup_amazon_uk():
 
 
 async def scraping_promo_products_from_search(search_term: str) -> list[str]:
-    async with async_playwright() as p:
-        Logger.info(f"Scraping promo products from Search = {search_term}")
-        browser, page = await get_browser(p)
+    product_links = run_checkpoint.get_search_links(search_term)
+    if product_links is not None:
+        Logger.info(f"Restored {len(product_links)} product links of Search = '{search_term}' from the checkpoint")
+        return product_links
 
-        all_product_links = []
-        try:
-            for page_num in range(1, MAX_PAGES_TO_SCRAPE + 1):
-                Logger.info(f"Scraping page {page_num} for Search = '{search_term}'")
-
-                encoded_search_term = urllib.parse.quote(search_term)
-                await page.goto(f"https://www.amazon.co.uk/s?k={encoded_search_term}&page={page_num}")
-                await page.wait_for_load_state('load', timeout=50000)
-
-                # Check for CAPTCHA before moving forward
-                if await page.locator("form[action='/errors/validateCaptcha']").is_visible(timeout=3000):
-                    Logger.warning(f"CAPTCHA page detected for term '{search_term}', skipping.")
-                    return []
-                # Wait for the results to load
-                await page.wait_for_selector('.s-main-slot', timeout=60000)
-
-                # Extract product links only for products with promotions
-                product_links = await page.eval_on_selector_all(
-                    'div.s-result-item div.a-section a.a-link-normal.s-no-outline',
-                    "elements => elements.map(el => el.href)"
-                )
-                all_product_links.extend(product_links)
-                Logger.info(
-                    f"Scraped page {page_num} for Search = '{search_term}'. Found {len(product_links)} product links")
+    async with browser_pool.page('search') as page:
+        product_links = await run_with_reroute(page, 'search', scrape_promo_products_from_search_page, search_term)
+    await run_checkpoint.save_search_links(search_term, product_links)
+    return product_links
 
-                try:
-                    await page.locator(
-                        ".s-pagination-item.s-pagination-next.s-pagination-button.s-pagination-separator").wait_for(
-                        timeout=5000)
-                except:
-                    Logger.info(f"No more pages found for Search = '{search_term}'")
-                    break
 
-                await sleep_randomly(DELAY_BETWEEN_PAGES)
-        except Exception as e:
-            Logger.error(f"Error scraping search term: {search_term}", e)
-            raise e
+async def scrape_promo_products_from_search_page(page, search_term: str) -> list[str]:
+    Logger.info(f"Scraping promo products from Search = {search_term}")
+
+    all_product_links = []
+    try:
+        for page_num in range(1, MAX_PAGES_TO_SCRAPE + 1):
+            Logger.info(f"Scraping page {page_num} for Search = '{search_term}'")
+
+            encoded_search_term = urllib.parse.quote(search_term)
+            # The first page of a search is paced like a new search, the rest like pagination
+            # Results that never load count against the context like a CAPTCHA, only more leniently
+            await navigate(page, f"https://www.amazon.co.uk/s?k={encoded_search_term}&page={page_num}",
+                           'searches' if page_num == 1 else 'pages',
+                           expected_selector='.s-main-slot', selector_timeout=60000)
+            await page.wait_for_load_state('load', timeout=50000)
+
+            # Extract product links only for products with promotions
+            product_links = await page.eval_on_selector_all(
+                'div.s-result-item div.a-section a.a-link-normal.s-no-outline',
+                "elements => elements.map(el => el.href)"
+            )
+            all_product_links.extend(product_links)
+            Logger.info(
+                f"Scraped page {page_num} for Search = '{search_term}'. Found {len(product_links)} product links")
+
+            try:
+                await page.locator(
+                    ".s-pagination-item.s-pagination-next.s-pagination-button.s-pagination-separator").wait_for(
+                    timeout=5000)
+            except Exception:
+                Logger.info(f"No more pages found for Search = '{search_term}'")
+                break
+    except Exception as e:
+        Logger.error(f"Error scraping search term: {search_term}", e)
+        raise e
 
-        all_product_links = list(set(all_product_links))
-        all_product_links = all_product_links[:LIMITING_RESULTS]
+    # Keep the result order, it is what the search term's fingerprint is made of and what the limit cuts
+    all_product_links = get_unique_product_urls(all_product_links)
+    all_product_links = all_product_links[:LIMITING_RESULTS]
 
-        Logger.info(
-            f"Finished scraping promo products from Search = {search_term}. Found {len(all_product_links)} product links")
-        return all_product_links
+    Logger.info(
+        f"Finished scraping promo products from Search = {search_term}. Found {len(all_product_links)} product links")
+    return all_product_links
 
 
-async def scraping_promo_products_from_searches() -> list[str]:
+async def scraping_promo_products_from_searches(fingerprints: FingerprintTracker = None) -> list[str]:
+    """Collect the product links of every search term, leaving out the terms whose results did not change."""
     Logger.info('Started Scraping all promo products from searches')
     all_product_links = []
     search_items = await get_all_searches()
 
-    
-
     for search_term in search_items:
         try:
-            all_product_links.extend(await scraping_promo_products_from_search(search_term))
-            await sleep_randomly(DELAY_BETWEEN_SEARCHES)
-        except:
-            await sleep_randomly(CAPTCHA_DETECTED_DELAY, 5)
-
-    all_product_links = list(set(all_product_links))
+            product_links = await scraping_promo_products_from_search(search_term)
+            if fingerprints is not None and \
+                    await fingerprints.get_unchanged_search_promo_codes(search_term, product_links) is not None:
+                continue
+            all_product_links.extend(product_links)
+        except Exception:
+            # The rate controller has already backed off on the failed navigation
+            pass
+
+    all_product_links = get_unique_product_urls(all_product_links)
     Logger.info(f'Finished Scraping all promo products from searches. Found {len(all_product_links)} product links')
     return all_product_links
 
@@ -137,10 +186,10 @@ def check_promo_regex(text):
     return False
 
 
-async def scrape_promo_codes_from_product_url(page, link: str) -> set[str]:
+async def scrape_promo_codes_from_product_url(page, link: str) -> set[str] | None:
     Logger.info(f"Scraping promo codes from link: {link}")
     try:
-        await page.goto(link)
+        await navigate(page, link, 'links')
         promo_codes = set()
         promo_elements = await page.query_selector_all('a[href^="/promotion/psp/"]')
         for promo_element in promo_elements:
@@ -154,25 +203,127 @@ async def scrape_promo_codes_from_product_url(page, link: str) -> set[str]:
 
         Logger.info(f"Finished Scraping promo codes from link: {link}")
         return promo_codes
+    except ContextQuarantinedError:
+        raise
     except Exception as e:
         Logger.error(f"Error scraping product details: {link}", e)
 
-    return set()
+    return None
+
+
+async def scrape_promo_codes_from_product_url_over_http(link: str) -> set[str] | None:
+    """Find promo codes in the server-rendered HTML, returning None when the browser has to be used instead."""
+    if circuit_breaker.is_quarantined(HTTP_CONTEXT_KEY):
+        return None
+
+    proxy = browser_pool.pick_proxy()
+    proxy_key = proxy and proxy.key
+    Logger.info(f"Scraping promo codes over HTTP from link: {link}")
+    await rate_controller.acquire(link, HTTP_CONTEXT_KEY, 'links', proxy_key)
+    latency = None
+    bytes_transferred = 0
+    try:
+        if not http_fetcher.is_running:
+            await http_fetcher.start(await browser_pool.get_cookies(), browser_pool.user_agent)
+        started_at = time.monotonic()
+        html = await http_fetcher.fetch_html(link, proxy and proxy.server)
+        latency = time.monotonic() - started_at
+        bytes_transferred = len(html.encode('utf-8')) if proxy else 0
+        product_page = parse_product_page(html)
+        if product_page.is_captcha:
+            outcome = NavigationOutcome.CAPTCHA
+        elif not product_page.is_product_page:
+            outcome = NavigationOutcome.SELECTOR_MISSING
+        else:
+            outcome = NavigationOutcome.OK
+    except Exception as e:
+        Logger.warn(f"HTTP fetch failed for link: {link}", e)
+        product_page = None
+        if isinstance(e, asyncio.TimeoutError):
+            outcome = NavigationOutcome.TIMEOUT
+        elif getattr(e, 'status', None) in THROTTLED_STATUS_CODES:
+            outcome = NavigationOutcome.THROTTLED
+        else:
+            outcome = NavigationOutcome.ERROR
+
+    if record_navigation_outcome(link, outcome, HTTP_CONTEXT_KEY, 'links', proxy_key, latency, bytes_transferred):
+        # Drop the session and its cookies, the browser handles every link until the quarantine is over
+        await http_fetcher.close()
+        if proxy_key is not None and circuit_breaker.is_quarantined(get_proxy_breaker_key(proxy_key)):
+            await browser_pool.retire_proxy_contexts(proxy_key)
+    if outcome is not NavigationOutcome.OK:
+        Logger.warn(f"Could not scrape link over HTTP ({outcome.value}): {link}, falling back to the browser")
+        return None
+
+    for promo_code in product_page.promo_codes:
+        Logger.info(f"Found promo code: {promo_code}")
+    Logger.info(f"Finished Scraping promo codes over HTTP from link: {link}")
+    return product_page.promo_codes
+
+
+async def scrape_promo_codes_from_link(page, link: str) -> set[str] | None:
+    with Logger.context(url=link):
+        promo_codes = None
+        if PROMO_CODE_FETCHER == 'http':
+            promo_codes = await scrape_promo_codes_from_product_url_over_http(link)
+        if promo_codes is None:
+            promo_codes = await run_with_reroute(page, 'promo_codes', scrape_promo_codes_from_product_url, link)
+
+        if promo_codes is not None:
+            await run_checkpoint.save_promo_codes(link, promo_codes)
+            asin = extract_asin(link)
+            if asin is not None:
+                await cache_promo_codes(asin, promo_codes)
+        return promo_codes
 
 
-async def scrape_promo_codes_from_urls_in_batch(product_links: list[str]) -> set[str]:
+async def get_promo_codes_from_cache(product_links: list[str],
+                                     force_refresh: bool = False) -> tuple[dict[str, set[str]], list[str]]:
+    """Split the links into the promo codes already found for them, by link, and the links that still need a visit.
+
+    Promo codes found earlier in the same run are reused even when a refresh is forced.
+    """
+    cached_promo_codes = {}
+    if not force_refresh:
+        asins = [asin for asin in map(extract_asin, product_links) if asin is not None]
+        cached_promo_codes = await get_cached_promo_codes(asins)
+
+    link_promo_codes = {}
+    uncached_links = []
+    for link in product_links:
+        promo_codes = run_checkpoint.get_promo_codes(link)
+        if promo_codes is None:
+            promo_codes = cached_promo_codes.get(extract_asin(link))
+        if promo_codes is not None:
+            link_promo_codes[link] = promo_codes
+        else:
+            uncached_links.append(link)
+    return link_promo_codes, uncached_links
+
+
+async def scrape_promo_codes_from_urls_in_batch(product_links: list[str], force_refresh: bool = False,
+                                                fingerprints: FingerprintTracker = None) -> set[str]:
     Logger.info(f"Scraping promo codes from urls in batch")
-    promo_codes = set()
+    link_promo_codes, uncached_links = await get_promo_codes_from_cache(product_links, force_refresh)
+    promo_codes = set().union(*link_promo_codes.values())
+    if fingerprints is not None:
+        for link, cached_promo_codes in link_promo_codes.items():
+            fingerprints.record_link_promo_codes(link, cached_promo_codes)
+    Logger.info(f"Promo code cache: {len(product_links) - len(uncached_links)} hits, {len(uncached_links)} misses"
+                f"{' (refresh forced)' if force_refresh else ''}")
+    product_links = uncached_links
+
     total_batches = (len(product_links) - 1) // SCRAPING_URL_BATCH_SIZE + 1
     for i in range(0, len(product_links), SCRAPING_URL_BATCH_SIZE):
         Logger.info(f"Starting batch {i // SCRAPING_URL_BATCH_SIZE + 1} of {total_batches}")
         batch = product_links[i:i + SCRAPING_URL_BATCH_SIZE]
 
-        async with async_playwright() as p:
-            browser, page = await get_browser(p)
+        async with browser_pool.page('promo_codes') as page:
             for link in batch:
-                promo_codes.update(await scrape_promo_codes_from_product_url(page, link))
-                await sleep_randomly(DELAY_BETWEEN_LINKS)
+                link_promo_codes = await scrape_promo_codes_from_link(page, link)
+                promo_codes.update(link_promo_codes or set())
+                if fingerprints is not None:
+                    fingerprints.record_link_promo_codes(link, link_promo_codes)
 
         Logger.info(f"Completed batch {i // SCRAPING_URL_BATCH_SIZE + 1} of {total_batches}")
         await sleep_randomly(BATCH_SIZE_DELAY, 3)
@@ -181,15 +332,204 @@ async def scrape_promo_codes_from_urls_in_batch(product_links: list[str]) -> set
     return promo_codes
 
 
+async def scrape_promotion_search_from_dom(page, search: str) -> list[dict]:
+    # Input search term
+    await page.fill('#keywordSearchInputText', search)
+    await page.click('#keywordSearchBtn', timeout=60000)
+    await sleep_randomly(7, 1, 'Waiting for search results')
+    for index in range(MAX_SHOW_MORE_CLICKS):
+        try:
+            show_more_button = await page.query_selector('#showMore.showMoreBtn')
+            if show_more_button:
+                await show_more_button.scroll_into_view_if_needed(timeout=10000)
+                await show_more_button.click(timeout=10000)
+                Logger.info('Clicked "Show More" button')
+                await sleep_randomly(7, 1, 'Waiting for more results')
+            else:
+                raise Exception("Show More button not found")
+        except Exception:
+            Logger.error(f"Error clicking 'Show More' button")
+            break
+
+    return await page.evaluate('''
+        () => {
+            const productCards = Array.from(document.querySelectorAll('#productInfoList > li.productGrid'));
+            return productCards.map(card => {
+                const imageElement = card.querySelector('img');
+                const titleElement = card.querySelector('div.productTitleBox a');
+                let priceElement = card.querySelector('.a-offscreen') ||
+                   card.querySelector('#corePriceDisplay_desktop_feature_div .reinventPricePriceToPayMargin') ||
+                   card.querySelector('.reinventPricePriceToPay');
+
+                // Additional fallbacks (from full page if card-based selector fails)
+                if (!priceElement) {
+                    priceElement = document.querySelector('#priceblock_ourprice') ||
+                                document.querySelector('.a-price .a-offscreen');
+                }
+
+                const priceText = priceElement ? priceElement.textContent.trim() : "N/A";
+                const match = priceText.match(/([£€$]|USD|EUR)?\\s*([\\d.,]+)/);
+                const currency = match?.[1] || "";
+                const amount = match?.[2] || "";
+
+                    
+                return {
+                    product_url: titleElement ? titleElement.href : null,
+                    product_title: titleElement ? titleElement.textContent.trim() : "Unknown Title",
+                    current_price: match ? `${currency}${amount}` : "N/A",
+                    product_img: imageElement ? imageElement.src : null
+                };
+            }).filter(p => p.product_url !== null);
+        }
+    ''')
+
+
+def is_promotion_product_list_response(response) -> bool:
+    return response.request.resource_type in ('xhr', 'fetch') and \
+        re.search(PROMO_PAGE_RESPONSE_URL_PATTERN, response.url) is not None
+
+
+async def wait_for_product_list_response(page, action):
+    """Run the action and return the product list response it triggers, raising a timeout error when none arrives."""
+    async with page.expect_response(is_promotion_product_list_response,
+                                    timeout=PROMO_PAGE_RESPONSE_TIMEOUT * 1000) as response_info:
+        await action()
+    return await response_info.value
+
+
+async def fetch_next_product_list_page(page, request, token: str):
+    """Replay the product list request with the pagination token of the previous response, sharing the page cookies."""
+    url = set_query_parameter(request.url, PROMO_PAGE_PAGINATION_KEY, token)
+    return await page.request.fetch(url, method=request.method, headers=request.headers, data=request.post_data)
+
+
+async def has_more_promotion_results(page, product_count: int) -> bool:
+    try:
+        # Let the page render the products of the last response before looking for its Show More button
+        await page.wait_for_function(
+            "count => document.querySelectorAll('#productInfoList > li.productGrid').length >= count",
+            arg=product_count, timeout=5000)
+    except PlaywrightTimeoutError:
+        pass
+    return await page.locator('#showMore.showMoreBtn').is_visible()
+
+
+async def scrape_promotion_search_from_network(page, search: str) -> list[dict] | None:
+    """Read the search results of the promotion page from its product list responses as soon as they arrive.
+
+    Follows the pagination token of each response, or clicks Show More when the responses carry none. Returns None
+    when no response could be captured or understood, so the caller can fall back to scraping the DOM.
+    """
+    async def search_products():
+        await page.fill('#keywordSearchInputText', search)
+        await page.click('#keywordSearchBtn', timeout=60000)
+
+    try:
+        response = await wait_for_product_list_response(page, search_products)
+    except PlaywrightTimeoutError:
+        Logger.warn(f"No product list response captured for search '{search}'")
+        return None
+
+    request = response.request
+    product_data_list = []
+    seen_tokens = set()
+    for _ in range(PROMO_PAGE_MAX_RESPONSES):
+        if not response.ok:
+            Logger.warn(f"Product list response for search '{search}' returned HTTP {response.status}")
+            return product_data_list or None
+
+        product_list = parse_promotion_response(await response.text(), response.url, PROMO_PAGE_PAGINATION_KEY)
+        product_data_list.extend(product_list.products)
+        Logger.debug(f"Captured {len(product_list.products)} products for search '{search}'")
+
+        token = product_list.next_page_token
+        if token is not None and token not in seen_tokens:
+            seen_tokens.add(token)
+            response = await fetch_next_product_list_page(page, request, token)
+            continue
+        if seen_tokens:
+            # The tokens fetched every page already, the DOM never rendered them and its Show More would repeat them
+            break
+
+        if not await has_more_promotion_results(page, len(product_data_list)):
+            break
+        try:
+            response = await wait_for_product_list_response(
+                page, lambda: page.click('#showMore.showMoreBtn', timeout=10000))
+        except PlaywrightTimeoutError:
+            break
+        request = response.request
+
+    if not product_data_list:
+        try:
+            await page.wait_for_selector('#productInfoList > li.productGrid', timeout=2000)
+            # The page shows products the responses did not yield, so their shape is not understood
+            return None
+        except PlaywrightTimeoutError:
+            pass
+    return product_data_list
+
+
+async def scrape_promotion_search(page, search: str) -> list[dict]:
+    global promo_page_capture_failures
+    if PROMO_PAGE_SCRAPE_MODE == 'network' and promo_page_capture_failures < PROMO_PAGE_CAPTURE_MAX_FAILURES:
+        product_data_list = await scrape_promotion_search_from_network(page, search)
+        if product_data_list is not None:
+            return product_data_list
+
+        promo_page_capture_failures += 1
+        Logger.warn(f"Falling back to the DOM for search '{search}' "
+                    f"({promo_page_capture_failures}/{PROMO_PAGE_CAPTURE_MAX_FAILURES} capture failures this run)")
+    return await scrape_promotion_search_from_dom(page, search)
+
+
+async def scrape_promotion_search_term(page, promo_code: str, search: str) -> list[dict]:
+    try:
+        Logger.info(f"Searching = '{search}' with promo code: {promo_code}")
+        product_data_list = await scrape_promotion_search(page, search)
+        Logger.info(f'Fetched {len(product_data_list)} products for search term: {search} and promo code: {promo_code}')
+        return product_data_list
+    except Exception as e:
+        Logger.error(f"Exception during search '{search}' for promo code {promo_code}:", e)
+        return []
+    finally:
+        Logger.info(f"Finished scraping search '{search}'")
+
+
+async def scrape_promotion_searches_in_tabs(page, url: str, promo_code: str, search_list: list[str]) -> list[list[dict]]:
+    """Run the search terms on the promotion page open in page, plus up to PROMO_SEARCH_CONCURRENCY - 1 more tabs of
+    the same context, returning each term's products in search term order."""
+    results = [[] for _ in search_list]
+    pending_searches = deque(enumerate(search_list))
+
+    async def run_searches(tab):
+        while pending_searches:
+            index, search = pending_searches.popleft()
+            results[index] = await scrape_promotion_search_term(tab, promo_code, search)
+
+    async def run_searches_in_new_tab(tab_number: int):
+        try:
+            async with browser_pool.page('promotions') as tab:
+                await navigate(tab, url, 'pages', expected_selector='#keywordSearchInputText')
+                await run_searches(tab)
+        except Exception as e:
+            # The other tabs pick up the search terms this one leaves behind
+            Logger.warn(f"Promotion tab {tab_number} for promo code {promo_code} failed", e)
+
+    tab_count = max(min(PROMO_SEARCH_CONCURRENCY, len(search_list)), 1)
+    if tab_count > 1:
+        Logger.info(f"Searching {len(search_list)} terms for promo code {promo_code} in {tab_count} tabs")
+    await asyncio.gather(run_searches(page), *(run_searches_in_new_tab(tab_number)
+                                               for tab_number in range(1, tab_count)))
+    return results
+
+
 async def scrape_links_from_promo_code(promo_code: str) -> list[Promotion]:
-    from discord_bot import send_price_change_notification
-    
-    async with async_playwright() as p:
+    async with browser_pool.page('promotions') as page:
         Logger.info(f"Scraping product urls from promo code: {promo_code}")
-        browser, page = await get_browser(p)
 
         url = f'https://www.amazon.co.uk/promotion/psp/{promo_code}'
-        await page.goto(url)
+        await navigate(page, url, 'searches')
 
         all_promotion_products: list[Promotion] = []
 
@@ -205,128 +545,78 @@ async def scrape_links_from_promo_code(promo_code: str) -> list[Promotion]:
 
         if not check_promo_regex(promotion_title):
             Logger.warn(f"Promotion title: {promotion_title} does not match the regex. Skipping...")
-            await sleep_randomly(20, 3, 'Not a valid promotion')
             return all_promotion_products
 
         await sleep_randomly(5, 0.5, 'Waiting for page to load')
 
         search_list = await get_all_searches()
 
-        for search in search_list:
-            try:
-                Logger.info(f"Searching = '{search}' with promo code: {promo_code}")
-
-                # Input search term
-                await page.fill('#keywordSearchInputText', search)
-                await page.click('#keywordSearchBtn', timeout=60000)
-                await sleep_randomly(7, 1, 'Waiting for search results')
-                for index in range(MAX_SHOW_MORE_CLICKS):
-                    try:
-                        show_more_button = await page.query_selector('#showMore.showMoreBtn')
-                        if show_more_button:
-                            await show_more_button.scroll_into_view_if_needed(timeout=10000)
-                            await show_more_button.click(timeout=10000)
-                            Logger.info('Clicked "Show More" button')
-                            await sleep_randomly(7, 1, 'Waiting for more results')
-                        else:
-                            raise Exception("Show More button not found")
-                    except:
-                        Logger.error(f"Error clicking 'Show More' button")
-                        break
-
-                product_data_list = await page.evaluate('''
-                    () => {
-                        const productCards = Array.from(document.querySelectorAll('#productInfoList > li.productGrid'));
-                        return productCards.map(card => {
-                            const imageElement = card.querySelector('img');
-                            const titleElement = card.querySelector('div.productTitleBox a');
-                            let priceElement = card.querySelector('.a-offscreen') ||
-                               card.querySelector('#corePriceDisplay_desktop_feature_div .reinventPricePriceToPayMargin') ||
-                               card.querySelector('.reinventPricePriceToPay');
-
-                            // Additional fallbacks (from full page if card-based selector fails)
-                            if (!priceElement) {
-                                priceElement = document.querySelector('#priceblock_ourprice') ||
-                                            document.querySelector('.a-price .a-offscreen');
-                            }
-
-                            const priceText = priceElement ? priceElement.textContent.trim() : "N/A";
-                            const match = priceText.match(/([£€$]|USD|EUR)?\\s*([\\d.,]+)/);
-                            const currency = match?.[1] || "";
-                            const amount = match?.[2] || "";
-
-                                
-                            return {
-                                product_url: titleElement ? titleElement.href : null,
-                                product_title: titleElement ? titleElement.textContent.trim() : "Unknown Title",
-                                current_price: match ? `${currency}${amount}` : "N/A",
-                                product_img: imageElement ? imageElement.src : null
-                            };
-                        }).filter(p => p.product_url !== null);
-                    }
-                ''')
-                for product in product_data_list:
-                    all_promotion_products.append(Promotion(
-                        promo_code,
-                        promotion_title,
-                        url,
-                        product_title=product['product_title'],
-                        product_price=product['current_price'],
-                        product_img=product['product_img'],
-                        product_url=product['product_url']
-                    ))
-
-                Logger.info(f'Fetched {len(product_data_list)} products for search term: {search} and promo code: {promo_code}')
-            except Exception as e:
-                Logger.error(f"Exception during search '{search}' for promo code {promo_code}:", e)
-            finally:
-                Logger.info(f"Finished scraping search '{search}'")
-
-        # Save or update to DB + Notify if price changes
-        for promo in all_promotion_products:
-            existing = await get_promotion_by_url(promo.product_url)
-
-            if existing:
-                old_price = existing.get("product_price", "N/A")
-                new_price = promo.product_price
-
-                if old_price != new_price:
-                    Logger.info(f"Price changed for {promo.product_title}: {old_price} → {new_price}")
-                    await send_price_change_notification(promo, old_price)
-            else:
-                Logger.info(f"New promotion found: {promo.product_title}")
-
-            await upsert_promotion(promo)
+        # Results are merged in search term order whatever the number of tabs, first occurrence of an ASIN wins
+        seen_product_keys = set()
+        for product_data_list in await scrape_promotion_searches_in_tabs(page, url, promo_code, search_list):
+            for product in product_data_list:
+                product_key = get_product_key(product['product_url'])
+                if product_key in seen_product_keys:
+                    continue
+                seen_product_keys.add(product_key)
+                all_promotion_products.append(Promotion(
+                    promo_code,
+                    promotion_title,
+                    url,
+                    product_title=product['product_title'],
+                    product_price=product['current_price'],
+                    product_img=product['product_img'],
+                    product_url=canonicalize_product_url(product['product_url'])
+                ))
 
         Logger.info(f"Finished scraping for promo code {promo_code}. Total products: {len(all_promotion_products)}")
         return all_promotion_products
 
 
-async def scrape_links_from_promo_codes(promo_codes: set[str]) -> list[Promotion]:
-    Logger.info('scraping product links from all promo codes')
+async def scrape_links_from_promo_code_with_retries(promo_code: str, coupon_label: str) -> list[Promotion] | None:
+    promotions = run_checkpoint.get_promotions(promo_code)
+    if promotions is not None:
+        Logger.info(f"Restored {len(promotions)} promotions of coupon {coupon_label} from the checkpoint")
+        price_changes.extend(run_checkpoint.get_price_changes(promo_code))
+        return promotions
 
-    promotions_list: list[Promotion] = []
-    for coupon_index, promo_code in enumerate(promo_codes):
-        max_attempts = 3
+    max_attempts = 3
+    with Logger.context(url=f'https://www.amazon.co.uk/promotion/psp/{promo_code}'):
         for attempt in range(max_attempts):
             try:
-                Logger.info(
-                    f"Attempting coupon {coupon_index + 1}/{len(promo_codes)}, attempt {attempt + 1}/{max_attempts}")
-                promo_results = await scrape_links_from_promo_code(promo_code)
-                promotions_list.extend(promo_results)
-                await sleep_randomly(DELAY_BETWEEN_SEARCHES)
-                break
+                Logger.info(f"Attempting coupon {coupon_label}, attempt {attempt + 1}/{max_attempts}")
+                promotions = await scrape_links_from_promo_code(promo_code)
+                promotion_price_changes = await upsert_promotions_and_get_price_changes(promotions)
+                await run_checkpoint.save_promotions(promo_code, promotions, promotion_price_changes)
+                price_changes.extend(promotion_price_changes)
+                return promotions
             except Exception as e:
-                Logger.error(
-                    f"Error scraping promo code {promo_code} (coupon {coupon_index + 1}/{len(promo_codes)}) on attempt {attempt + 1}",
-                    e)
+                Logger.error(f"Error scraping promo code {promo_code} (coupon {coupon_label}) on attempt {attempt + 1}", e)
                 if attempt == max_attempts - 1:
                     Logger.error(
-                        f"Max attempts reached for promo code {promo_code} (coupon {coupon_index + 1}/{len(promo_codes)}). Moving to next promo code.")
+                        f"Max attempts reached for promo code {promo_code} (coupon {coupon_label}). Moving to next promo code.")
                 else:
                     Logger.info(
-                        f"Retrying coupon {coupon_index + 1}/{len(promo_codes)}, attempt {attempt + 2}/{max_attempts} for promo code {promo_code}...")
-                    await sleep_randomly(20, 5, 'Retrying coupon')
+                        f"Retrying coupon {coupon_label}, attempt {attempt + 2}/{max_attempts} for promo code {promo_code}...")
+                    # A quarantined context has already been replaced, only a plain failure needs a pause
+                    if not isinstance(e, ContextQuarantinedError):
+                        await sleep_randomly(20, 5, 'Retrying coupon')
+    return None
+
+
+async def scrape_links_from_promo_codes(promo_codes: set[str],
+                                       fingerprints: FingerprintTracker = None) -> list[Promotion]:
+    """Collect the promotions of every promo code, only keeping the products new to a promo code's listing."""
+    Logger.info('scraping product links from all promo codes')
+
+    promotions_list: list[Promotion] = []
+    for coupon_index, promo_code in enumerate(promo_codes):
+        promo_results = await scrape_links_from_promo_code_with_retries(
+            promo_code, f"{coupon_index + 1}/{len(promo_codes)}")
+        if promo_results is not None:
+            if fingerprints is not None:
+                promo_results = await fingerprints.get_new_promotions(promo_code, promo_results)
+            promotions_list.extend(promo_results)
     Logger.info(
         f'finished scraping product links from all promo codes. found {len(promotions_list)} items with promotions',
         promotions_list)
@@ -337,7 +627,7 @@ async def scrape_product_details_from_url(page, promotion_link: Promotion) -> Pr
     product_link = promotion_link.product_url
     try:
         Logger.info(f"Scraping product details : {product_link}")
-        await page.goto(product_link)
+        await navigate(page, product_link, 'links', expected_selector='#productTitle')
 
         product = await page.evaluate('''
             () => {
@@ -346,7 +636,8 @@ async def scrape_product_details_from_url(page, promotion_link: Promotion) -> Pr
                 const product_img = document.querySelector('#landingImage').src;
 
                 // Get the ASIN (extracted from the product URL)
-                const asin = product_url ? product_url.match(/\\/dp\\/(\\\\w+)/) ? product_url.match(/\\/dp\\/(\\\\w+)/)[1] : null : null;
+                const asin_match = product_url ? product_url.match(/\\/dp\\/(\\w+)/) : null;
+                const asin = asin_match ? asin_match[1] : null;
 
                 // Get the current price
                 const priceElement = document.querySelector('#corePriceDisplay_desktop_feature_div .reinventPricePriceToPayMargin');
@@ -387,7 +678,7 @@ async def scrape_product_details_from_url(page, promotion_link: Promotion) -> Pr
             }
         ''')
 
-        return ProductDetails(
+        product_details = ProductDetails(
             promotion_code=promotion_link.promotion_code,
             promotion_title=promotion_link.promotion_title,
             promotion_url=promotion_link.promotion_url,
@@ -396,8 +687,11 @@ async def scrape_product_details_from_url(page, promotion_link: Promotion) -> Pr
             product_image_url=product['product_img'],
             product_price=product['current_price'],
             product_sales=product['sales_last_month'],
-            product_asin=product['asin'],
+            # The id products are de-duplicated on, the promotion's link has the ASIN even when the page URL does not
+            product_asin=extract_asin(promotion_link.product_url) or product['asin'],
         )
+        await run_checkpoint.save_product_details(promotion_link, product_details)
+        return product_details
     except Exception as e:
         Logger.error(f"Error scraping product - {product_link}, Most Likely Captcha is detected!", e)
         raise e
@@ -406,58 +700,188 @@ async def scrape_product_details_from_url(page, promotion_link: Promotion) -> Pr
 
 
 async def scrape_product_details_from_urls_in_batch(product_links: list[Promotion]) -> list[ProductDetails]:
-    Logger.info(f"Scraping product details from urls in batch")
-    product_details_list: list[ProductDetails] = []
+    if PRODUCT_DETAILS_CONCURRENCY > 1 and len(product_links) > 1:
+        return await scrape_product_details_from_urls_concurrently(product_links)
 
-    total_batches = (len(product_links) - 1) // SCRAPING_URL_BATCH_SIZE + 1
-    for i in range(0, len(product_links), SCRAPING_URL_BATCH_SIZE):
+    Logger.info(f"Scraping product details from urls in batch")
+    # Results are stored by input position so a resumed run keeps the order of an uninterrupted one
+    results = dict(enumerate(run_checkpoint.get_product_details(link) for link in product_links))
+    if any(results.values()):
+        Logger.info(f"Restored {sum(map(bool, results.values()))} product details from the checkpoint")
+    pending_links = [(index, link) for index, link in enumerate(product_links) if results[index] is None]
+
+    total_batches = (len(pending_links) - 1) // SCRAPING_URL_BATCH_SIZE + 1
+    for i in range(0, len(pending_links), SCRAPING_URL_BATCH_SIZE):
         Logger.info(f"Starting batch {i // SCRAPING_URL_BATCH_SIZE + 1} of {total_batches}")
-        batch = product_links[i:i + SCRAPING_URL_BATCH_SIZE]
+        batch = pending_links[i:i + SCRAPING_URL_BATCH_SIZE]
 
-        async with async_playwright() as p:
-            browser, page = await get_browser(p)
-            for link in batch:
+        async with browser_pool.page('product_details') as page:
+            for index, link in batch:
                 try:
-                    product_details_list.append(await scrape_product_details_from_url(page, link))
-                    await sleep_randomly(DELAY_BETWEEN_LINKS)
-                except:
-                    await sleep_randomly(CAPTCHA_DETECTED_DELAY, 3)
+                    with Logger.context(url=link.product_url):
+                        results[index] = await run_with_reroute(page, 'product_details',
+                                                                scrape_product_details_from_url, link)
+                except Exception:
+                    # The rate controller has already backed off on the failed navigation
                     pass
 
         Logger.info(f"Completed batch {i // SCRAPING_URL_BATCH_SIZE + 1} of {total_batches}")
         await sleep_randomly(BATCH_SIZE_DELAY, 3)
 
+    product_details_list = [product_details for product_details in results.values() if product_details is not None]
     Logger.info(f"Finished Scraping product details from urls in batch. Found {len(product_details_list)} promo codes",
                 product_details_list)
     return product_details_list
 
 
-async def startScraper() -> ProcessedProductDetails:
-    Logger.info('Starting the Scraper')
-    start_time = time.time()
+async def scrape_product_details_worker(worker_id: int, queue: asyncio.Queue, results: dict[int, ProductDetails],
+                                        isolated: bool = True) -> None:
+    """Scrape (index, promotion) items from the queue until the None end marker is reached."""
+    # Stagger the workers so the contexts don't all hit Amazon at the same moment
+    await sleep_randomly(worker_id * DELAY_BETWEEN_LINKS / max(PRODUCT_DETAILS_CONCURRENCY, 1), 1,
+                         f'Staggering product details worker {worker_id}')
+
+    scraped = 0
+    rerouted_item = None
+    rerouted_indexes = set()
+    finished = False
+    while not finished:
+        async with browser_pool.worker_page(isolated, 'product_details') as page:
+            while True:
+                if rerouted_item is not None:
+                    item, rerouted_item = rerouted_item, None
+                else:
+                    item = await queue.get()
+                if item is None:
+                    # Leave the end marker in place for the other workers
+                    await queue.put(None)
+                    finished = True
+                    break
 
-    await connect_to_database()
+                index, link = item
+                restored_product_details = run_checkpoint.get_product_details(link)
+                if restored_product_details is not None:
+                    results[index] = restored_product_details
+                    continue
+                try:
+                    with Logger.context(url=link.product_url):
+                        results[index] = await scrape_product_details_from_url(page, link)
+                except ContextQuarantinedError:
+                    # Retry the item once on the fresh context, requeueing it could put it behind the end marker
+                    if index not in rerouted_indexes:
+                        rerouted_indexes.add(index)
+                        rerouted_item = item
+                    Logger.warn(f"Worker {worker_id} context quarantined, moving to a fresh context")
+                    break
+                except Exception:
+                    # The rate controller has already backed off on the failed navigation
+                    pass
 
-    try:
-        # await setup_amazon_uk()
-        # await sleep_randomly(DELAY_BETWEEN_STEPS)
+                scraped += 1
+                if scraped % SCRAPING_URL_BATCH_SIZE == 0 and not queue.empty():
+                    Logger.info(f"Worker {worker_id} completed a batch of {SCRAPING_URL_BATCH_SIZE} products")
+                    await sleep_randomly(BATCH_SIZE_DELAY, 3)
+
+    Logger.info(f"Product details worker {worker_id} finished after {scraped} products")
+
+
+async def scrape_product_details_from_urls_concurrently(product_links: list[Promotion]) -> list[ProductDetails]:
+    worker_count = min(PRODUCT_DETAILS_CONCURRENCY, len(product_links))
+    Logger.info(f"Scraping product details from {len(product_links)} urls with {worker_count} browser contexts")
 
-        product_links = await scraping_promo_products_from_searches()
-        await sleep_randomly(DELAY_BETWEEN_STEPS)
+    queue = asyncio.Queue()
+    for index, link in enumerate(product_links):
+        queue.put_nowait((index, link))
+    queue.put_nowait(None)
 
-        promo_codes = await scrape_promo_codes_from_urls_in_batch(product_links)
-        await sleep_randomly(DELAY_BETWEEN_STEPS)
+    # Results are stored by input position so the output order matches the sequential mode
+    results: dict[int, ProductDetails] = {}
+    await asyncio.gather(*(scrape_product_details_worker(worker_id, queue, results)
+                           for worker_id in range(worker_count)))
 
-        promotions_list = await scrape_links_from_promo_codes(promo_codes)
-        await sleep_randomly(DELAY_BETWEEN_STEPS)
+    product_details_list = [results[index] for index in sorted(results)]
+    Logger.info(f"Finished Scraping product details from urls concurrently. Found {len(product_details_list)} products",
+                product_details_list)
+    return product_details_list
+
+
+async def run_staged_scraper(fingerprints: FingerprintTracker, force_refresh: bool = False) -> list[ProductDetails]:
+    with Logger.context(stage='search'):
+        product_links = await scraping_promo_products_from_searches(fingerprints)
+    report_progress('stage_finished', {"stage": 'search', "product_links": len(product_links)})
+    await sleep_randomly(DELAY_BETWEEN_STEPS)
 
+    with Logger.context(stage='promo_codes'):
+        promo_codes = await scrape_promo_codes_from_urls_in_batch(product_links, force_refresh, fingerprints)
+        promo_codes.update(fingerprints.unchanged_promo_codes)
+    report_progress('stage_finished', {"stage": 'promo_codes', "promo_codes": len(promo_codes)})
+    await sleep_randomly(DELAY_BETWEEN_STEPS)
+
+    with Logger.context(stage='promotions'):
+        promotions_list = await scrape_links_from_promo_codes(promo_codes, fingerprints)
+    report_progress('stage_finished', {"stage": 'promotions', "promotions": len(promotions_list)})
+    await sleep_randomly(DELAY_BETWEEN_STEPS)
+
+    with Logger.context(stage='product_details'):
         product_details_list = await scrape_product_details_from_urls_in_batch(promotions_list)
+    report_progress('stage_finished', {"stage": 'product_details', "products": len(product_details_list)})
+    return product_details_list
+
+
+async def startScraper(force_refresh: bool = False) -> ProcessedProductDetails:
+    await connect_to_database()
+    run_id, force_refresh = await run_checkpoint.start(force_refresh)
+    report_progress('run_started', {"run_id": run_id, "force_refresh": force_refresh})
+    with Logger.context(run_id=run_id):
+        return await scrape_and_process_products(run_id, force_refresh)
+
+
+async def scrape_and_process_products(run_id: str, force_refresh: bool = False) -> ProcessedProductDetails:
+    global promo_page_capture_failures
+    Logger.info('Starting the Scraper')
+    promo_page_capture_failures = 0
+    price_changes.clear()
+    start_time = time.time()
+    fingerprints = FingerprintTracker(force_refresh)
+
+    try:
+        if SCRAPER_EXECUTION_MODE != 'distributed':
+            if PROXIES_ENABLED:
+                await proxy_manager.initialize_proxies()
+            await browser_pool.start()
+
+        # await setup_amazon_uk()
+        # await sleep_randomly(DELAY_BETWEEN_STEPS)
+
+        if SCRAPER_EXECUTION_MODE == 'distributed':
+            # worker.py processes do the scraping, this process only queues the run and collects its results
+            from job_queue import run_distributed
+            product_details_list = await run_distributed(run_id, force_refresh)
+        elif SCRAPER_EXECUTION_MODE == 'streaming':
+            from pipeline import run_streaming_pipeline
+            product_details_list = await run_streaming_pipeline(fingerprints, force_refresh)
+        else:
+            product_details_list = await run_staged_scraper(fingerprints, force_refresh)
 
         filtered_products = await process_products(product_details_list)
+        filtered_products.price_changes = list(price_changes)
+        await run_checkpoint.finish()
+        # Saved last: a resumed run replays its checkpoint against the fingerprints the run started with
+        await fingerprints.save_search_fingerprints()
+        await fingerprints.save_promotion_fingerprints(product_details_list)
 
     except Exception as e:
         Logger.critical(f"FAILED!! FAILED!! FAILED!! FAILED!! FAILED!! FAILED!! FAILED!! FAILED!!", e)
+        Logger.info(f"Run {run_id} is checkpointed, the next start resumes it")
         filtered_products = ProcessedProductDetails()
+    finally:
+        await http_fetcher.close()
+        await browser_pool.stop()
+        await proxy_manager.close()
+        try:
+            await proxy_manager.save_stats(run_id)
+        except Exception as e:
+            Logger.error("Error saving proxy stats", e)
 
     end_time = time.time()
     total_time = end_time - start_time
@@ -0,0 +1,137 @@
+import asyncio
+import os
+import signal
+import sys
+
+import codec
+from config import SCRAPER_PROCESS_HEARTBEAT_INTERVAL, SCRAPER_PROCESS_HEARTBEAT_TIMEOUT, \
+    SCRAPER_PROCESS_MESSAGE_LIMIT, SCRAPER_PROCESS_STOP_TIMEOUT
+from logger import Logger
+from models import ProcessedProductDetails
+import scraper
+
+# The child writes one JSON message per line to its stdout, logs keep going to stderr:
+#   {"type": "heartbeat"}, {"type": "progress", "event": ..., "details": {...}}, {"type": "result", "result": {...}}
+
+SCRAPER_PROCESS_SCRIPT = os.path.abspath(__file__)
+
+
+async def wait_for_exit(process) -> int:
+    """Wait for a child that was asked to stop, killing it when it has not exited after the grace period."""
+    try:
+        return await asyncio.wait_for(process.wait(), SCRAPER_PROCESS_STOP_TIMEOUT)
+    except asyncio.TimeoutError:
+        Logger.error(f"The scraper process did not stop within {SCRAPER_PROCESS_STOP_TIMEOUT} seconds, killing it")
+        process.kill()
+        return await process.wait()
+
+
+class ScraperProcess:
+    """Runs startScraper in a child process so the bot's event loop only has to read its messages.
+
+    The child is killed when it stops sending heartbeats, a killed or crashed run is resumed from its checkpoint by the
+    next start.
+    """
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super(ScraperProcess, cls).__new__(cls)
+            cls._instance.process = None
+        return cls._instance
+
+    @property
+    def is_running(self) -> bool:
+        return self.process is not None and self.process.returncode is None
+
+    async def run(self, force_refresh: bool = False) -> ProcessedProductDetails:
+        if self.is_running:
+            raise RuntimeError("The scraper is already running")
+
+        Logger.info(f"Starting the scraper process (force refresh: {force_refresh})")
+        self.process = await asyncio.create_subprocess_exec(
+            sys.executable, SCRAPER_PROCESS_SCRIPT, *(['--force-refresh'] if force_refresh else []),
+            cwd=os.path.dirname(SCRAPER_PROCESS_SCRIPT), stdout=asyncio.subprocess.PIPE,
+            limit=SCRAPER_PROCESS_MESSAGE_LIMIT,
+        )
+
+        result = None
+        try:
+            while True:
+                try:
+                    line = await asyncio.wait_for(self.process.stdout.readline(), SCRAPER_PROCESS_HEARTBEAT_TIMEOUT)
+                except asyncio.TimeoutError:
+                    Logger.error(f"No heartbeat from the scraper process for {SCRAPER_PROCESS_HEARTBEAT_TIMEOUT} "
+                                 f"seconds, killing it")
+                    self.process.kill()
+                    break
+                if not line:
+                    break
+
+                try:
+                    message = codec.loads(line)
+                except ValueError:
+                    Logger.warn(f"Unexpected output from the scraper process: {line[:200]!r}")
+                    continue
+                if message['type'] == 'progress':
+                    Logger.info(f"Scraper process: {message['event']}", message['details'])
+                elif message['type'] == 'result':
+                    result = ProcessedProductDetails.from_dict(message['result'])
+        except asyncio.CancelledError:
+            # The bot is shutting down, let the child close its browser before it goes
+            self.process.terminate()
+            raise
+        finally:
+            return_code = await wait_for_exit(self.process)
+            self.process = None
+
+        if result is None:
+            Logger.critical(f"The scraper process exited with code {return_code} without a result")
+            return ProcessedProductDetails()
+        Logger.info("The scraper process finished")
+        return result
+
+    async def stop(self) -> None:
+        """Ask a running scraper to stop and wait for it, it closes its browser and leaves the run to be resumed."""
+        if not self.is_running:
+            return
+        Logger.info("Stopping the scraper process")
+        process = self.process
+        process.terminate()
+        await wait_for_exit(process)
+
+
+async def run_child(force_refresh: bool, ipc) -> None:
+    def send(message: dict) -> None:
+        ipc.write(codec.dumps(message) + b'\n')
+        ipc.flush()
+
+    async def send_heartbeats() -> None:
+        while True:
+            send({"type": "heartbeat"})
+            await asyncio.sleep(SCRAPER_PROCESS_HEARTBEAT_INTERVAL)
+
+    scraper.progress_listener = lambda event, details: send({"type": "progress", "event": event, "details": details})
+    heartbeat_task = asyncio.create_task(send_heartbeats())
+    scraper_task = asyncio.create_task(scraper.startScraper(force_refresh))
+    # The browser is closed by the scraper's own clean-up when the bot asks it to stop
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, scraper_task.cancel)
+    try:
+        processed_product_details = await scraper_task
+    finally:
+        heartbeat_task.cancel()
+    send({"type": "result", "result": processed_product_details.to_dict()})
+
+
+if __name__ == "__main__":
+    # Only IPC messages may reach the real stdout, anything else printed goes to the log stream
+    ipc_stream = sys.stdout.buffer
+    sys.stdout = sys.stderr
+    try:
+        asyncio.run(run_child('--force-refresh' in sys.argv[1:], ipc_stream))
+    except asyncio.CancelledError:
+        Logger.warn("Scraper process stopped, the run will be resumed by the next start")
+        sys.exit(1)
+    except Exception as e:
+        Logger.critical('An error occurred', e)
+        sys.exit(1)
@@ -0,0 +1,32 @@
+import os
+import sys
+
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+
+# The modules live at the repository root, next to main.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db  # noqa: E402
+
+COLLECTIONS = {
+    'collection': 'Searches',
+    'products_collection': 'Products',
+    'promotion_collection': 'Promotions',
+    'promo_code_cache_collection': 'PromoCodeCache',
+    'proxy_stats_collection': 'ProxyStats',
+    'fingerprints_collection': 'Fingerprints',
+    'runs_collection': 'Runs',
+    'run_items_collection': 'RunItems',
+    'jobs_collection': 'Jobs',
+}
+
+
+@pytest.fixture
+def database(monkeypatch):
+    """Point the collections of db.py at a fresh in-memory Mongo, as connect_to_database would at a real one."""
+    mock_db = AsyncMongoMockClient()['PromoBot']
+    monkeypatch.setattr(db, 'db', mock_db)
+    for name, collection_name in COLLECTIONS.items():
+        monkeypatch.setattr(db, name, mock_db[collection_name])
+    return mock_db
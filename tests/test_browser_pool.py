@@ -0,0 +1,53 @@
+import asyncio
+import time
+
+import browser_pool
+from browser_pool import BrowserPool
+from config import CIRCUIT_BREAKER_IDENTITY_HOLD
+from rate_controller import RateController
+
+
+class FakeContext:
+    def on(self, event, handler):
+        pass
+
+    async def close(self):
+        pass
+
+
+class FakePage:
+    async def evaluate(self, script):
+        return 'user agent'
+
+
+async def get_browser(playwright, proxy: dict = None):
+    return FakeContext(), FakePage()
+
+
+def get_wait_time(rate_controller: RateController, key: str) -> float:
+    budget = rate_controller.budgets.get(key)
+    return budget.get_wait_time(time.monotonic()) if budget is not None else 0.0
+
+
+def test_quarantined_profile_without_proxies_holds_only_its_host(monkeypatch):
+    """Without proxies the relaunched profile keeps its IP, so the host it tripped on is held for a short while."""
+    monkeypatch.setattr(browser_pool, 'get_browser', get_browser)
+    rate_controller = RateController()
+    monkeypatch.setattr(rate_controller, 'budgets', {})
+    rate_controller.get_budgets('https://www.amazon.com/')
+    pool = BrowserPool()
+    monkeypatch.setattr(pool, 'playwright', object())
+    monkeypatch.setattr(pool, 'context', None)
+
+    async def run():
+        await pool.start()
+        retired_context = pool.context
+        await pool.retire_context(retired_context, 'https://www.amazon.co.uk/dp/B0ABCDEF12')
+        # Further pages of the retired profile don't extend the hold
+        await pool.retire_context(retired_context, 'https://www.amazon.co.uk/dp/B0ABCDEF12')
+        return retired_context
+
+    retired_context = asyncio.run(run())
+    assert pool.context is not retired_context
+    assert 0 < get_wait_time(rate_controller, 'host:www.amazon.co.uk') <= CIRCUIT_BREAKER_IDENTITY_HOLD
+    assert get_wait_time(rate_controller, 'host:www.amazon.com') == 0
@@ -0,0 +1,33 @@
+import asyncio
+from datetime import datetime, timedelta
+
+from checkpoints import RunCheckpoint
+from config import RUN_CHECKPOINT_MAX_AGE
+
+# The bot's cron starts a run every day at 01:00 UTC
+SCHEDULE_INTERVAL = timedelta(days=1)
+
+
+def start_after_crash(database, monkeypatch, crashed_run_age: timedelta) -> str:
+    run_checkpoint = RunCheckpoint()
+    monkeypatch.setattr(run_checkpoint, 'run_id', None)
+    monkeypatch.setattr(run_checkpoint, 'items', {})
+
+    async def run():
+        await database['Runs'].insert_one({"_id": 'crashed', "status": "running",
+                                           "started_at": datetime.utcnow() - crashed_run_age})
+        run_id, _ = await run_checkpoint.start()
+        return run_id
+
+    return asyncio.run(run())
+
+
+def test_next_scheduled_run_resumes_a_crashed_run(database, monkeypatch):
+    # The scheduled start can fire late, and the crashed run started on time the day before
+    assert start_after_crash(database, monkeypatch, SCHEDULE_INTERVAL + timedelta(minutes=5)) == 'crashed'
+
+
+def test_run_older_than_the_resume_window_starts_over(database, monkeypatch):
+    assert RUN_CHECKPOINT_MAX_AGE > SCHEDULE_INTERVAL.total_seconds()
+    crashed_run_age = timedelta(seconds=RUN_CHECKPOINT_MAX_AGE, minutes=1)
+    assert start_after_crash(database, monkeypatch, crashed_run_age) != 'crashed'
@@ -0,0 +1,146 @@
+import asyncio
+from datetime import datetime, timedelta
+
+from pymongo.errors import BulkWriteError
+
+import db
+from config import DAYS_TO_EXPIRE_OLD_PRODUCTS
+from models import ProductDetails, ProcessedProductDetails, Promotion
+
+SALES_CUTOFF = 100
+
+
+def get_product(asin: str, product_sales: int = 500) -> ProductDetails:
+    return ProductDetails("CODE1", "Save 20%", "https://www.amazon.co.uk/promotion/psp/CODE1",
+                          f"https://www.amazon.co.uk/dp/{asin}", "Title", "https://m.media-amazon.com/image.jpg",
+                          "£9.99", product_sales, asin)
+
+
+PRODUCTS = [
+    get_product('B0NEW00001'),
+    get_product('B0FRESH001'),
+    get_product('B0STALE001'),
+    get_product('B0NEW00001'),
+    get_product('B0LOWSALE1', SALES_CUTOFF - 1),
+    get_product('B0NEW00002', SALES_CUTOFF),
+]
+
+
+async def seed_products(database) -> None:
+    await database['Products'].delete_many({})
+    await database['Products'].insert_many([
+        {"_id": 'B0FRESH001/CODE1', "last_updated": datetime.utcnow() - timedelta(days=1)},
+        {"_id": 'B0STALE001/CODE1',
+         "last_updated": datetime.utcnow() - timedelta(days=DAYS_TO_EXPIRE_OLD_PRODUCTS + 1)},
+    ])
+
+
+async def process_products_one_by_one(product_list: list[ProductDetails]) -> ProcessedProductDetails:
+    """process_products as it was before the bulk writes: a lookup and an upsert per product."""
+    cutoff_date = datetime.utcnow() - timedelta(days=DAYS_TO_EXPIRE_OLD_PRODUCTS)
+    processed_product_details = ProcessedProductDetails()
+    for product in product_list:
+        doc = await db.products_collection.find_one({"_id": product.id, "last_updated": {"$gte": cutoff_date}})
+        if doc is not None:
+            processed_product_details.up_to_date.append(product)
+        elif product.product_sales >= SALES_CUTOFF:
+            if await db.upsert_product(product):
+                processed_product_details.upserted.append(product)
+        else:
+            processed_product_details.below_threshold.append(product)
+    return processed_product_details
+
+
+def get_classified_ids(processed_product_details: ProcessedProductDetails) -> dict[str, list[str]]:
+    return {name: [product.id for product in getattr(processed_product_details, name)]
+            for name in ('upserted', 'up_to_date', 'below_threshold')}
+
+
+def test_bulk_process_products_classifies_like_one_by_one(database, monkeypatch):
+    monkeypatch.setitem(db.data_manager.data, 'monthly_sales_cutoff', SALES_CUTOFF)
+
+    async def run():
+        await seed_products(database)
+        expected = await process_products_one_by_one(PRODUCTS)
+        await seed_products(database)
+        return expected, await db.process_products(PRODUCTS)
+
+    expected, processed_product_details = asyncio.run(run())
+    assert get_classified_ids(processed_product_details) == get_classified_ids(expected)
+    assert get_classified_ids(processed_product_details) == {
+        "upserted": ['B0NEW00001/CODE1', 'B0NEW00002/CODE1'],
+        # The repeated product finds the document written for its first occurrence
+        "up_to_date": ['B0FRESH001/CODE1', 'B0NEW00001/CODE1'],
+        "below_threshold": ['B0LOWSALE1/CODE1'],
+    }
+    # Refreshing a stale document is not an insert, both paths report it as a failed upsert but still write it
+    stale_product = asyncio.run(database['Products'].find_one({"_id": 'B0STALE001/CODE1'}))
+    assert stale_product['product_asin'] == 'B0STALE001'
+
+
+def test_promotions_move_to_canonical_product_urls(database):
+    canonical_url = "https://www.amazon.co.uk/dp/B0ABCDEF12"
+
+    async def run():
+        promotions = database['Promotions']
+        await promotions.create_index("product_url", unique=True)
+        await promotions.insert_many([
+            {"product_url": "https://www.amazon.co.uk/Old-Title/dp/B0ABCDEF12/ref=sr_1_1?th=1", "product_price": '£8',
+             "last_updated": datetime.utcnow() - timedelta(days=2)},
+            {"product_url": "https://www.amazon.co.uk/New-Title/dp/B0ABCDEF12/ref=sr_1_2", "product_price": '£9',
+             "last_updated": datetime.utcnow() - timedelta(days=1)},
+            {"product_url": "https://www.amazon.co.uk/sspa/click?url=%2Fdp%2FB0OTHER001%2Fref%3Dsspa",
+             "product_price": '£5', "last_updated": datetime.utcnow()},
+            {"product_url": "https://www.amazon.co.uk/dp/B0CANON001", "product_price": '£1',
+             "last_updated": datetime.utcnow()},
+            {"product_url": "https://www.amazon.co.uk/Title/dp/B0CANON001", "product_price": '£2',
+             "last_updated": datetime.utcnow()},
+        ])
+        await db.migrate_promotion_product_urls()
+        # A second start has nothing left to move
+        await db.migrate_promotion_product_urls()
+        return {doc['product_url']: doc['product_price'] async for doc in promotions.find()}
+
+    assert asyncio.run(run()) == {
+        # The newest of the raw rows of a product wins
+        canonical_url: '£9',
+        "https://www.amazon.co.uk/dp/B0OTHER001": '£5',
+        # A product already stored under its canonical URL keeps that row
+        "https://www.amazon.co.uk/dp/B0CANON001": '£1',
+    }
+
+
+class RacingCollection:
+    """Lets another worker insert the first product of the bulk write at the same moment, once."""
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.raced = False
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+    async def bulk_write(self, operations, ordered=True):
+        if self.raced:
+            return await self.collection.bulk_write(operations, ordered=ordered)
+        self.raced = True
+        await self.collection.insert_one({"product_url": operations[0]._filter['product_url'], "product_price": '£1'})
+        await self.collection.bulk_write(operations[1:], ordered=ordered)
+        raise BulkWriteError({"writeErrors": [{"index": 0, "code": db.DUPLICATE_KEY, "errmsg": "E11000"}],
+                              "upserted": [], "nInserted": 0, "nUpserted": len(operations) - 1})
+
+
+def test_promotion_upsert_retries_a_duplicate_key_race(database, monkeypatch):
+    promotions = [Promotion("CODE1", "Save 20%", "url", "Title", "£9.99", "image",
+                            f"https://www.amazon.co.uk/dp/{asin}") for asin in ('B0ABCDEF12', 'B0ABCDEF34')]
+
+    async def run():
+        await database['Promotions'].insert_one({"product_url": promotions[1].product_url, "product_price": '£5'})
+        monkeypatch.setattr(db, 'promotion_collection', RacingCollection(database['Promotions']))
+        price_changes = await db.upsert_promotions_and_get_price_changes(promotions)
+        return price_changes, {doc['product_url']: doc['product_price'] async for doc in database['Promotions'].find()}
+
+    price_changes, stored_prices = asyncio.run(run())
+    assert [(promotion.product_url, old_price) for promotion, old_price in price_changes] == \
+        [(promotions[1].product_url, '£5')]
+    assert stored_prices == {promotion.product_url: '£9.99' for promotion in promotions}
@@ -0,0 +1,31 @@
+import discord
+
+from config import DISCORD_MESSAGE_EMBED_LIMIT, DISCORD_MESSAGE_EMBED_SIZE_LIMIT
+from discord_bot import pack_embeds
+
+
+def get_embed(size: int) -> discord.Embed:
+    return discord.Embed(title='t' * 10, description='d' * (size - 10))
+
+
+def test_pack_embeds_splits_on_embed_count():
+    embeds = [get_embed(100) for _ in range(DISCORD_MESSAGE_EMBED_LIMIT * 2 + 3)]
+    messages = pack_embeds(embeds)
+    assert [len(message) for message in messages] == [DISCORD_MESSAGE_EMBED_LIMIT, DISCORD_MESSAGE_EMBED_LIMIT, 3]
+    assert [embed for message in messages for embed in message] == embeds
+
+
+def test_pack_embeds_splits_on_total_size():
+    embeds = [get_embed(2500) for _ in range(5)]
+    messages = pack_embeds(embeds)
+    assert [len(message) for message in messages] == [2, 2, 1]
+    assert all(sum(map(len, message)) <= DISCORD_MESSAGE_EMBED_SIZE_LIMIT for message in messages)
+    # An embed that exactly fills the message still fits
+    assert [len(message) for message in pack_embeds([get_embed(3000), get_embed(3000)])] == [2]
+
+
+def test_pack_embeds_sends_an_oversized_embed_alone():
+    oversized_embed = get_embed(DISCORD_MESSAGE_EMBED_SIZE_LIMIT + 1)
+    embeds = [get_embed(100), oversized_embed, get_embed(100)]
+    assert pack_embeds(embeds) == [[embeds[0]], [oversized_embed], [embeds[2]]]
+    assert pack_embeds([]) == []
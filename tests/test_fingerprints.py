@@ -0,0 +1,38 @@
+import asyncio
+
+from fingerprints import FingerprintTracker
+from models import Promotion, ProductDetails
+
+
+def get_promotion(promo_code: str, asin: str) -> Promotion:
+    return Promotion(promo_code, "Save 20%", f"https://www.amazon.co.uk/promotion/psp/{promo_code}", "Title", "£9.99",
+                     "https://m.media-amazon.com/image.jpg", f"https://www.amazon.co.uk/dp/{asin}")
+
+
+def get_product_details(promotion: Promotion, asin: str) -> ProductDetails:
+    return ProductDetails(promotion.promotion_code, promotion.promotion_title, promotion.promotion_url,
+                          promotion.product_url, "Title", promotion.product_img, "£9.99", 100, asin)
+
+
+def test_product_failed_under_one_promo_code_is_retried_for_it(database):
+    listings = {
+        'CODEA': [get_promotion('CODEA', 'B0SHARED01'), get_promotion('CODEA', 'B0ONLYA001')],
+        'CODEB': [get_promotion('CODEB', 'B0SHARED01')],
+    }
+
+    async def run():
+        fingerprints = FingerprintTracker()
+        for promo_code, promotions in listings.items():
+            await fingerprints.get_new_promotions(promo_code, promotions)
+        # The shared product only scraped under CODEA, its visit under CODEB failed
+        await fingerprints.save_promotion_fingerprints([
+            get_product_details(promotion, promotion.product_url[-10:]) for promotion in listings['CODEA']
+        ])
+
+        next_fingerprints = FingerprintTracker()
+        return {promo_code: await next_fingerprints.get_new_promotions(promo_code, promotions)
+                for promo_code, promotions in listings.items()}
+
+    new_promotions = asyncio.run(run())
+    assert new_promotions['CODEA'] == []
+    assert new_promotions['CODEB'] == listings['CODEB']
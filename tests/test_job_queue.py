@@ -0,0 +1,121 @@
+import asyncio
+
+import db
+import job_queue
+from config import JOB_MAX_ATTEMPTS
+
+
+def test_enqueue_jobs_is_idempotent(database):
+    async def run():
+        await db.enqueue_jobs('run1', 'promotions', {'CODE1': {"promo_code": 'CODE1'}})
+        await db.enqueue_jobs('run1', 'promotions', {'CODE1': {"promo_code": 'changed'},
+                                                     'CODE2': {"promo_code": 'CODE2'}})
+        # The same key in another run is another job
+        await db.enqueue_jobs('run2', 'promotions', {'CODE1': {"promo_code": 'CODE1'}})
+        return await database['Jobs'].find({"run_id": 'run1'}).sort('key').to_list(None)
+
+    jobs = asyncio.run(run())
+    assert [job['key'] for job in jobs] == ['CODE1', 'CODE2']
+    assert jobs[0]['payload'] == {"promo_code": 'CODE1'}
+    assert all(job['status'] == 'pending' and job['attempts'] == 0 for job in jobs)
+
+
+def test_expired_lease_is_claimed_by_another_worker(database):
+    async def run():
+        await db.enqueue_jobs('run1', 'search', {'term': {"search_term": 'term'}})
+        expired_job = await db.claim_job(['search'], 'dead-worker', -1)
+        job = await db.claim_job(['search'], 'live-worker', 60)
+        # A live lease is not handed out twice
+        assert await db.claim_job(['search'], 'other-worker', 60) is None
+        return expired_job, job, await db.complete_job(expired_job['_id'], 'dead-worker', 'late'), \
+            await db.complete_job(job['_id'], 'live-worker', 'done')
+
+    expired_job, job, dead_completed, live_completed = asyncio.run(run())
+    assert job['_id'] == expired_job['_id']
+    assert job['worker_id'] == 'live-worker'
+    assert job['attempts'] == 2
+    assert not dead_completed
+    assert live_completed
+
+
+def test_failed_job_is_retried_until_max_attempts(database):
+    async def run():
+        await db.enqueue_jobs('run1', 'search', {'term': {"search_term": 'term'}})
+        attempts = 0
+        while (job := await db.claim_job(['search'], 'worker', 60)) is not None:
+            attempts += 1
+            await db.fail_job(job['_id'], 'worker', 'boom')
+        return attempts, await db.get_job_counts('run1')
+
+    attempts, job_counts = asyncio.run(run())
+    assert attempts == JOB_MAX_ATTEMPTS
+    assert job_counts == {'search': {'failed': 1}}
+    assert job_queue.count_open_jobs(job_counts) == 0
+
+
+def test_abandoned_job_out_of_attempts_is_failed(database):
+    async def run():
+        await db.enqueue_jobs('run1', 'search', {'term': {"search_term": 'term'}})
+        for _ in range(JOB_MAX_ATTEMPTS):
+            await db.claim_job(['search'], 'dead-worker', -1)
+        assert await db.claim_job(['search'], 'worker', 60) is None
+        return await db.fail_abandoned_jobs('run1'), await db.get_job_counts('run1')
+
+    abandoned_jobs, job_counts = asyncio.run(run())
+    assert abandoned_jobs == 1
+    assert job_counts == {'search': {'failed': 1}}
+
+
+class FakeProxyManager:
+    async def save_stats(self, worker_id: str) -> None:
+        pass
+
+
+def test_workers_fan_out_a_run(database, monkeypatch):
+    handled = []
+
+    async def handle_search_job(run_id, payload):
+        handled.append(('search', payload['search_term']))
+        # Both search terms find the same promo code, it must be scraped once
+        await db.enqueue_jobs(run_id, 'promotions', {'CODE1': {"promo_code": 'CODE1'},
+                                                     f"CODE-{payload['search_term']}": {"promo_code": 'CODE2'}})
+        return []
+
+    async def handle_promotions_job(run_id, payload):
+        handled.append(('promotions', payload['promo_code']))
+        await db.enqueue_jobs(run_id, 'product_details', {f"B0ABCDEF12/{payload['promo_code']}": {}})
+        return {"promotions": 1, "price_changes": []}
+
+    async def handle_product_details_job(run_id, payload):
+        handled.append(('product_details', None))
+        return {"promotion_code": 'CODE1', "promotion_title": 'Save 20%', "promotion_url": 'url',
+                "product_url": 'https://www.amazon.co.uk/dp/B0ABCDEF12', "product_title": 'Title',
+                "product_image_url": 'image', "product_price": '£9.99', "product_sales": 100,
+                "product_asin": 'B0ABCDEF12'}
+
+    monkeypatch.setitem(job_queue.JOB_HANDLERS, 'search', handle_search_job)
+    monkeypatch.setitem(job_queue.JOB_HANDLERS, 'promotions', handle_promotions_job)
+    monkeypatch.setitem(job_queue.JOB_HANDLERS, 'product_details', handle_product_details_job)
+    monkeypatch.setattr(job_queue, 'JOB_POLL_INTERVAL', 0.01)
+    monkeypatch.setattr(job_queue, 'JOB_PROGRESS_INTERVAL', 0.01)
+    monkeypatch.setattr(job_queue, 'proxy_manager', FakeProxyManager())
+
+    async def run():
+        await database['Searches'].insert_many([{"text": 'usb'}, {"text": 'hdmi'}])
+        workers = [job_queue.JobWorker(2), job_queue.JobWorker(1)]
+        workers[1].worker_id += '-2'
+        worker_tasks = [asyncio.create_task(worker.run()) for worker in workers]
+        product_details_list = await job_queue.run_distributed('run1')
+        for worker in workers:
+            worker.stop()
+        await asyncio.gather(*worker_tasks)
+        return product_details_list, await db.get_job_counts('run1')
+
+    product_details_list, job_counts = asyncio.run(run())
+    # Three promotions jobs fan out to two product keys
+    assert job_counts == {'search': {'done': 2}, 'promotions': {'done': 3}, 'product_details': {'done': 2}}
+    assert sorted(handled) == sorted([('search', 'usb'), ('search', 'hdmi'), ('promotions', 'CODE1'),
+                                      ('promotions', 'CODE2'), ('promotions', 'CODE2')] +
+                                     [('product_details', None)] * 2)
+    assert len(product_details_list) == 2
+    assert product_details_list[0].id == 'B0ABCDEF12/CODE1'
@@ -0,0 +1,22 @@
+from config import LOG_DETAILS_MAX_ITEMS
+from logger import get_details_preview, format_details
+
+
+def test_small_details_are_snapshotted_at_call_time():
+    promo_codes = {'CODE1'}
+    job_counts = {'search': {'done': 1}}
+    promo_code_preview, _ = get_details_preview(promo_codes)
+    job_counts_preview, _ = get_details_preview(job_counts)
+
+    promo_codes.add('CODE2')
+    job_counts['search']['done'] = 2
+    assert format_details(promo_code_preview) == "{'CODE1'}"
+    assert job_counts_preview == {'search': {'done': 1}}
+
+
+def test_large_details_are_truncated():
+    product_links = [f"https://www.amazon.co.uk/dp/B0ABCDEF{index:02}" for index in range(LOG_DETAILS_MAX_ITEMS + 5)]
+    preview, omitted_items = get_details_preview(product_links)
+    product_links.clear()
+    assert len(preview) == LOG_DETAILS_MAX_ITEMS
+    assert omitted_items == 5
@@ -0,0 +1,78 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+import pytest
+
+import pipeline
+import scraper
+from models import Promotion
+
+PRODUCT_URL = "https://www.amazon.co.uk/dp/B0ABCDEF12"
+
+
+class FakeBrowserPool:
+    @asynccontextmanager
+    async def page(self, stage: str = None):
+        yield object()
+
+    @asynccontextmanager
+    async def worker_page(self, isolated: bool, stage: str = None):
+        yield object()
+
+
+class FakeFingerprintTracker:
+    async def get_unchanged_search_promo_codes(self, search_term, product_links):
+        return None
+
+    def record_link_promo_codes(self, link, promo_codes):
+        pass
+
+    async def get_new_promotions(self, promo_code, promotions):
+        return promotions
+
+
+def test_failed_stage_tears_the_pipeline_down(monkeypatch):
+    scraping_details = asyncio.Event()
+    cancelled = []
+
+    async def get_all_searches():
+        return ['usb']
+
+    async def scraping_promo_products_from_search(search_term):
+        return [PRODUCT_URL]
+
+    async def get_promo_codes_from_cache(product_links, force_refresh=False):
+        return {PRODUCT_URL: {'CODE1', 'CODE2'}}, []
+
+    async def scrape_links_from_promo_code_with_retries(promo_code, coupon_label):
+        if coupon_label == '#1':
+            return [Promotion(promo_code, "Save 20%", "url", "Title", "£9.99", "image", PRODUCT_URL)]
+        await scraping_details.wait()
+        raise RuntimeError("promotion page broke")
+
+    async def scrape_product_details_from_url(page, promotion):
+        scraping_details.set()
+        try:
+            await asyncio.sleep(60)
+        except asyncio.CancelledError:
+            cancelled.append(promotion.promotion_code)
+            raise
+
+    async def sleep_randomly(base_sleep, randomness=1, message=None):
+        pass
+
+    monkeypatch.setattr(pipeline, 'browser_pool', FakeBrowserPool())
+    monkeypatch.setattr(scraper, 'browser_pool', FakeBrowserPool())
+    monkeypatch.setattr(scraper, 'sleep_randomly', sleep_randomly)
+    monkeypatch.setattr(pipeline, 'get_all_searches', get_all_searches)
+    monkeypatch.setattr(pipeline, 'scraping_promo_products_from_search', scraping_promo_products_from_search)
+    monkeypatch.setattr(pipeline, 'get_promo_codes_from_cache', get_promo_codes_from_cache)
+    monkeypatch.setattr(pipeline, 'scrape_links_from_promo_code_with_retries', scrape_links_from_promo_code_with_retries)
+    monkeypatch.setattr(scraper, 'scrape_product_details_from_url', scrape_product_details_from_url)
+
+    async def run():
+        await asyncio.wait_for(pipeline.run_streaming_pipeline(FakeFingerprintTracker()), 5)
+
+    with pytest.raises(RuntimeError, match="promotion page broke"):
+        asyncio.run(run())
+    assert len(cancelled) == 1
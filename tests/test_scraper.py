@@ -0,0 +1,90 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+import pytest
+
+import scraper
+from models import Promotion
+
+
+class FakeProductPage:
+    """Stands in for a Playwright page on a product page whose URL carries no /dp/ path."""
+
+    def __init__(self, product_url: str):
+        self.product_url = product_url
+
+    async def evaluate(self, script):
+        return {"product_img": "https://m.media-amazon.com/image.jpg", "product_title": "Title",
+                "product_url": self.product_url, "asin": None, "current_price": "£9.99", "sales_last_month": 100}
+
+
+def get_promotion(product_url: str) -> Promotion:
+    return Promotion("CODE1", "Save 20%", "https://www.amazon.co.uk/promotion/psp/CODE1", "Title", "£9.99",
+                     "https://m.media-amazon.com/image.jpg", product_url)
+
+
+def test_products_under_one_promo_code_get_different_ids(monkeypatch):
+    async def navigate(page, url, *args, **kwargs):
+        pass
+
+    monkeypatch.setattr(scraper, 'navigate', navigate)
+
+    async def scrape(product_url: str):
+        return await scraper.scrape_product_details_from_url(FakeProductPage(product_url), get_promotion(product_url))
+
+    first = asyncio.run(scrape("https://www.amazon.co.uk/dp/B0ABCDEF12"))
+    second = asyncio.run(scrape("https://www.amazon.co.uk/Some-Product/dp/b0abcdef34/ref=sr_1_1"))
+
+    assert first.id == "B0ABCDEF12/CODE1"
+    assert second.id == "B0ABCDEF34/CODE1"
+
+
+class FakeBrowserPool:
+    @asynccontextmanager
+    async def page(self, stage: str = None):
+        yield object()
+
+
+def test_cancelling_the_product_details_batch_stops_it(monkeypatch):
+    visited = []
+
+    async def scrape_product_details_from_url(page, promotion):
+        visited.append(promotion.product_url)
+        await asyncio.sleep(60)
+
+    monkeypatch.setattr(scraper, 'browser_pool', FakeBrowserPool())
+    monkeypatch.setattr(scraper, 'scrape_product_details_from_url', scrape_product_details_from_url)
+    promotions = [get_promotion(f"https://www.amazon.co.uk/dp/B0ABCDEF1{index}") for index in range(5)]
+
+    async def run():
+        task = asyncio.create_task(scraper.scrape_product_details_from_urls_in_batch(promotions))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        await asyncio.wait_for(task, 1)
+
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(run())
+    assert len(visited) == 1
+
+
+def test_resumed_product_details_batch_keeps_link_order(monkeypatch):
+    promotions = [get_promotion(f"https://www.amazon.co.uk/dp/B0ABCDEF1{index}") for index in range(5)]
+    restored_urls = {promotions[1].product_url, promotions[3].product_url}
+
+    async def scrape(page, promotion):
+        return f"scraped {promotion.product_url}"
+
+    async def sleep_randomly(base_sleep, randomness=1, message=None):
+        pass
+
+    monkeypatch.setattr(scraper, 'browser_pool', FakeBrowserPool())
+    monkeypatch.setattr(scraper, 'scrape_product_details_from_url', scrape)
+    monkeypatch.setattr(scraper, 'sleep_randomly', sleep_randomly)
+    monkeypatch.setattr(scraper.run_checkpoint, 'get_product_details',
+                        lambda promotion: f"restored {promotion.product_url}"
+                        if promotion.product_url in restored_urls else None)
+
+    product_details_list = asyncio.run(scraper.scrape_product_details_from_urls_in_batch(promotions))
+    assert [product_details.split(' ')[1] for product_details in product_details_list] == \
+        [promotion.product_url for promotion in promotions]
+    assert product_details_list[1].startswith('restored') and product_details_list[2].startswith('scraped')
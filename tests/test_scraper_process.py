@@ -0,0 +1,39 @@
+import asyncio
+import time
+
+import scraper_process
+from models import ProcessedProductDetails
+
+# A child that ignores the stop request, like a scrape stuck in a handler that swallows the cancellation
+STUBBORN_CHILD = """
+import signal
+import time
+
+signal.signal(signal.SIGTERM, signal.SIG_IGN)
+sys.stdout.write('{"type": "heartbeat"}\\n')
+sys.stdout.flush()
+time.sleep(60)
+"""
+
+
+def test_stop_kills_a_child_that_does_not_exit(tmp_path, monkeypatch):
+    child_script = tmp_path / 'child.py'
+    child_script.write_text(STUBBORN_CHILD)
+    monkeypatch.setattr(scraper_process, 'SCRAPER_PROCESS_SCRIPT', str(child_script))
+    monkeypatch.setattr(scraper_process, 'SCRAPER_PROCESS_STOP_TIMEOUT', 0.5)
+
+    async def run():
+        process = scraper_process.ScraperProcess()
+        run_task = asyncio.create_task(process.run())
+        while not process.is_running:
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.5)
+        started_at = time.monotonic()
+        await asyncio.wait_for(process.stop(), 5)
+        result = await asyncio.wait_for(run_task, 5)
+        return time.monotonic() - started_at, result, process.is_running
+
+    stop_time, result, is_running = asyncio.run(run())
+    assert stop_time < 5
+    assert isinstance(result, ProcessedProductDetails) and not result.upserted
+    assert not is_running
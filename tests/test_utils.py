@@ -0,0 +1,33 @@
+from utils import canonicalize_product_url, get_unique_product_urls, extract_asin
+
+
+def test_canonicalize_unwraps_sponsored_redirects():
+    url = ("https://www.amazon.co.uk/sspa/click?ie=UTF8&spc=MTo0&sp_csd=d2lkZ2V0&"
+           "url=%2FSome-Product%2Fdp%2FB0ABCDEF12%2Fref%3Dsr_1_1_sspa%3Fkeywords%3Dusb%26psc%3D1")
+    assert extract_asin(url) == "B0ABCDEF12"
+    assert canonicalize_product_url(url) == "https://www.amazon.co.uk/dp/B0ABCDEF12"
+
+
+def test_canonicalize_strips_slug_ref_and_query():
+    url = "https://www.amazon.co.uk/Some-Product-Name/dp/b0abcdef12/ref=sr_1_3?crid=2X&keywords=usb&qid=1&sr=8-3"
+    assert canonicalize_product_url(url) == "https://www.amazon.co.uk/dp/B0ABCDEF12"
+
+
+def test_canonicalize_keeps_links_without_an_asin():
+    url = "https://www.amazon.co.uk/promotion/psp/CODE1?ref=x"
+    assert canonicalize_product_url(url) == url
+
+
+def test_unique_product_urls_keep_first_seen_order():
+    urls = [
+        "https://www.amazon.co.uk/Second/dp/B0SECOND00/ref=sr_1_1",
+        "https://www.amazon.co.uk/First/dp/B0FIRST000?th=1",
+        "https://www.amazon.co.uk/sspa/click?url=%2Fdp%2FB0SECOND00%2Fref%3Dsspa",
+        "https://www.amazon.co.uk/dp/B0THIRD000",
+        "https://www.amazon.co.uk/gp/product/B0FIRST000",
+    ]
+    assert get_unique_product_urls(urls) == [
+        "https://www.amazon.co.uk/dp/B0SECOND00",
+        "https://www.amazon.co.uk/dp/B0FIRST000",
+        "https://www.amazon.co.uk/dp/B0THIRD000",
+    ]
@@ -2,7 +2,10 @@ import os
 import pytz
 import asyncio
 import random
-import inspect
+import re
+import logging
+import sys
+import urllib.parse
 
 from datetime import datetime
 from dotenv import load_dotenv
@@ -20,20 +23,66 @@ def get_current_time():
 async def sleep_randomly(base_sleep: float, randomness: float = 1, message: str = None):
     delay = base_sleep + random.uniform(-randomness, randomness)
     delay = max(delay, 0)
-    current_frame = inspect.currentframe()
-    caller_frame = current_frame.f_back
-    file_name = caller_frame.f_code.co_filename
-    line_number = caller_frame.f_lineno
-    project_root = Logger.get_project_root()
-    relative_file_name = os.path.relpath(file_name, project_root)
-    relative_file_name = f"./{relative_file_name.replace(os.sep, '/')}"
-    if message == None:
-        Logger.debug(f'Sleeping for {delay:.2f} seconds - {relative_file_name}:{line_number})')
-    else:
-        Logger.debug(f'Sleeping for {delay:.2f} seconds - {message} - {relative_file_name}:{line_number})')
+    if Logger.is_enabled_for(logging.DEBUG):
+        caller_frame = sys._getframe(1)
+        relative_file_name = Logger.get_relative_path(caller_frame.f_code.co_filename)
+        line_number = caller_frame.f_lineno
+        if message == None:
+            Logger.debug(f'Sleeping for {delay:.2f} seconds - {relative_file_name}:{line_number})')
+        else:
+            Logger.debug(f'Sleeping for {delay:.2f} seconds - {message} - {relative_file_name}:{line_number})')
+        del caller_frame
     await asyncio.sleep(delay)
 
-    del current_frame, caller_frame
+
+ASIN_REGEX = re.compile(r'/(?:dp|gp/product|gp/aw/d)/([A-Z0-9]{10})(?:[/?#]|$)', re.IGNORECASE)
+REDIRECT_PATHS = ('/sspa/click', '/gp/slredirect/picassoRedirect.html')
+
+
+def resolve_redirect_url(url: str) -> str:
+    """The product URL a sponsored result redirects to, or the URL itself when it is not a redirect."""
+    parsed_url = urllib.parse.urlsplit(url or '')
+    if not parsed_url.path.endswith(REDIRECT_PATHS):
+        return url or ''
+    target = urllib.parse.parse_qs(parsed_url.query).get('url')
+    return urllib.parse.urljoin(url, target[0]) if target else url
+
+
+def extract_asin(url: str) -> str | None:
+    match = ASIN_REGEX.search(urllib.parse.urlsplit(resolve_redirect_url(url)).path)
+    return match.group(1).upper() if match else None
+
+
+def canonicalize_product_url(url: str) -> str:
+    """Reduce a product link to https://<host>/dp/<ASIN>, dropping its slug, ref= path and tracking parameters.
+
+    Links without an ASIN are returned unchanged.
+    """
+    asin = extract_asin(url)
+    if asin is None:
+        return url
+    parsed_url = urllib.parse.urlsplit(resolve_redirect_url(url))
+    return f"https://{parsed_url.netloc or 'www.amazon.co.uk'}/dp/{asin}"
+
+
+def get_product_key(url: str) -> str:
+    """The key product links are de-duplicated on: the ASIN, or the URL itself when it has none."""
+    return extract_asin(url) or url
+
+
+def get_unique_product_urls(urls: list[str]) -> list[str]:
+    """Canonical product URLs with one entry per ASIN, in the order each one first appears."""
+    unique_urls = {}
+    for url in urls:
+        unique_urls.setdefault(get_product_key(url), canonicalize_product_url(url))
+    return list(unique_urls.values())
+
+
+def set_query_parameter(url: str, name: str, value: str) -> str:
+    parsed_url = urllib.parse.urlsplit(url)
+    query = [(key, item) for key, item in urllib.parse.parse_qsl(parsed_url.query, keep_blank_values=True) if key != name]
+    query.append((name, value))
+    return urllib.parse.urlunsplit(parsed_url._replace(query=urllib.parse.urlencode(query)))
 
 
 USER_AGENTS = [
@@ -51,36 +100,45 @@ USER_AGENTS = [
 user_agent_cycle = cycle(USER_AGENTS)
 
 
-async def get_browser(p):
-    user_data_dir = os.path.abspath("chrome_user_data")
-    os.makedirs(user_data_dir, exist_ok=True)
+BROWSER_ARGS = [
+    '--disable-blink-features=AutomationControlled',
+    '--disable-features=IsolateOrigins,site-per-process',
+    '--disable-site-isolation-trials',
+    '--disable-setuid-sandbox',
+    '--no-sandbox',
+    '--ignore-certificate-errors',
+    '--enable-features=NetworkService,NetworkServiceInProcess',
+    '--disable-extensions',
+    '--disable-popup-blocking',
+    '--disable-infobars',
+]
+
 
+def get_context_options():
     # Randomize geolocation within Farnham, UK area
     latitude = 51.2150 + random.uniform(-0.1, 0.1)
     longitude = -0.7986 + random.uniform(-0.1, 0.1)
 
+    return {
+        'ignore_https_errors': True,
+        'accept_downloads': True,
+        'permissions': ['geolocation'],
+        'geolocation': {'latitude': latitude, 'longitude': longitude},
+        'locale': 'en-GB',
+        'timezone_id': 'Europe/London',
+    }
+
+
+async def get_browser(p, proxy: dict = None):
+    user_data_dir = os.path.abspath("chrome_user_data")
+    os.makedirs(user_data_dir, exist_ok=True)
+
     browser = await p.chromium.launch_persistent_context(
         user_data_dir=user_data_dir,
         headless=False,
-        args=[
-            '--disable-blink-features=AutomationControlled',
-            '--disable-features=IsolateOrigins,site-per-process',
-            '--disable-site-isolation-trials',
-            '--disable-setuid-sandbox',
-            '--no-sandbox',
-            '--ignore-certificate-errors',
-            '--enable-features=NetworkService,NetworkServiceInProcess',
-            f'--user-agent={next(user_agent_cycle)}',
-            '--disable-extensions',
-            '--disable-popup-blocking',
-            '--disable-infobars',
-        ],
-        ignore_https_errors=True,
-        accept_downloads=True,
-        permissions=['geolocation'],
-        geolocation={'latitude': latitude, 'longitude': longitude},
-        locale='en-GB',
-        timezone_id='Europe/London',
+        args=[*BROWSER_ARGS, f'--user-agent={next(user_agent_cycle)}'],
+        proxy=proxy,
+        **get_context_options(),
     )
     pages = browser.pages
     if pages:
@@ -88,3 +146,16 @@ async def get_browser(p):
     else:
         page = await browser.new_page()
     return browser, page
+
+
+async def launch_browser(p):
+    return await p.chromium.launch(headless=False, args=BROWSER_ARGS)
+
+
+async def get_isolated_context(browser, storage_state=None, proxy: dict = None):
+    return await browser.new_context(
+        storage_state=storage_state,
+        user_agent=next(user_agent_cycle),
+        proxy=proxy,
+        **get_context_options(),
+    )
@@ -0,0 +1,35 @@
+import asyncio
+import signal
+
+import db
+from config import PROXIES_ENABLED
+from job_queue import JobWorker
+from logger import Logger
+from scraper import browser_pool, http_fetcher, proxy_manager
+
+
+async def main():
+    await db.connect_to_database()
+
+    worker = JobWorker()
+    loop = asyncio.get_running_loop()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signal_number, worker.stop)
+
+    try:
+        if PROXIES_ENABLED:
+            await proxy_manager.initialize_proxies()
+        await browser_pool.start()
+        await worker.run()
+    finally:
+        await http_fetcher.close()
+        await browser_pool.stop()
+        await proxy_manager.close()
+        await worker.save_proxy_stats()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except Exception as e:
+        Logger.critical('An error occurred', e)